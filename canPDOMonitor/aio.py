@@ -0,0 +1,462 @@
+"""
+asyncio versions of the device, pdo converter and monitor
+
+Frames are read, assembled and routed in the event loop rather than in a
+thread per object. :class:`ThreadedDevice` adapts the existing threaded
+devices such as :class:`kvaser.Kvaser` and :class:`virtual.Virtual`, waking
+the event loop when their read thread adds frames. Timesteps are produced
+with async for, or blocks of timesteps with a block_size, which needs
+numpy::
+
+    converter = AsyncPDOConverter(ThreadedDevice(Kvaser()), Format(odr),
+                                  block_size=100)
+    await converter.start()
+    async for block in converter:
+        ...
+"""
+
+from canPDOMonitor.can import TimestepAssembler, Device
+from canPDOMonitor.datalog import DataBlock
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.monitor import check_datalogger_node
+from abc import ABC, abstractmethod
+from collections import deque
+import asyncio
+import inspect
+import logging
+import time
+
+
+class AsyncDevice(ABC):
+    """
+    Base class for CAN devices read from the event loop
+
+    Child classes must implement the async _start and _stop methods, and
+    add frames with _add_frames from the event loop, so no locking is
+    needed. Frames are read in bursts with get_frames
+
+    :param bitrate: CAN Bus bitrate in b/s
+    :type bitrate: :class:`Int`
+    """
+
+    # seconds per unit of frame timestamp
+    timestamp_resolution = 1
+
+    def __init__(self, bitrate):
+        self.bitrate = bitrate
+        # frame timestamp at bus on, older frames are stale. None if unknown
+        self.start_timestamp = None
+        # bursts of frames waiting to be read
+        self.bursts = deque()
+        # set when frames are added or the device stops
+        self.ready = None
+        self.active = False
+        # total number of frames from device
+        self.frame_count = 0
+
+    async def start(self):
+        """
+        Starts the device adding frames
+        """
+        logger.info("Starting async CAN Device")
+        self.bursts.clear()
+        self.ready = asyncio.Event()
+        await self._start()
+        self.active = True
+
+    async def stop(self):
+        """
+        Stops the device, get_frames returns None once all frames are read
+        """
+        if self.active:
+            logger.debug("Stopping async CAN Device")
+            self.active = False
+            await self._stop()
+            self.ready.set()
+            logger.info("Async CAN Device Stopped")
+
+    async def get_frames(self, max_n=1000):
+        """
+        Waits for frames, returning the next burst of up to max_n frames
+
+        Returns None when the device has stopped and all frames have been
+        read
+        """
+        while not self.bursts:
+            if not self.active:
+                return None
+            self.ready.clear()
+            await self.ready.wait()
+
+        frames = self.bursts.popleft()
+        if len(frames) > max_n:
+            # leave the rest for the next call
+            self.bursts.appendleft(frames[max_n:])
+            frames = frames[:max_n]
+        return frames
+
+    def _add_frames(self, frames):
+        """
+        Adds a burst of frames, must be called from the event loop
+        """
+        if frames:
+            # mark when the burst was queued, for latency to the sinks
+            ingest_time = time.monotonic()
+            for frame in frames:
+                frame.ingest_time = ingest_time
+            self.bursts.append(frames)
+            self.frame_count = self.frame_count + len(frames)
+            self.ready.set()
+
+    def set_id_filter(self, ids):
+        """
+        Sets the frame ids wanted, called before start
+
+        Async devices keep every frame, for the converter to filter
+        """
+        pass
+
+    @abstractmethod
+    async def _start(self):
+        pass
+
+    @abstractmethod
+    async def _stop(self):
+        pass
+
+
+class ThreadedDevice(AsyncDevice):
+    """
+    Adapts a threaded :class:`can.Device` to be read from the event loop
+
+    The device keeps its own read thread. Its on_frames hook wakes the event
+    loop, at most once per read, so frames are awaited rather than polled
+
+    :param device: Device to read, not yet started
+    :type device: :class:`can.Device`
+    """
+
+    def __init__(self, device):
+        super().__init__(device.bitrate)
+        self.device = device
+        self.timestamp_resolution = device.timestamp_resolution
+        self.loop = None
+        # True once the event loop has been told of new frames
+        self.notified = False
+
+    def set_id_filter(self, ids):
+        """
+        Passes the frame ids wanted on to the device, to filter in hardware
+        """
+        self.device.set_id_filter(ids)
+
+    async def _start(self):
+        self.loop = asyncio.get_running_loop()
+        self.device.on_frames = self._notify
+        # starting hardware can block, so done outside the event loop
+        await self.loop.run_in_executor(None, self.device.start)
+        self.start_timestamp = self.device.start_timestamp
+
+    async def _stop(self):
+        await self.loop.run_in_executor(None, self.device.stop)
+
+    async def get_frames(self, max_n=1000):
+        """
+        Waits for frames, returning up to max_n from the device queue
+
+        Returns None when the device has stopped and all frames have been
+        read
+        """
+        while True:
+            frames = self.device.get_frames(max_n, timeout=0)
+            if frames or frames is None:
+                return frames
+            # clear then check again, so frames added in between are seen
+            self.notified = False
+            self.ready.clear()
+            frames = self.device.get_frames(max_n, timeout=0)
+            if frames or frames is None:
+                return frames
+            await self.ready.wait()
+
+    def _notify(self):
+        """
+        Called from the device thread when frames are added
+        """
+        if not self.notified:
+            self.notified = True
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+
+class AsyncVirtual(AsyncDevice):
+    """
+    Virtual device generating the frames of :class:`virtual.Virtual` in a
+    task, without any threads
+
+    :param nodes: CANopen node ids to send PDOs from
+    :type nodes: :class:`list`
+    """
+
+    def __init__(self, nodes=(1,)):
+        super().__init__(bitrate=1000000)
+        # only used to generate frames, never started
+        self.generator = Virtual(nodes=nodes)
+        self.task = None
+
+    async def _start(self):
+        self.generator.pacer.start()
+        self.generator._frame_count = 0
+        # timestamps are relative to start time
+        self.start_timestamp = 0
+        self.task = asyncio.create_task(self._gen_loop())
+
+    async def _stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def _gen_loop(self):
+        """
+        Adds a burst of frames whenever they are due, sleeping in between
+        """
+        generator = self.generator
+        pacer = generator.pacer
+        n = generator.burst_size
+        while True:
+            # sleeps until the last frame of the burst is due
+            await asyncio.sleep(pacer.delay(pacer.due(pacer.count + n)))
+            self._add_frames(generator.gen_frames(n))
+            pacer.add(n)
+
+
+class AsyncPDOConverter:
+    """
+    Converts frames from an :class:`AsyncDevice` into data, with async for
+
+    Frames of each node are assembled by a :class:`can.TimestepAssembler`
+    as in :class:`can.PDOConverter`. Blocks are passed on at the end of each
+    burst of frames, up to block_size timesteps, so data arrives as soon
+    as the device reads it. With block_size None, the default, every
+    timestep is passed on by itself. Blocks are decoded with numpy
+
+    :param device: Device to read, threaded devices are wrapped in
+        :class:`ThreadedDevice`
+    :type device: :class:`AsyncDevice`
+    :param format: PDO format of the frames
+    :type format: :class:`can.Format`
+    :param block_size: Maximum number of timesteps per block, None for
+        single timesteps
+    :type block_size: :class:`Int`
+    :param resync: If True, recover from out of order frames, see
+        :class:`can.PDOConverter`
+    :type resync: :class:`Bool`
+    """
+
+    # maximum number of frames to fetch from device at once
+    read_size = 1000
+
+    def __init__(self, device, format, block_size=None, resync=False):
+        if isinstance(device, Device):
+            device = ThreadedDevice(device)
+        self.device = device
+        self.format = format
+        self.block_size = block_size
+        self.resync = resync
+
+        # assembler of each node and lookup of frame id to assembler
+        self.assemblers = {}
+        self.dispatch = {}
+        # timesteps or blocks ready to be returned, filled by assemblers
+        self.data_queue = _ListQueue()
+
+    @property
+    def data_count(self):
+        """
+        Total timesteps assembled, over all nodes
+        """
+        return sum(a.data_count for a in self.assemblers.values())
+
+    async def start(self):
+        """
+        Starts the device and creates an assembler for each node
+        """
+        logger.info("Starting async PDO Converter")
+        self.format.compile()
+        self.device.set_id_filter(self.format.dispatch)
+        await self.device.start()
+        for id, (node, format) in self.format.dispatch.items():
+            if node not in self.assemblers:
+                self.assemblers[node] = TimestepAssembler(
+                    format, self.data_queue, block_size=self.block_size,
+                    resync=self.resync,
+                    timestamp_resolution=self.device.timestamp_resolution,
+                    start_timestamp=self.device.start_timestamp)
+            self.dispatch[id] = self.assemblers[node]
+        logger.info("Started async PDO Converter")
+
+    async def stop(self):
+        """
+        Stops the device, iteration ends once all frames are converted
+        """
+        await self.device.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        items = self.data_queue.items
+        while not items:
+            frames = await self.device.get_frames(self.read_size)
+            if frames is None:
+                # device has stopped
+                raise StopAsyncIteration
+            self._process_frames(frames)
+        return items.popleft()
+
+    def _process_frames(self, frames):
+        """
+        Passes a burst of frames to the assemblers, then ends their blocks
+        """
+        dispatch = self.dispatch
+        for frame in frames:
+            assembler = dispatch.get(frame.id)
+            if assembler is None:
+                continue
+            assembler.process_frame(frame.id, frame.data, frame.timestamp,
+                                    frame.ingest_time)
+        for assembler in self.assemblers.values():
+            assembler.flush()
+
+
+class AsyncMonitor:
+    """
+    Routes data from an :class:`AsyncPDOConverter` to sinks, in a task
+
+    Each timestep is passed through the filters, then to every sink as in
+    :class:`monitor.Monitor`. A sink is any function taking a
+    :class:`datalog.Timestep`, if it returns an awaitable it is awaited
+    before the next timestep. Blocks are split into timesteps first
+
+    :param pdo_converter:
+    :type pdo_converter: :class:`AsyncPDOConverter`
+    """
+
+    def __init__(self, pdo_converter):
+        self.pdo_converter = pdo_converter
+        self.filters = []
+        # (sink, node) pairs, node None for all
+        self.sinks = []
+        # dataloggers started and stopped with the monitor, and their nodes
+        self.dataloggers = []
+        self.datalogger_nodes = []
+        self.task = None
+
+    def add_filter(self, filter):
+        """
+        Add filter to be applied before the sinks
+
+        :param filter: A filter to be applied the timesteps
+        :type filter: :class:`monitor.FilterType`
+        """
+        self.filters.append(filter)
+
+    def add_sink(self, sink, node=None):
+        """
+        Adds a function or coroutine function to be given each timestep
+
+        :param sink: Called with each :class:`datalog.Timestep`
+        :type sink: :class:`callable`
+        :param node: Only send timesteps of this node, None for all
+        :type node: :class:`Int`
+        """
+        self.sinks.append((sink, node))
+
+    def add_datalogger(self, datalogger, node=None):
+        """
+        Adds a datalogger as a sink, started and stopped with the monitor
+
+        :param datalogger:
+        :type datalogger: :class:`datalog.DataLogger`
+        :param node: Only log timesteps of this node, required if the
+            format has more than one node. None for all
+        :type node: :class:`Int`
+        """
+        check_datalogger_node(self.pdo_converter.format, node)
+        self.dataloggers.append(datalogger)
+        self.datalogger_nodes.append(node)
+        self.add_sink(datalogger.put, node)
+
+    async def run(self):
+        """
+        Starts everything and routes data until the converter stops
+        """
+        logger.info("Async Monitor Started")
+        # nodes may have been added to the format since
+        for node in self.datalogger_nodes:
+            check_datalogger_node(self.pdo_converter.format, node)
+        for datalogger in self.dataloggers:
+            datalogger.start()
+        await self.pdo_converter.start()
+        try:
+            async for data in self.pdo_converter:
+                if isinstance(data, DataBlock):
+                    for timestep in data.timesteps():
+                        await self._route(timestep)
+                else:
+                    await self._route(data)
+        finally:
+            await self.pdo_converter.stop()
+            for datalogger in self.dataloggers:
+                datalogger.stop()
+            logger.info("Async Monitor Stopped")
+
+    def start(self):
+        """
+        Runs the monitor in a task, returning the task
+        """
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        """
+        Stops the converter and waits for the routing to end
+        """
+        await self.pdo_converter.stop()
+        if self.task is not None:
+            await self.task
+
+    async def _route(self, timestep):
+        """
+        Passes one timestep through filters and on to the sinks
+        """
+        for filter in self.filters:
+            filter.process(timestep)
+
+        node = timestep.schema.node
+        for sink, sink_node in self.sinks:
+            if sink_node is None or sink_node == node:
+                result = sink(timestep)
+                if inspect.isawaitable(result):
+                    await result
+
+
+class _ListQueue:
+    """
+    Stands in for the data queue of a :class:`can.TimestepAssembler`,
+    keeping the items for the converter to return
+    """
+
+    def __init__(self):
+        self.items = deque()
+
+    def put(self, item):
+        self.items.append(item)
+        return True
+
+    def close(self):
+        pass
+
+
+logger = logging.getLogger(__name__)
@@ -0,0 +1,201 @@
+"""
+Binary data log, with a self describing header, and its reader
+
+:class:`BinaryLogger` writes timesteps as fixed width rows of a float64
+time and float32 or float64 values, after a JSON header giving the signal
+names, node, rate and start time. The log is read back in place as numpy
+arrays with :class:`BinaryLog`, with no parsing
+"""
+
+from canPDOMonitor.datalog import DataLogger
+import logging
+import struct
+import json
+import time
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only required for reading logs with BinaryLog
+    np = None
+
+
+class BinaryLogger(DataLogger):
+    """
+    Writes timesteps to a binary log
+
+    inherits from :class:`datalog.DataLogger`, with the same start and end
+    conditions. The file starts with :data:`BINARY_LOG_HEADER`, then the
+    JSON header padded to a multiple of 8 bytes, then a row per timestep.
+    Rows are packed into a buffer and written buffer_size bytes at a time,
+    the rest on stop.
+
+    PDO values are 7Q8 or single floats, so float32 values are exact and a
+    row is a quarter of the size of the CSV text
+
+    :param dtype: Type of the values, "f4" for float32 or "f8" for float64
+    :type dtype: :class:`String`
+    :param rate: Timesteps per second, stored in the header. None for the
+        rate of the format the timesteps are from
+    :type rate: :class:`Float`
+    :param buffer_size: Bytes of rows written to file at once
+    :type buffer_size: :class:`Int`
+    """
+
+    file_mode = "wb"
+
+    def __init__(self, filename, start_condition=None, end_condition=None,
+                 start_at_zero=True, dtype="f4", rate=None,
+                 buffer_size=1 << 20):
+        super().__init__(filename, start_condition, end_condition,
+                         start_at_zero)
+        if dtype not in _VALUE_FORMATS:
+            raise ValueError("dtype must be f4 or f8, not {}".format(dtype))
+        self.dtype = dtype
+        self.rate = rate
+        self.buffer_size = buffer_size
+        # rows waiting to be written, created with the header
+        self.row = None
+        self.buffer = None
+        self.offset = 0
+
+    def _write_header(self, timestep):
+        """
+        Writes the JSON header describing the rows
+        """
+        header = {
+            "names": timestep.names,
+            "node": timestep.schema.node,
+            "rate": self.rate if self.rate is not None
+            else timestep.schema.rate,
+            # wall clock time of the first row
+            "start_time": time.time(),
+            "time_offset": self.time_offset,
+            "dtype": "<" + self.dtype,
+        }
+        text = json.dumps(header).encode()
+        # rows start 8 byte aligned
+        text = text + b" " * (-len(text) % 8)
+        self.file.write(BINARY_LOG_HEADER.pack(
+            BINARY_LOG_MAGIC, BINARY_LOG_VERSION, len(text)))
+        self.file.write(text)
+        self.bytes_written = (self.bytes_written + BINARY_LOG_HEADER.size
+                              + len(text))
+
+        self.row = struct.Struct("<d{}{}".format(
+            len(timestep.values), _VALUE_FORMATS[self.dtype]))
+        # whole number of rows
+        self.buffer = bytearray(max(self.buffer_size // self.row.size, 1)
+                                * self.row.size)
+        self.offset = 0
+
+    def _write_timestep(self, timestep):
+        """
+        Packs the timestep as a row, writing the buffer once full
+        """
+        self.row.pack_into(self.buffer, self.offset,
+                           timestep.time - self.time_offset,
+                           *timestep.values)
+        self.offset = self.offset + self.row.size
+        if self.offset == len(self.buffer):
+            self._flush()
+
+    def _flush(self):
+        """
+        Writes the rows in the buffer
+        """
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.bytes_written = self.bytes_written + self.offset
+        self.offset = 0
+
+    def _close(self):
+        if self.offset:
+            self._flush()
+        self.file.close()
+
+
+class BinaryLog:
+    """
+    Binary log read in place, as numpy arrays
+
+    The file is memory mapped, nothing is parsed or copied until the rows
+    are used. Values of a signal are found by name, as a column view::
+
+        log = BinaryLog("run.bin")
+        plot(log.time, log["Wave Gen Out"])
+
+    :param filename: Name of the binary log
+    :type filename: :class:`String`
+    """
+
+    def __init__(self, filename):
+        if np is None:
+            raise ImportError("numpy is required to read binary logs")
+        self.filename = filename
+        with open(filename, "rb") as file:
+            start = file.read(BINARY_LOG_HEADER.size)
+            if len(start) < BINARY_LOG_HEADER.size:
+                raise LogFormatError("Binary log header is too short")
+            magic, version, length = BINARY_LOG_HEADER.unpack(start)
+            if magic != BINARY_LOG_MAGIC:
+                raise LogFormatError("Not a binary log")
+            if version != BINARY_LOG_VERSION:
+                raise LogFormatError("Binary log version {} not supported"
+                                     .format(version))
+            # header with names, node, rate, start time and dtype
+            self.header = json.loads(file.read(length))
+        self.names = self.header["names"]
+        self.node = self.header["node"]
+        self.rate = self.header["rate"]
+        self.start_time = self.header["start_time"]
+        # position of each signal in the values
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        self.dtype = np.dtype([("time", "<f8"), ("values",
+                                                 self.header["dtype"],
+                                                 (len(self.names),))])
+        offset = BINARY_LOG_HEADER.size + length
+        # a part written row at the end is left out
+        n = (os.path.getsize(filename) - offset) // self.dtype.itemsize
+        if n:
+            self.rows = np.memmap(filename, dtype=self.dtype, mode="r",
+                                  offset=offset, shape=(n,))
+        else:
+            self.rows = np.empty(0, dtype=self.dtype)
+
+    @property
+    def time(self):
+        return self.rows["time"]
+
+    @property
+    def values(self):
+        """
+        Values with shape (timesteps, signals)
+        """
+        return self.rows["values"]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, name):
+        """
+        Returns the values of the named signal
+        """
+        return self.rows["values"][:, self.index[name]]
+
+
+# start of a binary log: magic, version, length of the JSON header after
+BINARY_LOG_HEADER = struct.Struct("<8sII")
+BINARY_LOG_MAGIC = b"CANPDOBL"
+BINARY_LOG_VERSION = 1
+
+# struct format of the values of each dtype
+_VALUE_FORMATS = {"f4": "f", "f8": "d"}
+
+
+class LogFormatError(Exception):
+    pass
+
+
+logger = logging.getLogger(__name__)
@@ -4,14 +4,27 @@ Group of classes for CAN and PDO
 """
 
 from abc import ABC, abstractmethod
-from canPDOMonitor.datalog import Datapoint
+from canPDOMonitor.datalog import Schema, Timestep, DataBlock
 from canPDOMonitor.common import params_from_file
-import queue
+from canPDOMonitor.scheduler import scheduler
+from canPDOMonitor.metrics import registry
+from array import array
+from collections import deque
+from enum import Enum
+import operator
+import pickle
+import tempfile
 import threading
 import logging
 import time
 import struct
 
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only required for block decoding
+    np = None
+
 
 class Device(ABC):
     """Main class for interfacing with CAN hardware.
@@ -20,25 +33,73 @@ class Device(ABC):
     Child classes must implement _start and _stop methods
 
     CAN frames must be read from devices and placed into frame_queue async
-    and thread safe following call to _start method.
+    and thread safe following call to _start method. Devices that read
+    frames in bursts should pass the whole burst to _add_frames, so the
+    queue is only locked once per burst
 
     init should call parent constructor with bitrate
 
+    Devices that can read their timestamp clock should set start_timestamp
+    in _start, before going bus on, so frames left over from before the
+    start can be told apart by timestamp
+
+    on_frames can be set to a function called with no arguments, from the
+    thread adding them, each time frames are added or the device stops. It
+    must not block, see :class:`aio.ThreadedDevice`
+
+    recorder can be set to a :class:`record.FrameRecorder`, it is then
+    started and stopped with the device and given every frame read, even
+    those the queue then drops
+
+    :class:`PDOConverter` calls set_id_filter with the frame ids of its
+    format before start. Devices that can reject other frames in hardware
+    or before queueing them override it, counting the frames rejected in
+    hardware_rejected and software_rejected
+
     :param bitrate: CAN Bus bitrate in b/s
     :type bitrate: :class:`Int`
+    :param ring_buffer: If True, frames are held in a preallocated
+        :class:`FrameRing` instead of a :class:`BoundedQueue`
+    :type ring_buffer: :class:`Bool`
+    :param overflow_policy: What to do when the frame queue is full,
+        defaults to stopping the device
+    :type overflow_policy: :class:`OverflowPolicy`
     """
 
     # maximum number of CAN frames to hold in queue
     # 4000 is 1 second of 4 PDOs at 1KHz
     DEFAULT_QUEUE_SIZE = 8000
 
-    def __init__(self, bitrate, check_loop_time=10):
+    # seconds per unit of frame timestamp, overridden by devices that
+    # timestamp in other units
+    timestamp_resolution = 1
+
+    def __init__(self, bitrate, check_loop_time=10, ring_buffer=False,
+                 overflow_policy=None):
         # can bitrate of device
         self.bitrate = bitrate
+        # frame timestamp at bus on, older frames are stale. None if unknown
+        self.start_timestamp = None
+        # called when frames are added or the queue closed
+        self.on_frames = None
+        # records the raw frames to file
+        self.recorder = None
+        # frame ids wanted, None for all
+        self.id_filter = None
+        # frames of other ids rejected by the hardware, and by the device
+        # before queueing
+        self.hardware_rejected = 0
+        self.software_rejected = 0
+        self.ring_buffer = ring_buffer
         # queue to hold can frames
-        self.frame_queue = queue.Queue(maxsize=self.DEFAULT_QUEUE_SIZE)
+        if ring_buffer:
+            self.frame_queue = FrameRing(self.DEFAULT_QUEUE_SIZE,
+                                         policy=overflow_policy)
+        else:
+            self.frame_queue = BoundedQueue(maxsize=self.DEFAULT_QUEUE_SIZE,
+                                            policy=overflow_policy)
         # time in seconds to report device info
-        self.check_loop_time = int(check_loop_time)
+        self.check_loop_time = check_loop_time
 
         # total number of frames from device
         self.frame_count = 0
@@ -46,8 +107,8 @@ class Device(ABC):
         self.frame_start_time = None
         # approx rate of frames
         self.frame_rate = 0
-        # thread for checking device stats
-        self.check_thread = threading.Thread(target=self._check_loop)
+        # scheduled task for checking device stats
+        self.check_task = None
         # time the check was last run
         self.check_time = None
         # frame count on last check
@@ -57,11 +118,8 @@ class Device(ABC):
         self.active = threading.Event()
         # lock for reading/changing active flag
         self.active_lock = threading.Lock()
-
-        # thread used for stopping device
-        self.stop_thread = threading.Thread(target=self.stop_check)
-        # event used to trigger device stopping
-        self.stop_trigger = threading.Event()
+        # seconds the last call to stop took
+        self.stop_time = None
 
     def start(self):
         """
@@ -74,17 +132,18 @@ class Device(ABC):
         logger.info("Starting CAN Device")
         # clear the frame queue and start device
         self.clear_queue()
+        if self.recorder is not None:
+            self.recorder.start(self.timestamp_resolution)
 
         # acquire lock to ensure active state change isnt interrupted by thread
         with self.active_lock:
             self._start()
             self.active.set()
 
-        # start the checking thread
-        self.check_thread.start()
-
-        # start the internal stop thread
-        self.stop_thread.start()
+        # check stats periodically
+        self._register_metrics()
+        self.check_task = scheduler.call_every(self.check_loop_time,
+                                               self._check)
 
     def stop(self):
         """
@@ -95,6 +154,7 @@ class Device(ABC):
         """
         if self.active.is_set():
             logger.debug("Stopping CAN Device")
+            start_time = time.monotonic()
             # add None to queue to indicate to consumer to stop
             self._add_to_queue(None)
 
@@ -102,21 +162,23 @@ class Device(ABC):
             with self.active_lock:
                 self._stop()
                 self.active.clear()
-                if self.check_thread.is_alive():
-                    self.check_thread.join()
-            # finally, stop the stop check thread
-            self.stop_trigger.set()
-            logger.info("CAN Device Stopped")
-
-    def stop_check(self):
+                if self.check_task is not None:
+                    self.check_task.cancel()
+            if self.recorder is not None:
+                self.recorder.stop()
+            self.stop_time = time.monotonic() - start_time
+            logger.info("CAN Device Stopped in {:.3f}s".format(
+                self.stop_time))
+
+    def _trigger_stop(self):
         """
-        Waits for the command to stop, and calls stop, for internal threads
+        Stops the device from a thread of its own
+
+        For internal threads, which cannot stop the device themselves as
+        stop waits for them to end. Not done in the scheduler thread, as
+        the waits would hold up the other scheduled tasks
         """
-        # wait for the stop trigger
-        self.stop_trigger.wait()
-        # check if device is still active
-        if self.active.is_set():
-            self.stop()
+        threading.Thread(target=self.stop).start()
 
 
     def get_frame(self):
@@ -131,7 +193,24 @@ class Device(ABC):
         """
 
         # Blocking call to get function
-        return self.frame_queue.get(True)
+        return self.frame_queue.get()
+
+    def get_frames(self, max_n=1000, timeout=None):
+        """
+        Gets up to max_n frames from the queue in one go
+
+        Blocks until at least one frame is available, or timeout seconds
+        have passed, in which case an empty list is returned. Returns None
+        when can device has been stopped and all frames have been read
+
+        :param max_n: Maximum number of frames to return
+        :type max_n: :class:`Int`
+        :param timeout: Seconds to wait for a frame, None waits forever
+        :type timeout: :class:`Float`
+        :return: List of frames in the order they arrived
+        :rtype: :class:`list`
+        """
+        return self.frame_queue.get_many(max_n, timeout)
 
     def clear_queue(self):
         """
@@ -139,9 +218,18 @@ class Device(ABC):
 
         This will not work well if the CAN device is still running
         """
-        # Thread safe method of clearing the queue
-        with self.frame_queue.mutex:
-            self.frame_queue.queue.clear()
+        self.frame_queue.clear()
+
+    def set_id_filter(self, ids):
+        """
+        Sets the frame ids wanted, called before start
+
+        The default keeps every frame, for the reader to filter
+
+        :param ids: Frame ids to keep
+        :type ids: :class:`list`
+        """
+        self.id_filter = frozenset(ids)
 
     @abstractmethod
     def _start(self):
@@ -164,74 +252,699 @@ class Device(ABC):
         """
         Called to add a frame to the queue
 
-        Method adds frame to queue whilst checking for overflow etc
+        Method adds frame to queue whilst checking for overflow etc.
+        None marks the end of frames, the consumer is given None once all
+        frames before it have been read
+        """
+        if frame is None:
+            self.frame_queue.close()
+            if self.on_frames is not None:
+                self.on_frames()
+            return True
+        return self._add_frames((frame,))
+
+    def _add_frames(self, frames):
+        """
+        Called to add a burst of frames to the queue in one go
+
+        If there is not room for the whole burst, the frame queue overflow
+        policy is applied. With the default Stop policy none are added and
+        the device is stopped as for a single frame overflow
         """
+        if not frames:
+            return True
 
-        # if queue is not full, put frame on queue
-        if self.frame_queue.full():
-            # wait for a second for something to remove item from queue
+        if self.recorder is not None:
+            self.recorder.put(frames)
+
+        if not self.ring_buffer:
+            # mark when the burst was queued, for latency to the sinks. The
+            # ring buffer keeps its own times as it does not keep frames
+            ingest_time = time.monotonic()
+            for frame in frames:
+                frame.ingest_time = ingest_time
+
+        # if queue has room, put frames on queue
+        if not self.frame_queue.put_many(frames):
             logging.error("CAN Device Frame Overflow")
             logger.debug("Frame Count {}".format(self.frame_count))
-            self.stop_trigger.set()
+            self._trigger_stop()
             return False
-  
-        self.frame_queue.put(frame)
+        if self.on_frames is not None:
+            self.on_frames()
 
         # record frame stats
         if self.frame_start_time is None:
             # this if first frame, record time
             self.frame_start_time = time.time()
-        self.frame_count = self.frame_count + 1
+        self.frame_count = self.frame_count + len(frames)
+        return True
+
+    def _add_records(self, records):
+        """
+        Called to add a burst of frames packed as :data:`FRAME_RECORD` bytes
+
+        A ring buffer copies the records in one go, without frame objects.
+        Otherwise frames are created from the records and added as by
+        _add_frames
+        """
+        if not self.ring_buffer:
+            return self._add_frames(
+                [Frame(id=id, data=data[:dlc], timestamp=timestamp, dlc=dlc)
+                 for timestamp, id, dlc, data
+                 in FRAME_RECORD.iter_unpack(records)])
+        if not records:
+            return True
+
+        if self.recorder is not None:
+            self.recorder.put_records(records)
+
+        if not self.frame_queue.put_records(records):
+            logging.error("CAN Device Frame Overflow")
+            self._trigger_stop()
+            return False
+        if self.on_frames is not None:
+            self.on_frames()
+
+        if self.frame_start_time is None:
+            self.frame_start_time = time.time()
+        self.frame_count = (self.frame_count
+                            + len(records) // FRAME_RECORD.size)
+        return True
+
+    def _check(self):
+        """
+        Updates stats on Device, such as frame rate, run by the scheduler
+        """
+        # if this is not the first run
+        if self.check_time is not None and self.frame_start_time is not None:
+            # calc frame rate
+            frame_count = self.frame_count - self.check_frame_count
+            elapsed_time = time.time() - self.check_time
+            self.frame_rate = round(frame_count / elapsed_time)
+            total_frame_rate = round(
+                self.frame_count / (time.time() - self.frame_start_time))
+
+            logger.debug("CAN Frame Rate: {}, Frame Count {}, Queue: {}, "
+                         "Dropped: {}".
+                         format(total_frame_rate,
+                                self.frame_count, self.frame_queue.qsize(),
+                                self.frame_queue.dropped))
+
+        # record this check time and frame count for next run
+        self.check_time = time.time()
+        self.check_frame_count = self.frame_count
+
+    def _register_metrics(self):
+        """
+        Adds the device stats to the :data:`metrics.registry`
+
+        Values are read from the device and its queue on export, so
+        nothing is added to the read thread
+        """
+        labels = {"device": type(self).__name__}
+        registry.counter("canpdo_device_frames_total",
+                         "Frames read from the device", labels,
+                         fn=lambda: self.frame_count)
+        registry.gauge("canpdo_device_frame_rate",
+                       "Frames per second at the last check", labels,
+                       fn=lambda: self.frame_rate)
+        registry.gauge("canpdo_device_queue_size",
+                       "Frames waiting in the frame queue", labels,
+                       fn=lambda: self.frame_queue.qsize())
+        registry.gauge("canpdo_device_queue_high_water",
+                       "Most frames held in the frame queue", labels,
+                       fn=lambda: self.frame_queue.high_water)
+        registry.counter("canpdo_device_frames_dropped_total",
+                         "Frames dropped by the frame queue overflow policy",
+                         labels, fn=lambda: self.frame_queue.dropped)
+        for filter in ("hardware", "software"):
+            registry.counter("canpdo_device_frames_rejected_total",
+                             "Frames of unwanted ids rejected by the device",
+                             dict(labels, filter=filter),
+                             fn=lambda attr=filter + "_rejected":
+                             getattr(self, attr))
+
+
+# fixed width record of a frame: timestamp, id, dlc, 3 pad bytes, 8 data
+FRAME_RECORD = struct.Struct("<dIB3x8s")
+# the record fields before the data bytes
+_RECORD_HEADER = struct.Struct("<dIB3x")
+
+# header of a raw binary frame log: magic, version, seconds per unit of
+# timestamp. The same size as a record, so records follow on aligned
+FRAME_LOG_HEADER = struct.Struct("<8sId4x")
+FRAME_LOG_MAGIC = b"CANPDOFL"
+FRAME_LOG_VERSION = 1
+
+
+def _pack_record(buffer, offset, id, dlc, timestamp, data):
+    """
+    Writes a frame as a :data:`FRAME_RECORD` into buffer at offset
+    """
+    _RECORD_HEADER.pack_into(buffer, offset, timestamp, id, dlc)
+    offset = offset + _RECORD_HEADER.size
+    buffer[offset:offset + 8] = _pad_data(data)
+
+
+class OverflowPolicy(Enum):
+    """
+    What a queue does when an item is added and it is full
+    """
+    # reject the items, the device or converter stops
+    Stop = 1
+    # wait for the consumer to make room, dropping the items on timeout
+    Block = 2
+    # drop the items being added
+    DropNewest = 3
+    # drop the oldest items in the queue to make room
+    DropOldest = 4
+    # write the items to a temporary file, read back once queue has room
+    Spill = 5
+
+    def __str__(self):
+        return self.name
+
+
+class BoundedQueue:
+    """
+    Thread safe bounded queue that items can be added to and read in bursts
+
+    Similar to :class:`queue.Queue`, but put_many and get_many move a whole
+    burst of items with a single lock, rather than one lock per item.
+    Calling close marks the end of the items, get then returns None once
+    the queue is empty instead of blocking.
+
+    Used for both frames in :class:`Device` and timesteps in
+    :class:`PDOConverter`. The policy sets what happens when full, with
+    dropped and spilled items counted. on_drop is called with any list of
+    items that are dropped
+
+    :param maxsize: Maximum number of items held in memory
+    :type maxsize: :class:`Int`
+    :param policy: What to do when full, defaults to Stop
+    :type policy: :class:`OverflowPolicy`
+    :param timeout: Seconds to wait for room with the Block policy
+    :type timeout: :class:`Float`
+    :param on_drop: Called with list of dropped items
+    :type on_drop: :class:`Callable`
+    """
+
+    def __init__(self, maxsize, policy=None, timeout=1, on_drop=None):
+        self.maxsize = maxsize
+        if policy is None:
+            policy = OverflowPolicy.Stop
+        self.policy = policy
+        self.timeout = timeout
+        self.on_drop = on_drop
+        self.queue = deque()
+        self.mutex = threading.Lock()
+        # notified when items are added or queue is closed
+        self.not_empty = threading.Condition(self.mutex)
+        # notified when items are removed, for the Block policy
+        self.not_full = threading.Condition(self.mutex)
+        self.closed = False
+
+        # overflow stats
+        self.dropped = 0
+        self.spilled = 0
+        self.high_water = 0
+        # file holding items that did not fit, for the Spill policy
+        self.spill = None
+
+    def put(self, item):
+        """
+        Adds a single item, returns False if rejected by the Stop policy
+        """
+        return self.put_many((item,))
+
+    def put_many(self, items):
+        """
+        Adds all the items, applying the overflow policy if there is no room
+
+        Returns False without adding any items if full and the policy is
+        Stop, True otherwise even if items were dropped
+        """
+        dropped = None
+        with self.mutex:
+            n = len(items)
+            if self.spill is not None:
+                # keep order, everything goes to file until it is read back
+                self.spill.write(items)
+                self.spilled = self.spilled + n
+                self.not_empty.notify()
+                return True
+
+            if len(self.queue) + n > self.maxsize:
+                if self.policy is OverflowPolicy.Stop:
+                    return False
+                elif self.policy is OverflowPolicy.Block:
+                    if not self.not_full.wait_for(
+                            lambda: len(self.queue) + n <= self.maxsize,
+                            self.timeout):
+                        dropped = list(items)
+                        items = ()
+                elif self.policy is OverflowPolicy.DropNewest:
+                    # keep what fits
+                    room = max(self.maxsize - len(self.queue), 0)
+                    dropped = list(items[room:])
+                    items = items[:room]
+                elif self.policy is OverflowPolicy.DropOldest:
+                    # remove enough of the oldest to make room
+                    n_old = min(len(self.queue) + n - self.maxsize,
+                                len(self.queue))
+                    popleft = self.queue.popleft
+                    dropped = [popleft() for i in range(n_old)]
+                    if n > self.maxsize:
+                        dropped.extend(items[:n - self.maxsize])
+                        items = items[n - self.maxsize:]
+                elif self.policy is OverflowPolicy.Spill:
+                    self.spill = _SpillFile()
+                    self.spill.write(items)
+                    self.spilled = self.spilled + n
+                    self.not_empty.notify()
+                    return True
+
+            if dropped is not None:
+                self.dropped = self.dropped + len(dropped)
+            if items:
+                self.queue.extend(items)
+                if len(self.queue) > self.high_water:
+                    self.high_water = len(self.queue)
+                self.not_empty.notify()
+
+        if dropped and self.on_drop is not None:
+            self.on_drop(dropped)
+        return True
+
+    def get(self, timeout=None):
+        """
+        Returns the next item, None if closed and empty or on timeout
+        """
+        items = self.get_many(1, timeout)
+        if items:
+            return items[0]
+        return None
+
+    def get_many(self, max_n, timeout=None):
+        """
+        Returns list of up to max_n items, waiting for at least one
+
+        Returns an empty list on timeout, None if closed and empty
+        """
+        with self.not_empty:
+            if not self.queue:
+                if self.spill is not None:
+                    self._unspill()
+                if not self.queue and self.closed:
+                    return None
+                self.not_empty.wait_for(
+                    lambda: self.queue or self.closed
+                    or self.spill is not None, timeout)
+                if not self.queue and self.spill is not None:
+                    self._unspill()
+                if not self.queue:
+                    return None if self.closed else []
+            popleft = self.queue.popleft
+            items = [popleft() for i in range(min(max_n, len(self.queue)))]
+            if self.policy is OverflowPolicy.Block:
+                self.not_full.notify()
+            return items
+
+    def _unspill(self):
+        """
+        Moves spilled items back into the queue, must hold mutex
+        """
+        items = self.spill.read(self.maxsize)
+        self.queue.extend(items)
+        if self.spill.empty():
+            self.spill.close()
+            self.spill = None
+
+    def close(self):
+        """
+        Marks the end of items, waking any waiting consumer
+        """
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+
+    def clear(self):
+        """
+        Empties the queue and reopens it if closed
+        """
+        with self.mutex:
+            self.queue.clear()
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+            self.closed = False
+            self.not_full.notify_all()
+
+    def qsize(self):
+        n = len(self.queue)
+        if self.spill is not None:
+            n = n + self.spill.count
+        return n
+
+    def full(self):
+        return len(self.queue) >= self.maxsize
+
+    def empty(self):
+        return not self.queue and self.spill is None
+
+
+class _SpillFile:
+    """
+    Temporary file that bursts of items are pickled to and read back from
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.read_pos = 0
+        # number of items in file not yet read back
+        self.count = 0
+        # items unpickled from file but not yet returned
+        self.pending = deque()
+
+    def write(self, items):
+        self.file.seek(0, 2)
+        pickle.dump(list(items), self.file, pickle.HIGHEST_PROTOCOL)
+        self.count = self.count + len(items)
+
+    def read(self, max_n):
+        """
+        Returns list of up to max_n of the oldest items in file
+        """
+        self.file.seek(self.read_pos)
+        while len(self.pending) < max_n and self.count > len(self.pending):
+            self.pending.extend(pickle.load(self.file))
+        self.read_pos = self.file.tell()
+        popleft = self.pending.popleft
+        items = [popleft() for i in range(min(max_n, len(self.pending)))]
+        self.count = self.count - len(items)
+        return items
+
+    def empty(self):
+        return self.count == 0
+
+    def close(self):
+        self.file.close()
+
+
+class FrameRing:
+    """
+    Preallocated single producer, single consumer ring buffer of frames
+
+    Frames are stored as fixed width :data:`FRAME_RECORD` slots in one
+    bytearray, so capacity is a fixed memory bound of
+    capacity * FRAME_RECORD.size bytes and no frame objects are kept.
+
+    The producer only moves head and the consumer only moves tail, so no lock
+    is taken to add or read frames. An event is used to wake a waiting
+    consumer. Records returned by get_records are a view into the ring and
+    are only valid until the next call to get, which hands the slots back to
+    the producer. Has the same interface as :class:`BoundedQueue`.
+
+    The Stop, Block and DropNewest overflow policies are supported. Dropping
+    the oldest or spilling would need the producer to move the tail, which
+    is owned by the consumer
+
+    The time.monotonic each burst was added is kept for each slot, read with
+    ingest_times alongside get_records
+
+    :param capacity: Number of frame slots
+    :type capacity: :class:`Int`
+    :param policy: What to do when full, defaults to Stop
+    :type policy: :class:`OverflowPolicy`
+    :param timeout: Seconds to wait for room with the Block policy
+    :type timeout: :class:`Float`
+    """
+
+    def __init__(self, capacity, policy=None, timeout=1):
+        if policy is None:
+            policy = OverflowPolicy.Stop
+        if policy not in (OverflowPolicy.Stop, OverflowPolicy.Block,
+                          OverflowPolicy.DropNewest):
+            raise ValueError(
+                "FrameRing does not support {} policy".format(policy))
+        self.policy = policy
+        self.timeout = timeout
+        self.maxsize = capacity
+        self.record_size = FRAME_RECORD.size
+        self.buffer = bytearray(capacity * self.record_size)
+        self.view = memoryview(self.buffer)
+        # time.monotonic each slot was written
+        self.ingest = array("d", bytes(8 * capacity))
+        self.ingest_view = memoryview(self.ingest)
+        # total records written and read, slot is count % capacity
+        self.head = 0
+        self.tail = 0
+        # records handed to consumer but not yet released
+        self.pending = 0
+        # set by producer when records are added
+        self.ready = threading.Event()
+        # set by consumer when records are released, for Block policy
+        self.released = threading.Event()
+        self.closed = False
+
+        # overflow stats
+        self.dropped = 0
+        self.spilled = 0
+        self.high_water = 0
+
+    def put(self, frame):
+        """
+        Adds a single frame, returns False if rejected by the Stop policy
+        """
+        return self.put_many((frame,))
+
+    def put_many(self, frames):
+        """
+        Writes the frames into slots, applying the policy if there is no room
+
+        Returns False without adding any frames if full and the policy is
+        Stop, True otherwise even if frames were dropped
+        """
+        n = len(frames)
+        head = self.head
+        if head - self.tail + n > self.maxsize:
+            frames = self._overflow(frames)
+            if frames is None:
+                return False
+            n = len(frames)
+        buffer = self.buffer
+        ingest = self.ingest
+        ingest_time = time.monotonic()
+        for frame in frames:
+            slot = head % self.maxsize
+            _pack_record(buffer, slot * self.record_size,
+                         frame.id, frame.dlc, frame.timestamp, frame.data)
+            ingest[slot] = ingest_time
+            head = head + 1
+        # publish the records to the consumer
+        self.head = head
+        if head - self.tail > self.high_water:
+            self.high_water = head - self.tail
+        self.ready.set()
         return True
 
-    def _check_loop(self):
+    def _overflow(self, frames):
+        """
+        Applies the overflow policy, returns the frames to add or None
         """
-        Updates stats on Device, such as frame rate, at a slow rate
+        if self.policy is OverflowPolicy.Block:
+            # wait for consumer to release enough slots
+            deadline = time.monotonic() + self.timeout
+            while self.head - self.tail + len(frames) > self.maxsize:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.dropped = self.dropped + len(frames)
+                    return ()
+                self.released.clear()
+                if self.head - self.tail + len(frames) > self.maxsize:
+                    self.released.wait(remaining)
+            return frames
+        elif self.policy is OverflowPolicy.DropNewest:
+            room = max(self.maxsize - (self.head - self.tail), 0)
+            self.dropped = self.dropped + len(frames) - room
+            return frames[:room]
+        return None
+
+    def put_record(self, id, dlc, timestamp, data):
         """
-        while(self.active.is_set()):
-            # if this is not the first run
-            if self.check_time is not None:
-                # calc frame rate
-                frame_count = self.frame_count - self.check_frame_count
-                elapsed_time = time.time() - self.check_time
-                self.frame_rate = round(frame_count / elapsed_time)
-                total_frame_rate = round(
-                    self.frame_count / (time.time() - self.frame_start_time))
+        Writes a single frame into a slot without needing a frame object
+        """
+        head = self.head
+        if head - self.tail >= self.maxsize:
+            if not self._overflow((None,)):
+                return self.policy is not OverflowPolicy.Stop
+        slot = head % self.maxsize
+        _pack_record(self.buffer, slot * self.record_size,
+                     id, dlc, timestamp, data)
+        self.ingest[slot] = time.monotonic()
+        self.head = head + 1
+        self.ready.set()
+        return True
 
-                logger.debug("CAN Frame Rate: {}, Frame Count {}, Queue: {}".
-                             format(total_frame_rate,
-                                    self.frame_count, self.frame_queue.qsize()))
+    def put_records(self, records):
+        """
+        Copies packed :data:`FRAME_RECORD` records into the ring in one go
 
-            # record this check time and frame count, and wait for next loop
-            self.check_time = time.time()
-            self.check_frame_count = self.frame_count
-            for i in range(self.check_loop_time):
-                if not self.active.is_set():
-                    break
-                time.sleep(1)
+        Applies the policy as put_many if there is no room
+        """
+        size = self.record_size
+        n = len(records) // size
+        head = self.head
+        if head - self.tail + n > self.maxsize:
+            # the policy only needs the count of records kept
+            kept = self._overflow(range(n))
+            if kept is None:
+                return False
+            n = len(kept)
+        if not n:
+            return True
+        records = memoryview(records)
+        slot = head % self.maxsize
+        # records up to the end of the ring, the rest wrap to the start
+        first = min(n, self.maxsize - slot)
+        self.buffer[slot * size:(slot + first) * size] = records[:first * size]
+        self.buffer[:(n - first) * size] = records[first * size:n * size]
+        # through the view, the array is exported so cannot be resized
+        ingest_time = array("d", (time.monotonic(),))
+        self.ingest_view[slot:slot + first] = ingest_time * first
+        self.ingest_view[:n - first] = ingest_time * (n - first)
+        # publish the records to the consumer
+        self.head = head + n
+        if self.head - self.tail > self.high_water:
+            self.high_water = self.head - self.tail
+        self.ready.set()
+        return True
+
+    def get_records(self, max_n, timeout=None):
+        """
+        Returns a memoryview of up to max_n contiguous records
+
+        Releases the records returned by the previous call. Returns an empty
+        view on timeout and None if closed and empty
+        """
+        # release the records from the last call
+        if self.pending:
+            self.tail = self.tail + self.pending
+            self.pending = 0
+            self.released.set()
+
+        if self.head == self.tail:
+            if self.closed:
+                return None
+            # clear then check again, so a put in between is not missed
+            self.ready.clear()
+            if self.head == self.tail:
+                self.ready.wait(timeout)
+            if self.head == self.tail:
+                return None if self.closed else self.view[0:0]
+
+        slot = self.tail % self.maxsize
+        # records up to end of ring, wrapped records come on next call
+        n = min(max_n, self.head - self.tail, self.maxsize - slot)
+        self.pending = n
+        start = slot * self.record_size
+        return self.view[start:start + n * self.record_size]
+
+    def ingest_times(self):
+        """
+        Returns a view of the time.monotonic each record returned by the last
+        get_records was added, valid until the next call to get
+        """
+        slot = self.tail % self.maxsize
+        return self.ingest_view[slot:slot + self.pending]
+
+    def get_many(self, max_n, timeout=None):
+        """
+        Returns list of up to max_n frames, as :class:`BoundedQueue`
+
+        The frame data is a view into the ring slot, valid until next get
+        """
+        records = self.get_records(max_n, timeout)
+        if records is None:
+            return None
+        size = self.record_size
+        ingest = self.ingest_times()
+        return [Frame(id=id, data=records[i*size + 16:i*size + 16 + dlc],
+                      timestamp=timestamp, dlc=dlc, ingest_time=ingest[i])
+                for i, (timestamp, id, dlc, data)
+                in enumerate(FRAME_RECORD.iter_unpack(records))]
+
+    def get(self, timeout=None):
+        """
+        Returns the next frame, None if closed and empty or on timeout
+        """
+        frames = self.get_many(1, timeout)
+        if frames:
+            return frames[0]
+        return None
+
+    def close(self):
+        """
+        Marks the end of frames, waking any waiting consumer
+        """
+        self.closed = True
+        self.ready.set()
+
+    def clear(self):
+        """
+        Empties the ring and reopens it if closed
+
+        Must not be called while frames are being added or read
+        """
+        self.head = 0
+        self.tail = 0
+        self.pending = 0
+        self.closed = False
+        self.ready.clear()
+
+    def qsize(self):
+        return self.head - self.tail
+
+    def full(self):
+        return self.head - self.tail >= self.maxsize
+
+    def empty(self):
+        return self.head == self.tail
 
 
 class Frame:
     """
     Class to hold frame information
+
+    Uses slots to keep each frame small. The data is stored as given, so it
+    can be a memoryview of a driver buffer or ring slot rather than a copy.
+    With no data, each frame gets its own writable 8 zero bytes, so it can
+    be filled in place
+
+    ingest_time is the time.monotonic the frame was queued by the device
     """
 
+    __slots__ = ("id", "data", "timestamp", "dlc", "error", "ingest_time")
+
     def __init__(self, id=0, data=None,
-                 timestamp=0, dlc=8, error=False):
+                 timestamp=0, dlc=8, error=False, ingest_time=None):
         self.id = id
         if data is None:
-            self.data = bytearray((0, 0, 0, 0, 0, 0, 0, 0))
+            self.data = bytearray(8)
         else:
             self.data = data
         self.timestamp = timestamp
         self.dlc = dlc
         self.error = error
+        self.ingest_time = ingest_time
 
     def __str__(self):
         """
         Override the str function
         """
-        return "ID: {}, Data: {}, Timestamp: {}".format(self.id, self.data, self.timestamp)
+        return "ID: {}, Data: {}, Timestamp: {}".format(
+            self.id, bytes(self.data), self.timestamp)
 
 
 class PDOConverter:
@@ -240,69 +953,116 @@ class PDOConverter:
 
     Requires an active :class:`can.Device` and Format instance to take raw
     frames and convert them into data
+    If block_size is given, timesteps are collected into blocks of that many
+    timesteps and decoded in one pass by :class:`BlockDecoder`. The data queue
+    then holds :class:`datalog.DataBlock` items instead of datapoint lists
+
+    The format can be a :class:`MultiNodeFormat`, frames of each node are
+    then assembled into timesteps by their own :class:`TimestepAssembler`,
+    all from the one read thread
+
     :param device:
     :type device: :class:`can.Device`
+    :param block_size: Number of timesteps per decoded block, None to decode
+        every frame as it arrives
+    :type block_size: :class:`Int`
+    :param overflow_policy: What to do when the data queue is full,
+        defaults to stopping the device and converter. Dropped timestep
+        indices are recorded in dropped_indices
+    :type overflow_policy: :class:`OverflowPolicy`
+    :param queue_size: Maximum number of items in the data queue
+    :type queue_size: :class:`Int`
+    :param resync: If True, recover from out of order frames by waiting for
+        the start of the next timestep, instead of raising
+        :class:`FrameOrderError`
+    :type resync: :class:`Bool`
     """
 
-    def __init__(self, device, format, check_loop_time=10):
+    def __init__(self, device, format, check_loop_time=10, block_size=None,
+                 overflow_policy=None, queue_size=1000, resync=False):
         self.device = device
         self.format = format
         self.check_loop_time = check_loop_time
 
+        # number of timesteps in each block, None for frame by frame
+        self.block_size = block_size
+
+        # assembler of each node, created on start once format is complete
+        self.assemblers = {}
+        # lookup of frame id to the assembler of its node
+        self.dispatch = {}
+
         # thread for pulling frames from device
         self.read_thread = threading.Thread(target=self._read_loop)
+        # maximum number of frames to fetch from device at once
+        self.read_size = 1000
         # event to control deactiviation of thread
         self.read_active = threading.Event()
 
-        # state of conversion
-        # Initiated = before starting
-        # Starting = read messages, waiting for first
-        # Running = reading messages, normal running
-        self.state = "Initiated"
-
-        # index of previous frame id recieved
-        self.prev_frame_ind = 0
+        # if True, frame order errors discard the timestep and resync on the
+        # next first frame rather than raising FrameOrderError
+        self.resync = resync
 
         # how many messages to read before entering running mode
-        # this is required because kvaser doesnt seem to clear buffer well
-        self.pre_msg_count = 1000
+        # only needed for devices without a start_timestamp, as stale frames
+        # are otherwise found by their timestamps
+        self.pre_msg_count = 0
+        # frames read of ids not in the format
+        self.unused_count = 0
+        # time start was called, for time to first timestep
+        self.start_time = None
+
+        # queue with each item a timestep (or block of timesteps)
+        self.data_queue = BoundedQueue(maxsize=queue_size,
+                                       policy=overflow_policy,
+                                       on_drop=self._record_dropped)
+        # total timesteps dropped from data queue
+        self.dropped_count = 0
+        # (first index, count) of each run of dropped timesteps
+        self.dropped_indices = deque(maxlen=1000)
 
-        # total messages recieved in running mode
-        self.frame_count = 0
-
-        # list of datapoints at current timestep
-        self.datapoints = []
-
-        # queue with each item a list of datapoints at a particular timestep
-        self.data_queue = queue.Queue(maxsize=1000)
-
-        # current index of datapoint timestep
-        self.data_count = 0
         self.check_data_count = 0
+        # approx rates of frames used and timesteps assembled
+        self.frame_rate = 0
+        self.data_rate = 0
 
         # marks the pdo converter as active 
         self.active = threading.Event()
-        # thread to stop the device internally
-        self.stop_thread = threading.Thread(target=self.stop_check)
-        self.stop_trigger = threading.Event()
+        # seconds the last call to stop took
+        self.stop_time = None
 
-        # check loop
-        self.check_thread = threading.Thread(target=self._check_loop)
+        # scheduled task for checking stats
+        self.check_task = None
         self.check_time = None
         self.check_frame_count = 0
-        self.frame_start_time = None
 
     def start(self):
         """
         Starts the CAN hardware device and a thread to read the frames
         """
         logger.info("Starting PDO Converter")
+        self.start_time = time.time()
+        # make sure decode plan matches any changes made to the format
+        self.format.compile()
         self.active.set()
-        self.read_thread.start()
-        self.stop_thread.start()
-        self.check_thread.start()
+        # device drops other frames where it can, the rest are unused here
+        self.device.set_id_filter(self.format.dispatch)
+        # device is started first so its start timestamp is known, frames
+        # wait in its queue until the read thread starts
         self.device.start()
-        self.state = "Starting"
+        # one assembler per node, shared by all of its frame ids
+        for id, (node, format) in self.format.dispatch.items():
+            if node not in self.assemblers:
+                self.assemblers[node] = TimestepAssembler(
+                    format, self.data_queue, block_size=self.block_size,
+                    resync=self.resync,
+                    timestamp_resolution=self.device.timestamp_resolution,
+                    start_timestamp=self.device.start_timestamp)
+            self.dispatch[id] = self.assemblers[node]
+        self.read_thread.start()
+        self._register_metrics()
+        self.check_task = scheduler.call_every(self.check_loop_time,
+                                               self._check)
         logger.info("Started PDO Converter")
 
     def stop(self):
@@ -315,10 +1075,12 @@ class PDOConverter:
         
         if self.active.is_set():
             logger.debug("Stopping PDO Converter")
+            start_time = time.monotonic()
             # Pop None on the queue to indicate to consumer that stop is called
             self.active.clear()
-            self.stop_trigger.set()
-            self.data_queue.put(None)
+            if self.check_task is not None:
+                self.check_task.cancel()
+            self.data_queue.close()
 
             # Call for underlying device to stop and wait for thread to end
             self.device.stop()
@@ -328,24 +1090,100 @@ class PDOConverter:
                 if self.read_thread.is_alive():
                     # error ending thread, do something
                     raise ThreadCloseError("PDO Converter read thread not closing")
-            logger.info("Stopped PDO Converter")
+            self.stop_time = time.monotonic() - start_time
+            logger.info("Stopped PDO Converter in {:.3f}s".format(
+                self.stop_time))
 
-    def stop_check(self):
+    def _trigger_stop(self):
         """
-        Waits for the command to stop, and calls stop, for internal threads
+        Stops the converter from a thread of its own
+
+        For the read thread, which cannot stop the converter itself as stop
+        waits for it to end. Not done in the scheduler thread, as the waits
+        would hold up the other scheduled tasks
         """
-        # wait for the stop trigger
-        self.stop_trigger.wait()
-        # check if device is still active
-        if self.active.is_set():
-            self.stop()
+        threading.Thread(target=self.stop).start()
 
     def get_datapoints(self):
         """
-        Returns the next list of datapoints, None if device has stopped
+        Returns the next :class:`datalog.Timestep`, None if device has stopped
+
+        In block mode a :class:`datalog.DataBlock` is returned instead
+        """
+
+        return self.data_queue.get()
+
+    @property
+    def data_count(self):
+        """
+        Total timesteps assembled, over all nodes
+        """
+        return sum(a.data_count for a in self.assemblers.values())
+
+    @property
+    def frame_count(self):
+        """
+        Total frames used in timesteps, over all nodes
+        """
+        return sum(a.frame_count for a in self.assemblers.values())
+
+    @property
+    def resync_count(self):
+        """
+        Total number of resyncs, over all nodes
+        """
+        return sum(a.resync_count for a in self.assemblers.values())
+
+    @property
+    def missing_count(self):
+        """
+        Total timesteps missed because of resyncs, over all nodes
+        """
+        return sum(a.missing_count for a in self.assemblers.values())
+
+    @property
+    def stale_count(self):
+        """
+        Total frames discarded for being from before the device started
+        """
+        return sum(a.stale_count for a in self.assemblers.values())
+
+    @property
+    def startup_time(self):
+        """
+        Seconds from start to the first complete timestep, None before then
+        """
+        times = [a.first_timestep_time for a in self.assemblers.values()
+                 if a.first_timestep_time is not None]
+        if not times or self.start_time is None:
+            return None
+        return min(times) - self.start_time
+
+    @property
+    def frame_start_time(self):
         """
+        Time the first frame of any node was used, None before then
+        """
+        times = [a.frame_start_time for a in self.assemblers.values()
+                 if a.frame_start_time is not None]
+        return min(times) if times else None
 
-        return self.data_queue.get(True)
+    def _record_dropped(self, items):
+        """
+        Called by data queue with timesteps or blocks dropped on overflow
+        """
+        for item in items:
+            if isinstance(item, DataBlock):
+                first, count = int(item.index[0]), len(item)
+            else:
+                first, count = item.index, 1
+            self.dropped_count = self.dropped_count + count
+            # extend the last run if this follows on from it
+            if self.dropped_indices and sum(self.dropped_indices[-1]) == first:
+                last_first, last_count = self.dropped_indices.pop()
+                self.dropped_indices.append((last_first, last_count + count))
+            else:
+                self.dropped_indices.append((first, count))
 
     def _read_loop(self):
         """
@@ -355,20 +1193,46 @@ class PDOConverter:
         # set the thread flag
         self.read_active.set()
 
+        # ring buffer records can be processed in place without frames
+        if isinstance(self.device.frame_queue, FrameRing):
+            get_frames = self.device.frame_queue.get_records
+            process_frames = self._process_records
+        else:
+            get_frames = self.device.get_frames
+            process_frames = self._process_frames
+
         # start loop to get and process messages
         while(self.read_active.is_set()):
-            # get frame from device
-            frame = self.device.get_frame()
+            # get all available frames from device, up to read_size
+            frames = get_frames(self.read_size)
 
             # if None, device is disabled, end read thread
-            if (frame is None):
+            if (frames is None):
                 logger.info("PDO converter: Device has stopped")
-                self.stop_trigger.set()
+                # pass on any part filled blocks
+                for assembler in self.assemblers.values():
+                    assembler.flush()
+                self._trigger_stop()
+                break
+
+            if not process_frames(frames):
+                # Exit loop if it was unable to place a frame on the queue
                 break
 
+        self.read_active.clear()
+
+    def _process_frames(self, frames):
+        """
+        Filters a burst of frames and passes those of interest to processor
+
+        Returns False if processing should stop
+        """
+        dispatch = self.dispatch
+        for frame in frames:
             # check if frame is of interest
-            if frame.id not in self.format.order:
-                logger.debug("Frame {} not used".format(frame))
+            assembler = dispatch.get(frame.id)
+            if assembler is None:
+                self.unused_count = self.unused_count + 1
                 continue
 
             # if still in starting mode
@@ -376,136 +1240,469 @@ class PDOConverter:
                 self.pre_msg_count = self.pre_msg_count - 1
                 continue
 
-            # pass the frame to processor
-            if not self._process_frame(frame):
-                # Exit loop if it was unable to place a frame on the queue
-                break
+            # pass the frame to the assembler of its node
+            if not assembler.process_frame(frame.id, frame.data,
+                                           frame.timestamp,
+                                           frame.ingest_time):
+                return self._queue_full()
+        return True
 
-        self.read_active.clear()
+    def _process_records(self, records):
+        """
+        Filters a view of ring buffer records and processes those of interest
 
-    def _process_frame(self, frame):
+        Frame fields are unpacked straight from the records, no
+        :class:`Frame` objects are created. Returns False if processing
+        should stop
         """
-        Takes a frame and uses format to convert to signals
+        dispatch = self.dispatch
+        ingest = self.device.frame_queue.ingest_times()
+        for (timestamp, id, dlc, data), ingest_time in zip(
+                FRAME_RECORD.iter_unpack(records), ingest):
+            # check if frame is of interest
+            assembler = dispatch.get(id)
+            if assembler is None:
+                self.unused_count = self.unused_count + 1
+                continue
+
+            # if still in starting mode
+            if (self.pre_msg_count):
+                self.pre_msg_count = self.pre_msg_count - 1
+                continue
+
+            if not assembler.process_frame(id, data[:dlc], timestamp,
+                                           ingest_time):
+                return self._queue_full()
+        return True
+
+    def _queue_full(self):
         """
+        Stops the device and converter when the data queue overflows
 
-        # check if still waiting for initial message
-        if (self.state == "Starting" and frame.id == self.format.order[0]):
-            # have recieved first message in sequence
-            self.state = "Running"
+        Returns False so the read loop ends
+        """
+        logger.error("PDO conveter queue full")
+        # stop the device from reading can frames
+        self.device.stop()
+        # stop the pdo converter
+        self._trigger_stop()
+        return False
+
+    def _check(self):
+        """
+        Prints debug info at slow rate, run by the scheduler
+        """
+        # if this is not the first run
+        if self.check_time is not None and self.frame_start_time is not None:
+            # calc frame rate
+            frame_count = self.frame_count - self.check_frame_count
+            data_count = self.data_count - self.check_data_count
+            elapsed_time = time.time() - self.check_time
+            self.frame_rate = round(frame_count / elapsed_time)
+            self.data_rate = round(data_count / elapsed_time)
+            total_frame_rate = round(
+                self.frame_count / (time.time() - self.frame_start_time))
+
+            logger.debug("PDO Frame Rate: {}, Data Rate: {}, Queue: {}, "
+                         "Dropped: {}, Startup: {:.3f}s, Stale: {}".
+                         format(total_frame_rate, self.data_rate,
+                                self.data_queue.qsize(),
+                                self.dropped_count,
+                                self.startup_time or 0,
+                                self.stale_count))
+
+        # record this check time and frame count for next run
+        self.check_time = time.time()
+        self.check_frame_count = self.frame_count
+        self.check_data_count = self.data_count
+
+    def _register_metrics(self):
+        """
+        Adds the converter and per node assembler stats to the
+        :data:`metrics.registry`, read on export
+        """
+        registry.gauge("canpdo_timestep_rate",
+                       "Timesteps per second at the last check",
+                       fn=lambda: self.data_rate)
+        registry.gauge("canpdo_data_queue_size",
+                       "Items waiting in the pdo converter data queue",
+                       fn=lambda: self.data_queue.qsize())
+        registry.gauge("canpdo_data_queue_high_water",
+                       "Most items held in the pdo converter data queue",
+                       fn=lambda: self.data_queue.high_water)
+        registry.counter("canpdo_timesteps_dropped_total",
+                         "Timesteps dropped by the data queue overflow policy",
+                         fn=lambda: self.dropped_count)
+        registry.counter("canpdo_frames_unused_total",
+                         "Frames of ids not in the format, filtered in the "
+                         "pdo converter", fn=lambda: self.unused_count)
+        for node, assembler in self.assemblers.items():
+            labels = {"node": node}
+            registry.counter("canpdo_timesteps_total",
+                             "Timesteps assembled from frames", labels,
+                             fn=lambda a=assembler: a.data_count)
+            registry.counter("canpdo_frames_total",
+                             "Frames used in timesteps", labels,
+                             fn=lambda a=assembler: a.frame_count)
+            registry.counter("canpdo_resyncs_total",
+                             "Resyncs after out of order frames", labels,
+                             fn=lambda a=assembler: a.resync_count)
+            registry.counter("canpdo_timesteps_missing_total",
+                             "Timesteps lost to resyncs", labels,
+                             fn=lambda a=assembler: a.missing_count)
+
+
+class TimestepAssembler:
+    """
+    Assembles the PDO frames of one node into timesteps
+
+    Frames are checked against format.order and their data collected until
+    the last frame of the timestep, which is then decoded and placed on the
+    data queue. :class:`PDOConverter` creates one for each node of the
+    format and passes each frame to the assembler of its node
+
+    :param format: PDO format of the node
+    :type format: :class:`Format`
+    :param data_queue: Queue the timesteps (or blocks) are placed on
+    :type data_queue: :class:`BoundedQueue`
+    :param block_size: Number of timesteps per decoded block, None to decode
+        every timestep as it completes
+    :type block_size: :class:`Int`
+    :param resync: If True, recover from out of order frames by waiting for
+        the start of the next timestep, instead of raising
+        :class:`FrameOrderError`
+    :type resync: :class:`Bool`
+    :param timestamp_resolution: Seconds per unit of frame timestamp
+    :type timestamp_resolution: :class:`Float`
+    :param start_timestamp: Timestamp the device went bus on, the first
+        timestep starts with a frame at or after it. None to start on the
+        first frame
+    :type start_timestamp: :class:`Float`
+    """
+
+    def __init__(self, format, data_queue, block_size=None, resync=False,
+                 timestamp_resolution=1, start_timestamp=None):
+        self.format = format
+        self.node = format.node
+        self.data_queue = data_queue
+        self.resync = resync
+        self.timestamp_resolution = timestamp_resolution
+        self.start_timestamp = start_timestamp
+
+        # state of assembly
+        # Starting = waiting for first frame in order
+        # Running = normal running
+        # Resync = frame order lost, waiting for first frame in order
+        self.state = "Starting"
+
+        # index of previous frame id recieved
+        self.prev_frame_ind = 0
+
+        # raw data of the frames in the current timestep
+        self.timestep_buffer = bytearray(format.timestep_size)
+
+        # number of timesteps in each block, None for frame by frame
+        self.block_size = block_size
+        self.block_decoder = None
+        if block_size is not None:
+            self.block_decoder = BlockDecoder(format)
+        # raw frame data, timestamps and ingest times of the block being
+        # collected
+        self.block_buffer = bytearray()
+        self.block_timestamps = []
+        self.block_ingest_times = []
+
+        # timestamp of first frame in current and last complete timestep
+        self.timestep_timestamp = None
+        self.last_timestep_timestamp = None
+        # number of resyncs and total timesteps missed because of them
+        self.resync_count = 0
+        self.missing_count = 0
+        # (index resumed at, timesteps missing) for each resync
+        self.resync_events = deque(maxlen=1000)
+
+        # current index of timestep
+        self.data_count = 0
+        # total frames used in running mode and time the first arrived
+        self.frame_count = 0
+        self.frame_start_time = None
+        # frames discarded for being older than start_timestamp
+        self.stale_count = 0
+        # time the first timestep was completed
+        self.first_timestep_time = None
+
+    def process_frame(self, id, data, timestamp, ingest_time=None):
+        """
+        Takes the id, data and timestamp of a frame and uses format to convert
+        to signals
+
+        The ingest time of the last frame of a timestep is passed on with it,
+        for the latency to the sinks. Returns False if the data queue was full
+        """
 
-            # set prev index to last in list (so order check works)
-            self.prev_frame_ind = len(self.format.order) - 1
+        # check if still waiting for initial message
+        if self.state == "Starting":
+            if (self.start_timestamp is not None
+                    and timestamp < self.start_timestamp):
+                # left in device buffer from before start
+                self.stale_count = self.stale_count + 1
+                return True
+            if id == self.format.order[0]:
+                # have recieved first message in sequence
+                self.state = "Running"
+
+                # set prev index to last in list (so order check works)
+                self.prev_frame_ind = len(self.format.order) - 1
+
+        elif (self.state == "Resync" and id == self.format.order[0]):
+            # first message of a timestep after losing frame order
+            self._resync(timestamp)
 
         if (self.state == "Running"):
             # check frame order
-            self._check_frame_order(frame)
+            if not self._check_frame_order(id):
+                if id != self.format.order[0]:
+                    # waiting to resync, frame is not used
+                    return True
+                # out of order frame starts the next timestep
+                self._resync(timestamp)
+                self.prev_frame_ind = 0
+
+            if id == self.format.order[0]:
+                # remember when timestep started for resyncing
+                self.timestep_timestamp = timestamp
+
+            if self.block_decoder is not None:
+                # block mode, store raw data for decoding in one go
+                if not self._collect_frame(id, data, timestamp,
+                                           ingest_time):
+                    return False
 
-            # convert the frame to datpoints and add to list
-            self._extract_datapoints(frame, self.format.frame[frame.id])
+            else:
+                # copy frame data into its place in the timestep
+                offset = self.format.offset[id]
+                self.timestep_buffer[offset:offset+8] = _pad_data(data)
 
             # check if at end of timestep
-            if frame.id == self.format.order[-1]:
-                if self.data_queue.full():
-                    # queue overflow
-                    # stop the device from reading can frames
-                    logger.error("PDO conveter queue full")
-                    self.device.stop()
-                    # stop the pdo converter
-                    self.stop_trigger.set()
+            if self.block_decoder is None and (
+                    id == self.format.order[-1]):
+                # decode whole timestep and place onto queue for consumer
+                if not self.data_queue.put(Timestep(
+                        self.format.schema,
+                        self.format.decode(self.timestep_buffer),
+                        time=self.data_count/self.format.rate,
+                        timestamp=timestamp,
+                        index=self.data_count,
+                        ingest_time=ingest_time)):
                     return False
-                else:
-                    # place datapoint list onto queue for consumer
-                    self.data_queue.put(self.datapoints.copy())
-
-                # clear the list
-                self.datapoints = []
 
                 # increment counter
                 self.data_count = self.data_count + 1
+
+            if id == self.format.order[-1]:
+                self.last_timestep_timestamp = self.timestep_timestamp
+                if self.first_timestep_time is None:
+                    self.first_timestep_time = time.time()
             if self.frame_start_time is None:
                 self.frame_start_time = time.time()
             self.frame_count = self.frame_count + 1
         return True
 
-    def _check_frame_order(self, frame):
+    def flush(self):
+        """
+        Places any part filled block on the data queue
+
+        Returns False if the data queue was full
         """
-        Takes frame, checks id against format.order using prev frame index
+        if self.block_timestamps:
+            return self._put_block()
+        return True
+
+    def _collect_frame(self, id, data, timestamp, ingest_time):
+        """
+        Adds the raw frame data to the block, decoding it once full
+        """
+        self.block_buffer += _pad_data(data)
+
+        # check if at end of timestep
+        if id == self.format.order[-1]:
+            self.block_timestamps.append(timestamp)
+            self.block_ingest_times.append(ingest_time)
+            if len(self.block_timestamps) >= self.block_size:
+                return self._put_block()
+        return True
+
+    def _put_block(self):
+        """
+        Decodes the collected timesteps and places the block on the queue
+        """
+        nsteps = len(self.block_timestamps)
+        # only decode whole timesteps
+        nbytes = nsteps * self.block_decoder.timestep_size
+        block = self.block_decoder.decode(
+            self.block_buffer[:nbytes],
+            start_index=self.data_count,
+            timestamps=self.block_timestamps,
+            ingest_times=self.block_ingest_times)
+
+        del self.block_buffer[:nbytes]
+        self.block_timestamps = []
+        self.block_ingest_times = []
+        self.data_count = self.data_count + nsteps
+
+        return self.data_queue.put(block)
+
+    def _check_frame_order(self, id):
+        """
+        Takes frame id, checks it against format.order using prev frame index
+
+        Returns True if in order. If not, raises :class:`FrameOrderError`,
+        or in resync mode discards the partial timestep, enters the Resync
+        state and returns False
         """
         # calc expected index for this id
         expected_ind = self.prev_frame_ind + 1
         if(expected_ind >= len(self.format.order)):
             expected_ind = 0
 
-        if(self.format.order[expected_ind] == frame.id):
+        if(self.format.order[expected_ind] == id):
             self.prev_frame_ind = expected_ind
-            return
+            return True
+        elif self.resync:
+            logger.warning("Node {} frame order lost at index {}, "
+                           "resyncing".format(self.node, self.data_count))
+            self.state = "Resync"
+            if self.block_decoder is not None:
+                # drop the data of the partial timestep
+                del self.block_buffer[
+                    len(self.block_timestamps)
+                    * self.block_decoder.timestep_size:]
+            return False
         else:
             # error, incorrect frame order
-            # pop None on the queue as that will indicate for higher devices
+            # close the queue as that will indicate for higher devices
             # to stop
-            self.data_queue.put(None)
-            raise FrameOrderError("{},{},{}".format(frame.id,
+            self.data_queue.close()
+            raise FrameOrderError("{},{},{}".format(id,
                                                     expected_ind,
                                                     self.prev_frame_ind))
 
-    def _extract_datapoints(self, frame, frame_format):
+    def _resync(self, timestamp):
         """
-        Extracts the data from the frame according to format, adds to list
+        Restarts timesteps from a first frame, after frame order was lost
+
+        The number of timesteps since the last complete one is worked out
+        from the hardware timestamps, so the index and time of following
+        timesteps stay correct
         """
-        # go through at least 2 for single, 4 for 7Q8
-        for i in range(4):
+        # pass on complete timesteps so the block indices are contiguous
+        if self.block_decoder is not None and self.block_timestamps:
+            self._put_block()
+
+        missing = 0
+        if self.last_timestep_timestamp is not None:
+            elapsed = ((timestamp - self.last_timestep_timestamp)
+                       * self.timestamp_resolution)
+            steps = max(round(elapsed * self.format.rate), 1)
+            missing = steps - 1
+            self.data_count = self.data_count + missing
+            # re-anchor on this timestep, in case it is also left incomplete
+            self.last_timestep_timestamp = timestamp - (
+                1 / (self.format.rate * self.timestamp_resolution))
+
+        self.resync_count = self.resync_count + 1
+        self.missing_count = self.missing_count + missing
+        self.resync_events.append((self.data_count, missing))
+        logger.warning("Node {} resynced at index {}, {} timesteps "
+                       "missing".format(self.node, self.data_count, missing))
+
+        self.state = "Running"
+        self.prev_frame_ind = len(self.format.order) - 1
+
+
+class BlockDecoder:
+    """
+    Decodes many timesteps of PDO frames in a single numpy pass
+
+    A timestep is the 8 data bytes of each frame in format.order placed end
+    to end, so a block of N timesteps is one contiguous buffer. Every
+    :class:`FrameFormat` becomes a field of a structured dtype, 4 x int16 for
+    7Q8 or 2 x float32 for single, and the buffer is read with one call to
+    np.frombuffer
+
+    :param format: PDO format of the frames being decoded
+    :type format: :class:`can.Format`
+    """
 
+    def __init__(self, format):
+        if np is None:
+            raise ImportError("numpy is required for block decoding")
+
+        self.rate = format.rate
+        # number of bytes in a single timestep
+        self.timestep_size = 8 * len(format.order)
+
+        fields = []
+        # signal names in column order
+        self.schema = format.schema
+        # (field name, first column, number of values, scale) per frame
+        self.columns = []
+        col = 0
+        for id in format.order:
+            frame_format = format.frame[id]
+            field = "0x{:x}".format(id)
+            n_values = frame_format.n_values
             if frame_format.use7Q8:
-                # extract the value
-                value = f7Q8_2_num(frame.data[2*i:(2*i)+2])
+                fields.append((field, "<i2", (n_values,)))
+            else:
+                fields.append((field, "<f4", (n_values,)))
+            # singles are stored as is, no need to scale
+            scale = frame_format.scale[0]
+            if scale == 1:
+                scale = None
+            self.columns.append((field, col, n_values, scale))
+            col = col + n_values
+
+        self.dtype = np.dtype(fields)
+
+    def decode(self, buffer, start_index=0, timestamps=None,
+               ingest_times=None):
+        """
+        Decodes a buffer of whole timesteps to a :class:`datalog.DataBlock`
+
+        :param buffer: Concatenated frame data, a multiple of timestep_size
+        :type buffer: :class:`bytes`
+        :param start_index: Index of the first timestep in the buffer
+        :type start_index: :class:`Int`
+        :param timestamps: CAN timestamp of each timestep
+        :type timestamps: :class:`list`
+        :param ingest_times: time.monotonic each timestep was queued
+        :type ingest_times: :class:`list`
+        :return: Block with a (timesteps x signals) array of values
+        :rtype: :class:`datalog.DataBlock`
+        """
+        raw = np.frombuffer(buffer, dtype=self.dtype)
+        nsteps = len(raw)
 
-            elif i >= 2:
-                # out of range for single, return
-                return
+        values = np.empty((nsteps, len(self.schema)))
+        for field, col, n_values, scale in self.columns:
+            if scale is None:
+                values[:, col:col+n_values] = raw[field]
             else:
-                # extract single value
-                value = single_2_num(frame.data[4*i:(4*i)+4])
-
-            # create a new datapoint
-            datapoint = Datapoint(name=frame_format.name[i])
-
-            datapoint.value = value
-
-            # add the timestamp and time info
-            datapoint.timestamp = frame.timestamp
-            datapoint.time = self.data_count/self.format.rate
-            datapoint.index = self.data_count
-
-            # add the datapoint to the list
-            self.datapoints.append(datapoint)
-
-    def _check_loop(self):
-        """
-        Prints debug info at slow rate in its own thread
-        """
-        while(self.active.is_set()):
-            # if this is not the first run
-            if self.check_time is not None and self.frame_start_time is not None:
-                # calc frame rate
-                frame_count = self.frame_count - self.check_frame_count
-                data_count = self.data_count - self.check_data_count
-                elapsed_time = time.time() - self.check_time
-                self.frame_rate = round(frame_count / elapsed_time)
-                self.data_rate =  round(data_count / elapsed_time)
-                total_frame_rate = round(
-                    self.frame_count / (time.time() - self.frame_start_time))
-
-                logger.debug("PDO Frame Rate: {}, Data Rate: {}, Queue: {}".
-                             format(total_frame_rate, self.data_rate, self.data_queue.qsize()))
-
-            # record this check time and frame count, and wait for next loop
-            self.check_time = time.time()
-            self.check_frame_count = self.frame_count
-            self.check_data_count = self.data_count
-            for i in range(self.check_loop_time):
-                if not self.active.is_set():
-                    break
-                time.sleep(1)
+                values[:, col:col+n_values] = raw[field] * scale
+
+        index = np.arange(start_index, start_index + nsteps)
+        if timestamps is None:
+            timestamps = np.zeros(nsteps)
+        return DataBlock(
+            schema=self.schema,
+            values=values,
+            index=index,
+            time=index / self.rate,
+            timestamp=np.asarray(timestamps, dtype=float),
+            ingest_time=ingest_times,
+        )
+
 
 class Format:
     """
@@ -515,17 +1712,39 @@ class Format:
     the order in which the frames are added determines expected order
     of frames on the bus
 
+    Adding a FrameFormat compiles the decode plan: the byte offset of each
+    frame in a timestep and a single struct covering the whole timestep, so
+    a timestep is decoded with one unpack call. Call :py:func:`compile` if
+    a FrameFormat is changed after being added
+
     :param odr: Path to a tREU object dictionary to extract PDO info
     :type odr: :class:`String`
+    :param node: CANopen node id of the device sending the PDOs
+    :type node: :class:`Int`
     """
 
-    def __init__(self, odr=None, rate=1000):
+    def __init__(self, odr=None, rate=1000, node=1):
         # init list for storing order of frame ids
         self.order = []
         # init dict for storing frameFormats
         self.frame = {}
         # rate of data in Hz
         self.rate = rate
+        # node id, sets the COB-ID of PDOs read from odr
+        self.node = node
+        # added to the start of every signal name
+        self.prefix = ""
+        # lookup of frame id to (node, format), see MultiNodeFormat
+        self.dispatch = {}
+        # names of all signals in a timestep, in order
+        self.schema = Schema([])
+        # byte offset of each frame id in the timestep data
+        self.offset = {}
+        # number of bytes of frame data in a timestep
+        self.timestep_size = 0
+        # struct and scale to decode the data of a whole timestep
+        self.timestep_struct = struct.Struct("<")
+        self.scale = ()
 
         if odr is None:
             return
@@ -549,7 +1768,7 @@ class Format:
             if transtype in params:
                 if params[transtype] == "255":
                     # PDO<i> enabled, create format with correct id
-                    frame_format = FrameFormat(i*0x100 + 0x81)
+                    frame_format = FrameFormat(i*0x100 + 0x80 + node)
                     # check for 7Q8
                     if params["CAN Sys Use7q8Format PDO{}".format(i)] == "0":
                         frame_format.use7Q8 = False
@@ -569,21 +1788,137 @@ class Format:
         # add the frame format to the dict
         self.frame[frame_format.id] = frame_format
         self.order.append(frame_format.id)
+        self.compile()
+
+    def compile(self):
+        """
+        Creates the decode plan and signal names from the frame formats
+        """
+        names = []
+        fmt = "<"
+        scale = []
+        for i, id in enumerate(self.order):
+            frame_format = self.frame[id]
+            frame_format.compile()
+            # each frame takes 8 bytes, in order
+            self.offset[id] = 8*i
+            fmt = fmt + frame_format.struct.format[1:]
+            scale.extend(frame_format.scale)
+            names.extend(self.prefix + name for name in
+                         frame_format.name[:frame_format.n_values])
+
+        # only create a new schema if names have changed, so existing
+        # timesteps keep sharing it
+        if (names != self.schema.names or self.node != self.schema.node
+                or self.rate != self.schema.rate):
+            self.schema = Schema(names, self.node, self.rate)
+        self.dispatch = {id: (self.node, self) for id in self.order}
+        self.timestep_size = 8*len(self.order)
+        self.timestep_struct = struct.Struct(fmt)
+        self.scale = tuple(scale)
+
+    def __getstate__(self):
+        # structs cannot be pickled, they are rebuilt by compile
+        state = self.__dict__.copy()
+        del state["timestep_struct"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.timestep_struct = struct.Struct("<")
+        self.compile()
+
+    def decode(self, buffer):
+        """
+        Decodes the concatenated data of a timestep to an array of values
+
+        :param buffer: Frame data in format order, timestep_size bytes
+        :type buffer: :class:`bytearray`
+        :return: Value of every signal in schema order
+        :rtype: :class:`array.array`
+        """
+        return array("d", map(operator.mul,
+                              self.timestep_struct.unpack_from(buffer),
+                              self.scale))
 
 
 class DefaultFormat(Format):
     """
     Creates a :class:`Format` object with some default Frameformats
+
+    :param node: CANopen node id of the device sending the PDOs
+    :type node: :class:`Int`
     """
 
-    def __init__(self):
+    def __init__(self, node=1):
         # init parent Frame class
-        super().__init__()
+        super().__init__(node=node)
         # create the 4 frame classes and add
-        self.add(FrameFormat(0x181, use7Q8=False))
-        self.add(FrameFormat(0x281))
-        self.add(FrameFormat(0x381))
-        self.add(FrameFormat(0x481))
+        self.add(FrameFormat(0x180 + node, use7Q8=False))
+        self.add(FrameFormat(0x280 + node))
+        self.add(FrameFormat(0x380 + node))
+        self.add(FrameFormat(0x480 + node))
+
+
+class MultiNodeFormat:
+    """
+    Combines the PDO formats of several CANopen nodes on one bus
+
+    Each node keeps its own :class:`Format`, so timesteps of every node are
+    assembled separately and reach the consumer as their own stream, with
+    the node id in :attr:`datalog.Schema.node`. dispatch maps every frame
+    id on the bus to its (node, format) for a single lookup per frame
+
+    :param odr: Path of the object dictionary of each node, keyed by node id
+    :type odr: :class:`dict`
+    :param rate: Rate of data in Hz, if not given in an odr
+    :type rate: :class:`Float`
+    :param prefix: Added to the start of signal names, {} is replaced by the
+        node id. None to leave names as they are
+    :type prefix: :class:`String`
+    """
+
+    def __init__(self, odr=None, rate=1000, prefix="N{} "):
+        # format of each node, keyed by node id
+        self.node = {}
+        # lookup of frame id to (node, format)
+        self.dispatch = {}
+        self.rate = rate
+        self.prefix = prefix
+
+        if odr is None:
+            return
+        for node, path in odr.items():
+            self.add(Format(odr=path, rate=rate, node=node))
+
+    def add(self, format):
+        """
+        Adds the format of another node on the bus
+
+        :param format: PDO format of the node, with node set
+        :type format: :class:`Format`
+        """
+        if format.node in self.node:
+            raise ValueError("Node {} already added".format(format.node))
+        format.compile()
+        for id in format.order:
+            if id in self.dispatch:
+                raise ValueError("Frame id 0x{:x} of node {} used by node "
+                                 "{}".format(id, format.node,
+                                             self.dispatch[id][0]))
+        if self.prefix is not None:
+            format.prefix = self.prefix.format(format.node)
+        self.node[format.node] = format
+        self.compile()
+
+    def compile(self):
+        """
+        Compiles the format of every node and rebuilds the dispatch table
+        """
+        self.dispatch = {}
+        for format in self.node.values():
+            format.compile()
+            self.dispatch.update(format.dispatch)
 
 
 class FrameFormat:
@@ -603,6 +1938,102 @@ class FrameFormat:
             self.name = [str(id) + '_' + str(x) for x in range(4)]
         else:
             self.name = name
+        self.compile()
+
+    def compile(self):
+        """
+        Sets the struct and scale used to decode the frame data
+        """
+        if self.use7Q8:
+            # 4 values, int16 divided by 256
+            self.n_values = 4
+            self.struct = struct.Struct("<4h")
+            self.scale = (1/256.0,) * 4
+        else:
+            # 2 values, single float
+            self.n_values = 2
+            self.struct = struct.Struct("<2f")
+            self.scale = (1.0,) * 2
+
+    def __getstate__(self):
+        # structs cannot be pickled, they are rebuilt by compile
+        state = self.__dict__.copy()
+        del state["struct"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    def decode(self, data):
+        """
+        Returns list of the values in the 8 bytes of frame data
+        """
+        return list(map(operator.mul, self.struct.unpack_from(data),
+                        self.scale))
+
+
+def acceptance_filters(ids, max_filters=1):
+    """
+    Works out code/mask acceptance filters letting through the frame ids
+
+    A frame is accepted by a filter if id & mask == code. Starting with a
+    filter for each id, the two filters whose merge lets through the
+    fewest ids are merged until there are at most max_filters. The filters
+    are exact if they let through no other ids, otherwise the frames of
+    the other ids must also be filtered in software
+
+    :param ids: 11 bit frame ids to accept
+    :type ids: :class:`list`
+    :param max_filters: Most filters the hardware supports
+    :type max_filters: :class:`Int`
+    :return: List of (code, mask) filters and if they are exact. No
+        filters if an id is over 11 bits
+    :rtype: :class:`tuple`
+    """
+    ids = sorted(set(ids))
+    if not ids or ids[-1] > _STD_ID_MASK:
+        return [], False
+    filters = [(id, _STD_ID_MASK) for id in ids]
+    while len(filters) > max_filters:
+        best = None
+        for i in range(len(filters)):
+            for j in range(i + 1, len(filters)):
+                merged = _merge_filters(filters[i], filters[j])
+                # ids let through by the merged filter
+                size = 1 << (11 - bin(merged[1]).count("1"))
+                if best is None or size < best[0]:
+                    best = (size, i, j, merged)
+        size, i, j, merged = best
+        filters = [f for k, f in enumerate(filters) if k not in (i, j)]
+        filters.append(merged)
+    accepted = sum(1 for id in range(_STD_ID_MASK + 1)
+                   if any(id & mask == code for code, mask in filters))
+    return filters, accepted == len(ids)
+
+
+def _merge_filters(a, b):
+    """
+    Returns the code/mask filter letting through the ids of filters a and b
+    """
+    code_a, mask_a = a
+    code_b, mask_b = b
+    # bits both filters check and agree on
+    mask = mask_a & mask_b & ~(code_a ^ code_b) & _STD_ID_MASK
+    return code_a & mask, mask
+
+
+# all bits of a standard 11 bit frame id
+_STD_ID_MASK = 0x7FF
+
+
+def _pad_data(data):
+    """
+    Returns the 8 bytes of frame data, padding short frames with zeros
+    """
+    if len(data) != 8:
+        data = bytes(data[:8]).ljust(8, b"\x00")
+    return data
 
 
 def num_2_f7Q8(num):
@@ -652,8 +2083,4 @@ class ThreadCloseError(Exception):
         super().__init__(msg)
 
 
-class FrameQueueOverflowError(Exception):
-    pass
-
-
 logger = logging.getLogger(__name__)
@@ -1,13 +1,24 @@
 import threading
 import queue
 from abc import ABC, abstractmethod
+from array import array
 from enum import Enum
+from canPDOMonitor.metrics import registry
+from time import monotonic
 import logging
 
 
 class DataLogger:
     """
-    Writes datapoints to file
+    Writes timesteps to file
+
+    Writes CSV text. The file format is set by the _write_header,
+    _write_timestep and _close methods, which child classes override to
+    write other formats with the same start and end conditions
+
+    Every timestep must have the signals of the first one logged, logging
+    ends with an error if they change, such as when given the timesteps of
+    another node
 
     :param filename: Name of file to write to, relative or absolute path
     :type filename: :class:`String`
@@ -21,11 +32,14 @@ class DataLogger:
     :type start_at_zero:
     """
 
+    # mode the file is opened in
+    file_mode = "w"
+
     def __init__(self, filename, start_condition=None, end_condition=None,
                  start_at_zero=True, mode=None):
         # open file used to log data
         self.filename = filename
-        self.file = open(filename, 'w')
+        self.file = open(filename, self.file_mode)
 
         # Start and Stop conditions
         self.start_condition = start_condition
@@ -35,7 +49,7 @@ class DataLogger:
         self.time_offset = 0
         self.start_at_zero = start_at_zero
 
-        # queue of lists of datapoints to write to file
+        # queue of timesteps to write to file
         self.data_queue = queue.Queue()
 
         # thread to run file write
@@ -49,6 +63,12 @@ class DataLogger:
 
         # list of strings written as the file header
         self.header = []
+        # schema of the timesteps logged, from the first. Timesteps with
+        # other signals end logging
+        self.schema = None
+
+        # total characters written to file, one byte each as csv is ascii
+        self.bytes_written = 0
 
     def start(self):
         """
@@ -58,6 +78,18 @@ class DataLogger:
         data in file or wait until trigger to do so
         """
         logger.info("{} datalog started".format(self.filename))
+        labels = {"file": self.filename}
+        registry.counter("canpdo_datalogger_bytes_total",
+                         "Bytes written by the datalogger", labels,
+                         fn=lambda: self.bytes_written)
+        registry.gauge("canpdo_datalogger_queue_size",
+                       "Timesteps waiting to be written", labels,
+                       fn=self.data_queue.qsize)
+        # observed by the write thread only
+        self.latency = registry.summary(
+            "canpdo_sink_latency_seconds",
+            "Seconds from the device queueing a timestep to a sink using it",
+            {"sink": "datalogger", "name": self.filename})
         # start the thead to write the datpoints to file
         self.active.set()
         self.write_thread.start()
@@ -77,69 +109,101 @@ class DataLogger:
         if self.write_thread.is_alive():
             self.write_thread.join()
 
-    def put(self, datapoints):
+    def put(self, timestep):
         """
-        External function for placing lists of datapoints on queue
+        External function for placing timesteps on queue
 
-        Will put datapoints on queue if the logger is active
+        Will put the timestep on queue if the logger is active. A list of
+        :class:`Datapoint` is also accepted and converted to a
+        :class:`Timestep`
         """
         if self.active.is_set():
-            self.data_queue.put(datapoints)
+            self.data_queue.put(as_timestep(timestep))
 
     def _write_loop(self):
         self.active.set()
 
         while(self.active.is_set()):
-            # pull datapoints from queue
-            datapoints = self.data_queue.get()
+            # pull timestep from queue
+            timestep = self.data_queue.get()
 
             # None indicates end of logging
-            if datapoints is None:
+            if timestep is None:
                 break
 
             # check if writing to file has begun
             if not self.writing.is_set():
                 # check start condition
                 if self.start_condition is not None:
-                    # if False, go to next datapoint list in loop
-                    if not self.start_condition.check(datapoints):
+                    # if False, go to next timestep in loop
+                    if not self.start_condition.check(timestep):
                         continue
 
-                # start condition met, =need to write header to file
-                # create header with time and all signal names
-                self.header.append("Time")
-                for datapoint in datapoints:
-                    self.header.append(datapoint.name)
+                # record time_offset if neccessary
+                if self.start_at_zero:
+                    self.time_offset = timestep.time
 
                 # indicate that writing to file has begun
                 self.writing.set()
                 logger.info("Writing to {}".format(self.filename))
 
-                # write the header
-                self.file.write(self.header[0])
-                for h in self.header[1:]:
-                    self.file.write("," + h)
-
-                # record time_offset if neccessary
-                if self.start_at_zero:
-                    self.time_offset = datapoints[0].time
+                # start condition met, need to write header to file
+                self.schema = timestep.schema
+                self._write_header(timestep)
+
+            elif (timestep.schema is not self.schema
+                    and timestep.names != self.schema.names):
+                # rows would not match the header, stop with the file intact
+                logger.error("{} stopped, timestep of node {} has signals {} "
+                             "not {}".format(self.filename,
+                                             timestep.schema.node,
+                                             timestep.names,
+                                             self.schema.names))
+                break
 
-            # write all the datapoints from list
-            self.file.write("\n")
-            self.file.write("{:.4f}".format(
-                datapoints[0].time - self.time_offset))
-            for d in datapoints:
-                self.file.write("," + str(d.value))
+            self._write_timestep(timestep)
+            if timestep.ingest_time is not None:
+                self.latency.observe(monotonic() - timestep.ingest_time)
 
             # check for end condition, and exit loop if true
             if self.end_condition is not None:
-                if self.end_condition.check(datapoints):
+                if self.end_condition.check(timestep):
                     break
 
         self.active.clear()
-        self.file.close()
+        self._close()
         logger.info("Writing to {} ended".format(self.filename))
 
+    def _write_header(self, timestep):
+        """
+        Writes the file header, called with the first timestep logged
+        """
+        # create header with time and all signal names
+        self.header.append("Time")
+        self.header.extend(timestep.names)
+
+        # write the header
+        header = ",".join(self.header)
+        self.file.write(header)
+        self.bytes_written = self.bytes_written + len(header)
+
+    def _write_timestep(self, timestep):
+        """
+        Writes a timestep to file
+        """
+        # write all the values in the timestep as one line
+        line = "\n{:.4f},{}".format(
+            timestep.time - self.time_offset,
+            ",".join([str(v) for v in timestep.values]))
+        self.file.write(line)
+        self.bytes_written = self.bytes_written + len(line)
+
+    def _close(self):
+        """
+        Writes anything held back and closes the file
+        """
+        self.file.close()
+
 
 class DataLoggerGroup(DataLogger):
     """
@@ -175,19 +239,295 @@ class Datapoint:
         return "{} = {} at t = {}".format(self.name, self.value, self.time)
 
 
+class Schema:
+    """
+    Names of the signals in a stream of timesteps, in value order
+
+    Created once per :class:`can.Format` and shared by every
+    :class:`Timestep` it describes, so names are not stored per value.
+    Schemas derived by adding or renaming signals are cached so filters
+    return the same schema object on every timestep
+
+    :param names: Signal names
+    :type names: :class:`list`
+    :param node: CANopen node id the signals come from, None if unknown
+    :type node: :class:`Int`
+    :param rate: Timesteps per second, None if unknown
+    :type rate: :class:`Float`
+    """
+
+    def __init__(self, names, node=None, rate=None):
+        self.names = list(names)
+        self.node = node
+        self.rate = rate
+        # lookup of value position from signal name
+        self.index = {name: i for i, name in enumerate(self.names)}
+        # schemas derived from this one
+        self._derived = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        """
+        Returns schema with name appended to the signal names
+        """
+        key = ("add", name)
+        if key not in self._derived:
+            self._derived[key] = Schema(self.names + [name], self.node,
+                                        self.rate)
+        return self._derived[key]
+
+    def rename(self, name, new_name):
+        """
+        Returns schema with signal name replaced by new_name
+        """
+        key = ("rename", name, new_name)
+        if key not in self._derived:
+            names = self.names.copy()
+            names[self.index[name]] = new_name
+            self._derived[key] = Schema(names, self.node, self.rate)
+        return self._derived[key]
+
+
+class Timestep:
+    """
+    Values of all signals at one timestep
+
+    Replaces a list of :class:`Datapoint`, holding the time info once and
+    the values in an array ordered by the shared :class:`Schema`.
+
+    For code written against lists of datapoints, a timestep can still be
+    indexed, iterated and appended to as if it were one. The items are views
+    that read and write the values held in the timestep
+
+    :param schema: Names of the values
+    :type schema: :class:`Schema`
+    :param values: Value of each signal, in schema order
+    :type values: :class:`array.array`
+    :param time: Sequence time since start
+    :type time: :class:`Float`
+    :param timestamp: Timestamp from canbus
+    :type timestamp: :class:`Float`
+    :param index: Index of timestep since start
+    :type index: :class:`Int`
+    :param ingest_time: time.monotonic when the last frame of the timestep
+        was queued by the device, None if unknown
+    :type ingest_time: :class:`Float`
+    """
+
+    __slots__ = ("schema", "values", "time", "timestamp", "index",
+                 "ingest_time")
+
+    def __init__(self, schema, values, time=0, timestamp=0, index=0,
+                 ingest_time=None):
+        self.schema = schema
+        self.values = values
+        self.time = time
+        self.timestamp = timestamp
+        self.index = index
+        self.ingest_time = ingest_time
+
+    @property
+    def names(self):
+        return self.schema.names
+
+    def get(self, name, default=None):
+        """
+        Returns value of named signal, or default if not in timestep
+        """
+        i = self.schema.index.get(name)
+        if i is None:
+            return default
+        return self.values[i]
+
+    def set(self, name, value):
+        """
+        Sets value of the named signal
+        """
+        self.values[self.schema.index[name]] = value
+
+    def add(self, name, value):
+        """
+        Adds a new signal to the timestep
+        """
+        values = array("d", self.values)
+        values.append(value)
+        self.values = values
+        self.schema = self.schema.add(name)
+
+    def rename(self, name, new_name):
+        """
+        Renames a signal in the timestep, keeping its value
+        """
+        self.schema = self.schema.rename(name, new_name)
+
+    def to_datapoints(self):
+        """
+        Returns a new list of :class:`Datapoint` with the timestep values
+        """
+        return [Datapoint(name=name, value=value, time=self.time,
+                          timestamp=self.timestamp, index=self.index)
+                for name, value in zip(self.schema.names, self.values)]
+
+    @classmethod
+    def from_datapoints(cls, datapoints):
+        """
+        Creates a timestep from a list of :class:`Datapoint`
+        """
+        first = datapoints[0]
+        return cls(Schema([d.name for d in datapoints]),
+                   array("d", [d.value for d in datapoints]),
+                   time=first.time, timestamp=first.timestamp,
+                   index=first.index)
+
+    def append(self, datapoint):
+        """
+        Adds a :class:`Datapoint` as a new signal, as for a list
+        """
+        self.add(datapoint.name, datapoint.value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + len(self.values)
+        if not 0 <= i < len(self.values):
+            raise IndexError("Timestep index out of range")
+        return _DatapointView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self.values)):
+            yield _DatapointView(self, i)
+
+    def __str__(self):
+        return "t = {}: {}".format(self.time, ", ".join(
+            "{} = {}".format(n, v) for n, v in zip(self.names, self.values)))
+
+
+class _DatapointView:
+    """
+    Datapoint-like view of a single value in a :class:`Timestep`
+    """
+
+    __slots__ = ("_timestep", "_i")
+
+    def __init__(self, timestep, i):
+        self._timestep = timestep
+        self._i = i
+
+    @property
+    def name(self):
+        return self._timestep.schema.names[self._i]
+
+    @name.setter
+    def name(self, name):
+        self._timestep.rename(self.name, name)
+
+    @property
+    def value(self):
+        return self._timestep.values[self._i]
+
+    @value.setter
+    def value(self, value):
+        self._timestep.values[self._i] = value
+
+    @property
+    def time(self):
+        return self._timestep.time
+
+    @property
+    def timestamp(self):
+        return self._timestep.timestamp
+
+    @property
+    def index(self):
+        return self._timestep.index
+
+    def __str__(self):
+        return "{} = {} at t = {}".format(self.name, self.value, self.time)
+
+
+def as_timestep(datapoints):
+    """
+    Returns datapoints as a :class:`Timestep`, converting a list if needed
+
+    None is passed through unchanged, as it is used to mark the end of data
+    """
+    if datapoints is None or isinstance(datapoints, Timestep):
+        return datapoints
+    return Timestep.from_datapoints(datapoints)
+
+
+class DataBlock:
+    """
+    Holds a block of consecutive timesteps as arrays
+
+    Created by :class:`can.BlockDecoder`, each row of values is one timestep
+
+    :param schema: Signal names, one for each column of values
+    :type schema: :class:`Schema`
+    :param values: Array of values with shape (timesteps, signals)
+    :type values: :class:`numpy.ndarray`
+    :param index: Index of each timestep since start
+    :type index: :class:`numpy.ndarray`
+    :param time: Sequence time of each timestep
+    :type time: :class:`numpy.ndarray`
+    :param timestamp: CAN timestamp of each timestep
+    :type timestamp: :class:`numpy.ndarray`
+    :param ingest_time: time.monotonic each timestep was queued by the
+        device, None if unknown
+    :type ingest_time: :class:`list`
+    """
+
+    def __init__(self, schema, values, index, time, timestamp,
+                 ingest_time=None):
+        self.schema = schema
+        self.values = values
+        self.index = index
+        self.time = time
+        self.timestamp = timestamp
+        self.ingest_time = ingest_time
+
+    @property
+    def names(self):
+        return self.schema.names
+
+    def __len__(self):
+        return len(self.index)
+
+    def timesteps(self):
+        """
+        Generator giving a :class:`Timestep` for each row of the block
+
+        The timestep values are views of the block rows, not copies
+        """
+        time = self.time.tolist()
+        timestamp = self.timestamp.tolist()
+        index = self.index.tolist()
+        ingest_time = self.ingest_time
+        if ingest_time is None:
+            ingest_time = [None] * len(index)
+        for i in range(len(index)):
+            yield Timestep(self.schema, self.values[i], time=time[i],
+                           timestamp=timestamp[i], index=index[i],
+                           ingest_time=ingest_time[i])
+
+
 class Condition(ABC):
     """
     parent class to start and stop datalogger
 
-    Call check function with datapoint list, returns true if condition check
-    passes
+    Call check function with a :class:`Timestep`, returns true if condition
+    check passes
     """
 
     def __init__(self):
         pass
 
     @abstractmethod
-    def check(self, datapoints):
+    def check(self, timestep):
         """
         Return true if check passes, false otherwise
         """
@@ -221,53 +561,51 @@ class TriggerCondition(Condition):
         self.trigger = trigger
         self.signal_name = signal_name
         self.value = value
-        self.prev_datapoint = None
+        self.prev_value = None
         self.count = count
         self.trig_count = 0
 
-    def check(self, datapoints):
+    def check(self, timestep):
         """
-        Checks for signal edge given the new set of datapoints
+        Checks for signal edge given the new timestep
 
-        :param datapoints:
-        :type datapoints: :class:`data.Datapoint`
+        :param timestep:
+        :type timestep: :class:`Timestep`
         """
 
-        # get the datapoint of interest
+        # get the value of interest
         if self.signal_name is None:
-            # no name has been set, use first datapoint
-            datapoint = datapoints[0]
+            # no name has been set, use first signal
+            value = timestep.values[0]
         else:
-            for datapoint in datapoints:
-                if datapoint.name == self.signal_name:
-                    break
+            value = timestep.get(self.signal_name)
 
         # check if it is the first call to check
-        if self.prev_datapoint is None:
-            # remember first datapoint
-            self.prev_datapoint = datapoint
+        if self.prev_value is None:
+            # remember first value
+            self.prev_value = value
             return False
 
         # Look for a rising edge`
         if ((self.trigger == Trigger.Rising or self.trigger == Trigger.Either)
-                and self.prev_datapoint.value < self.value
-                and datapoint.value >= self.value):
+                and self.prev_value < self.value
+                and value >= self.value):
             self.trig_count = self.trig_count + 1
 
         # Look for a falling edge
         elif ((self.trigger == Trigger.Falling
                 or self.trigger == Trigger.Either)
-                and self.prev_datapoint.value > self.value
-                and datapoint.value <= self.value):
+                and self.prev_value > self.value
+                and value <= self.value):
             self.trig_count = self.trig_count + 1
 
         # check for an equal condition
         elif self.trigger == Trigger.Equal:
-            if datapoint == self.value:
+            if value == self.value:
                 self.trig_count = self.trig_count + 1
 
-        # remember datapoint
-        self.prev_datapoint = datapoint
+        # remember value
+        self.prev_value = value
         # if trigger count has matched target count
         if self.trig_count >= self.count:
             return True
@@ -275,20 +613,20 @@ class TriggerCondition(Condition):
             return False
 
     def reset(self):
-        self.prev_datapoint = None
+        self.prev_value = None
         self.trig_count = 0
 
 
 class CountCondition(Condition):
     """
-    Condtion will return true when the number of datapoints reaches count
+    Condtion will return true when the number of timesteps reaches count
     """
 
     def __init__(self, count):
         self.count = count
         self.data_count = 0
 
-    def check(self, datapoints):
+    def check(self, timestep):
         """
         Adds 1 to the data count and returns true if it equals count condition
         """
@@ -305,23 +643,23 @@ class CountCondition(Condition):
 
 class TimeCondition(Condition):
     """
-    Check returns true after datapoint time has passed
+    Check returns true after timestep time has passed
     """
 
     def __init__(self, time):
         self.time = time
         self.start_time = None
 
-    def check(self, datapoints):
+    def check(self, timestep):
         """
         Checks elasped data time between start and now
         """
         # check if this is the first check
         if self.start_time is None:
-            self.start_time = datapoints[0].time
+            self.start_time = timestep.time
 
         # check elapsed_time
-        if (datapoints[0].time - self.start_time) >= self.time:
+        if (timestep.time - self.start_time) >= self.time:
             return True
         else:
             return False
@@ -1,4 +1,6 @@
-from canPDOMonitor.can import Device, Frame
+from canPDOMonitor.can import (Device, Frame, FRAME_RECORD, _pack_record,
+                               acceptance_filters)
+from canPDOMonitor.scheduler import scheduler
 from canlib import canlib
 import threading
 import time
@@ -22,10 +24,37 @@ class Kvaser(Device):
     Class for communicating with kvaser hardware using the kvaser canlib
 
     inherits from :class:`can.Device`
+
+    The read thread blocks in canlib until a frame arrives, then reads
+    every frame waiting in the receive buffer and adds them as one burst.
+    With a ring buffer the burst is packed straight into records
+
+    The acceptance filter is worked out from the frame ids given to
+    set_id_filter, so frames of other ids are rejected by the hardware and
+    never cross USB. The hardware has one code/mask filter, if it lets
+    through other ids as well their frames are dropped before queueing.
+    Frames rejected by the hardware are found from the bus statistics
+    every STATISTICS_INTERVAL seconds, read by the scheduler as the read
+    takes about 10ms, so the read thread only counts the frames it reads
+
+    :param max_burst: Most frames read from the receive buffer at once
+    :type max_burst: :class:`Int`
     """
 
-    def __init__(self, bitrate=1000000, channel=0):
-        super().__init__(bitrate)
+    # canlib timestamps are in milliseconds
+    timestamp_resolution = 0.001
+
+    # milliseconds to wait for a frame before checking for stop
+    READ_TIMEOUT = 100
+
+    # seconds between reads of the bus statistics, for hardware_rejected
+    STATISTICS_INTERVAL = 1
+
+    def __init__(self, bitrate=1000000, channel=0, ring_buffer=False,
+                 overflow_policy=None, max_burst=4000):
+        super().__init__(bitrate, ring_buffer=ring_buffer,
+                         overflow_policy=overflow_policy)
+        self.max_burst = max_burst
         # reinit library to clearup any previous connections
         canlib.reinitializeLibrary()
 
@@ -41,8 +70,18 @@ class Kvaser(Device):
         # clear the recieve buffer
         self.ch.iocontrol.flush_rx_buffer()
 
-        # filter out heartbeats as they seem to screw up the buffer
+        # filter out heartbeats as they seem to screw up the buffer, until
+        # a filter is set from the frame ids
         self.ch.canSetAcceptanceFilter(0x080, 0x080)
+        # ids to keep of frames let through by the hardware, None for all
+        self.software_filter = None
+
+        # frames read from the hardware and on the bus since start
+        self.read_count = 0
+        self.bus_count = 0
+        # scheduled read of the bus statistics, and held while reading them
+        self.statistics_task = None
+        self.statistics_lock = threading.Lock()
 
         # thread for fetching messages form device
         self.read_thread = threading.Thread(target=self._read_loop)
@@ -60,17 +99,28 @@ class Kvaser(Device):
         # clear the buffer
         self.ch.iocontrol.flush_rx_buffer()
 
+        # frames that survive the flush are timestamped before this
+        self.start_timestamp = self.ch.readTimer()
+
         # activate the CAN device
         self.ch.busOn()
 
+        # bus statistics may count from before this start
+        self.read_count = 0
+        self.bus_count = self._bus_frames()
+
         # start the read thread
         self.reading.set()
         self.read_thread.start()
+        self.statistics_task = scheduler.call_every(
+            self.STATISTICS_INTERVAL, self._poll_statistics)
 
     def _stop(self):
         logger.debug("Stopping Kvaser")
         # clear the reading event to inidicate thread to stop
         self.reading.clear()
+        if self.statistics_task is not None:
+            self.statistics_task.cancel()
 
         # wait for thread to end, give it a second to do so
         if self.read_thread.is_alive():
@@ -79,8 +129,13 @@ class Kvaser(Device):
             # thread failed to end, something is borked
             raise KvaserError("Failed to stop read thread")
 
-        # exit the bus
-        self.ch.busOff()
+        # waits for a scheduled read of the statistics to finish
+        with self.statistics_lock:
+            self._update_statistics()
+            # exit the bus
+            self.ch.busOff()
+        logger.info("Rejected {} frames in hardware, {} in software".format(
+            self.hardware_rejected, self.software_rejected))
 
         # clear the buffer
         self.ch.iocontrol.flush_rx_buffer()
@@ -102,44 +157,116 @@ class Kvaser(Device):
 
         # check that stop hasnt been called
         while(self.reading.is_set()):
-            # Get all the messages from the device
+            # wait for and get all the messages from the device
             if not self._read_messages():
                 return
-            # wait for a length of time to let other threads run
-            # 10ms = 40 messages
-            time.sleep(0.01)
 
         # thread ends here, do any clear up as required
 
     def _read_messages(self):
         """
-        Reads all the messages from device and places them in queue
+        Waits for a message, then reads all the messages from device and
+        places them in queue
+
+        canlib wakes the read as soon as a message arrives, so there is no
+        polling. The messages in the receive buffer are then read without
+        waiting and passed to the queue together as one burst
 
         Returns
         -------
-        None.
+        False if the queue overflowed, True otherwise
 
         """
-        # print("\rQueue size: {}".format(self.ch.iocontrol.rx_buffer_level),
-        # flush=True,end="\r")
-        while(self.reading.is_set()):
+        read = self.ch.read
+        try:
+            frames = [read(timeout=self.READ_TIMEOUT)]
+        except canlib.CanNoMsg:
+            # nothing on the bus, check for stop and wait again
+            return True
+
+        # messages already waiting, read in one go
+        n = min(self.ch.iocontrol.rx_buffer_level, self.max_burst - 1)
+        try:
+            for i in range(n):
+                frames.append(read())
+        except canlib.CanNoMsg:
+            # buffer level is approximate
+            pass
+        return self._add_burst(frames)
+
+    def set_id_filter(self, ids):
+        """
+        Sets the acceptance filter to let through the frame ids
 
-            try:
-                # try get a message
-                frame = self.ch.read()
+        Ids the filter cannot tell apart from others are filtered in
+        software as well
+        """
+        super().set_id_filter(ids)
+        filters, exact = acceptance_filters(self.id_filter)
+        if filters:
+            code, mask = filters[0]
+        else:
+            # extended ids, let everything through
+            code, mask = 0, 0
+        self.ch.canSetAcceptanceFilter(code, mask)
+        self.software_filter = None if exact else self.id_filter
+        logger.info("Acceptance filter code 0x{:03x} mask 0x{:03x}{}".format(
+            code, mask, "" if exact else ", other ids filtered in software"))
+
+    def _bus_frames(self):
+        """
+        Returns the data frames on the bus counted by the bus statistics
+        """
+        statistics = self.ch.get_bus_statistics()
+        return statistics.stdData + statistics.extData
 
-                # If got a frame, convert to custom frame type and place in
-                # queue
-                if not self._add_to_queue(Frame(id=frame.id, data=frame.data,
-                                         timestamp=frame.timestamp,
-                                         dlc=frame.dlc)):
-                    return False
-                # print(type(frame.data))
+    def _update_statistics(self):
+        """
+        Works out the frames rejected by the hardware from the frames on
+        the bus and those read
+
+        Frames still in the receive buffer are counted as rejected until
+        they are read. Waits about 10ms for the statistics
+        """
+        bus_frames = self._bus_frames() - self.bus_count
+        self.hardware_rejected = max(bus_frames - self.read_count, 0)
 
-            except canlib.CanNoMsg:
-                # no more messages available
+    def _poll_statistics(self):
+        """
+        Updates hardware_rejected while reading, run by the scheduler
+        """
+        with self.statistics_lock:
+            if self.reading.is_set():
+                self._update_statistics()
+
+    def _add_burst(self, frames):
+        """
+        Adds a burst of canlib frames to the queue
+
+        The ring buffer is given them packed as records, otherwise they are
+        copied to :class:`can.Frame`, as canlib frames cannot be given
+        ingest times
+        """
+        self.read_count = self.read_count + len(frames)
+        if self.software_filter is not None:
+            wanted = self.software_filter
+            n = len(frames)
+            frames = [frame for frame in frames if frame.id in wanted]
+            self.software_rejected = self.software_rejected + n - len(frames)
+            if not frames:
                 return True
-        return False
+        if self.ring_buffer:
+            size = FRAME_RECORD.size
+            records = bytearray(len(frames) * size)
+            for i, frame in enumerate(frames):
+                _pack_record(records, i * size, frame.id, frame.dlc,
+                             frame.timestamp, frame.data)
+            return self._add_records(records)
+        error_flag = canlib.MessageFlag.ERROR_FRAME
+        return self._add_frames([
+            Frame(id=frame.id, data=frame.data, timestamp=frame.timestamp,
+                  dlc=frame.dlc, error=bool(frame.flags & error_flag))
+            for frame in frames])
 
 
 class KvaserError(Exception):
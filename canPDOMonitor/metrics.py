@@ -0,0 +1,350 @@
+"""
+Registry of pipeline metrics, with Prometheus text export
+
+Devices, converters, monitors, dataloggers, scopes and the scope server
+record counts, levels, timings and latencies in the shared
+:data:`registry`. Values are read with :py:func:`Registry.snapshot`, or
+exported in the Prometheus text format to a file or a local HTTP endpoint.
+
+Updating a metric is a plain attribute change with no lock, so each metric
+should only be updated from one thread. Values that already exist, such as
+queue sizes, are given as a function that is only called on export
+"""
+
+from canPDOMonitor.scheduler import scheduler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left
+from collections import deque
+import threading
+import logging
+import os
+import math
+
+
+class Counter:
+    """
+    Total that only increases, such as frames read or bytes written
+
+    :param fn: Called on export for the value instead of using inc
+    :type fn: :class:`callable`
+    """
+
+    type = "counter"
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, n=1):
+        self.value = self.value + n
+
+    def get(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.value
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, such as queue size or frame rate
+
+    :param fn: Called on export for the value instead of using set
+    :type fn: :class:`callable`
+    """
+
+    type = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def set_max(self, value):
+        """
+        Sets the value if it is higher, for high water marks
+        """
+        if value > self.value:
+            self.value = value
+
+
+class Histogram:
+    """
+    Counts of observed values, such as processing times, in buckets
+
+    :param buckets: Upper bounds of the buckets, in increasing order
+    :type buckets: :class:`tuple`
+    """
+
+    type = "histogram"
+
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = DEFAULT_BUCKETS
+        self.buckets = tuple(buckets)
+        # count in each bucket, last is above the highest bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def get(self):
+        """
+        Returns dict of cumulative bucket counts, sum and count
+        """
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total = total + count
+            cumulative.append(total)
+        return {"buckets": dict(zip(self.buckets + (math.inf,), cumulative)),
+                "sum": self.sum, "count": self.count}
+
+
+class Summary:
+    """
+    Rolling quantiles of the latest observed values, such as latencies
+
+    Only the last window values are kept, so the quantiles follow recent
+    behaviour. They are worked out on export, observing is an append
+
+    :param window: Number of latest values the quantiles are taken from
+    :type window: :class:`Int`
+    """
+
+    type = "summary"
+
+    # quantiles exported, 1 is the maximum
+    quantiles = (0.5, 0.99, 1)
+
+    def __init__(self, window=None):
+        if window is None:
+            window = DEFAULT_WINDOW
+        self.values = deque(maxlen=window)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def get(self):
+        """
+        Returns dict of the window quantiles, total sum and count
+
+        Quantiles are None before any values are observed
+        """
+        values = sorted(self.values)
+        n = len(values)
+        quantiles = {q: values[min(int(q * n), n - 1)] if n else None
+                     for q in self.quantiles}
+        return {"quantiles": quantiles, "sum": self.sum,
+                "count": self.count}
+
+
+class Registry:
+    """
+    Holds metrics by name and labels
+
+    The counter, gauge and histogram methods return the existing metric if
+    one with the same name and labels exists, so objects created again,
+    such as on each test run, keep adding to the same metric. A function
+    given for the value replaces any previous one
+    """
+
+    def __init__(self):
+        # name: (type, help, {labels: metric})
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.http_server = None
+
+    def counter(self, name, help="", labels=None, fn=None):
+        return self._get(Counter, name, help, labels, fn=fn)
+
+    def gauge(self, name, help="", labels=None, fn=None):
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help="", labels=None, buckets=None):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def summary(self, name, help="", labels=None, window=None):
+        return self._get(Summary, name, help, labels, window=window)
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        """
+        Returns the metric of name and labels, creating it if needed
+        """
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = (cls.type, help, {})
+            type, help, metrics = self.metrics[name]
+            if type != cls.type:
+                raise ValueError("Metric {} is a {}".format(name, type))
+            metric = metrics.get(key)
+            if metric is None:
+                metric = cls(**kwargs)
+                metrics[key] = metric
+            elif kwargs.get("fn") is not None:
+                metric.fn = kwargs["fn"]
+        return metric
+
+    def snapshot(self):
+        """
+        Returns the current value of every metric
+
+        :return: Dict of name to dict of labels to value, where the labels
+            are a tuple of (name, value) pairs. Histogram values are dicts
+        :rtype: :class:`dict`
+        """
+        with self.lock:
+            items = [(name, list(metrics.items()))
+                     for name, (type, help, metrics) in self.metrics.items()]
+        snapshot = {}
+        for name, metrics in items:
+            snapshot[name] = {key: _value(metric) for key, metric in metrics}
+        return snapshot
+
+    def to_prometheus(self):
+        """
+        Returns all the metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            items = [(name, type, help, list(metrics.items()))
+                     for name, (type, help, metrics) in self.metrics.items()]
+        lines = []
+        for name, type, help, metrics in items:
+            if help:
+                lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, type))
+            for key, metric in metrics:
+                value = _value(metric)
+                if type == "histogram":
+                    for bound, count in value["buckets"].items():
+                        le = key + (("le", _number(bound)),)
+                        lines.append("{}_bucket{} {}".format(
+                            name, _labels(le), count))
+                elif type == "summary":
+                    for q, v in value["quantiles"].items():
+                        quantile = key + (("quantile", q),)
+                        lines.append("{}{} {}".format(
+                            name, _labels(quantile), _number(v)))
+                else:
+                    lines.append("{}{} {}".format(name, _labels(key),
+                                                  _number(value)))
+                    continue
+                lines.append("{}_sum{} {}".format(name, _labels(key),
+                                                  _number(value["sum"])))
+                lines.append("{}_count{} {}".format(name, _labels(key),
+                                                    value["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, filename):
+        """
+        Writes the metrics to a Prometheus text file
+
+        The file is replaced in one go, so a collector never reads it part
+        written, as for the node exporter textfile collector
+        """
+        temp = filename + ".tmp"
+        with open(temp, "w") as file:
+            file.write(self.to_prometheus())
+        os.replace(temp, filename)
+
+    def export_file(self, filename, interval=10):
+        """
+        Writes the metrics to file every interval seconds
+
+        :return: Scheduled task, cancel to stop writing
+        :rtype: :class:`scheduler.Task`
+        """
+        return scheduler.call_every(interval,
+                                    lambda: self.write_file(filename),
+                                    delay=0)
+
+    def serve_http(self, port=9100, host="127.0.0.1"):
+        """
+        Serves the metrics over HTTP in a daemon thread
+
+        Any path returns the metrics, call stop_http to end
+
+        :return: The HTTP server
+        :rtype: :class:`http.server.ThreadingHTTPServer`
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.http_server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.http_server.serve_forever,
+                         name="Metrics HTTP", daemon=True).start()
+        logger.info("Serving metrics on http://{}:{}".format(host, port))
+        return self.http_server
+
+    def stop_http(self):
+        """
+        Stops serving the metrics over HTTP
+        """
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+
+def _value(metric):
+    """
+    Returns the value of a metric, None if its function fails
+    """
+    try:
+        return metric.get()
+    except Exception:
+        logger.exception("Failed to get metric value")
+        return None
+
+
+def _labels(key):
+    """
+    Returns the Prometheus label string of a labels key
+    """
+    if not key:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in key) + "}"
+
+
+def _number(value):
+    """
+    Returns a value formatted as a Prometheus number
+    """
+    if value is None:
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# default histogram buckets for processing times in seconds
+DEFAULT_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01,
+                   0.05, 0.1, 0.5, 1)
+
+# default number of latest values summary quantiles are taken from
+DEFAULT_WINDOW = 1000
+
+# the registry shared by everything in the process
+registry = Registry()
+
+logger = logging.getLogger(__name__)
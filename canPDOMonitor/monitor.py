@@ -1,14 +1,16 @@
 """
 Main classes for running the canPDOMonitor
 
-Monitor routes datapoints from a pdo_converter to attached dataloggers,
+Monitor routes timesteps from a pdo_converter to attached dataloggers,
 managing the stopping and starting of each.  Can use a CAN_SYS_PDO.order
 object dictionary to choose PDO format
 """
 
-from canPDOMonitor.can import PDOConverter, DefaultFormat
+from canPDOMonitor.can import PDOConverter, DefaultFormat, MultiNodeFormat
 from canPDOMonitor.virtual import Virtual
-from canPDOMonitor.datalog import Datapoint
+from canPDOMonitor.datalog import DataBlock, as_timestep
+from canPDOMonitor.scheduler import scheduler
+from canPDOMonitor.metrics import registry
 from abc import ABC, abstractmethod
 import threading
 import time
@@ -17,12 +19,17 @@ import logging
 
 class Monitor:
     """
-    Routes datapoints from the pdo_converter to any attached dataloggers
+    Routes timesteps from the pdo_converter to any attached dataloggers
 
     Typical usage: Optionally include a Device, leave format and pdo_converter
     blank.  Format will then include the PDO specifications from the
     CAN_SYS_PDO.odr file in the current directory
 
+    With a :class:`can.MultiNodeFormat`, dataloggers and scope windows can
+    be given a node to only receive the timesteps of that node. With more
+    than one node, each datalogger must be given its node, as a file holds
+    the signals of one node
+
     :param device: Defaults to :class:`virtual.Virtual`, with its defaults
     :type device: :class:`can.Device`
     :param format: Defaults to object dict in local directory, then class
@@ -39,46 +46,74 @@ class Monitor:
             raise InvalidArgumentsError
 
         # assign the arguments to the instance
-        if device is None:
-            self.device = Virtual()
+        if pdo_converter is not None:
+            # device and format are those of the given converter
+            self.pdo_converter = pdo_converter
+            self.device = pdo_converter.device
+            self.format = pdo_converter.format
         else:
-            self.device = device
+            if device is None:
+                self.device = Virtual()
+            else:
+                self.device = device
 
-        if format is None:
-            # Look for odr in local directory
+            if format is None:
+                # Look for odr in local directory
 
-            # or use defaults
-            self.format = DefaultFormat()
-        else:
-            self.format = format
+                # or use defaults
+                self.format = DefaultFormat()
+            else:
+                self.format = format
 
-        if pdo_converter is None:
             self.pdo_converter = PDOConverter(self.device, self.format)
 
         # list of filters
         self.filters = []
         # List of dataloggers
         self.dataloggers = []
+        # node each datalogger receives, None for all
+        self.datalogger_nodes = []
         # List of scope windows
         self.scope_windows = []
+        # node each scope window receives, None for all
+        self.scope_window_nodes = []
+
+        # index of the last timestep routed of each node and total missing
+        self.prev_index = {}
+        self.missing_count = 0
+
+        # processing time histograms of each filter, datalogger and scope
+        # window, created on start
+        self.filter_histograms = []
+        self.datalogger_histograms = []
+        self.scope_window_histograms = []
 
-        # thread to pass all the datapoints around
+        # thread to pass all the timesteps around
         self.route_thread = threading.Thread(target=self._route_loop)
         # flag to indicate thread is running
         self.active = threading.Event()
 
-        # slow rate checking thread to monitor status of things
-        # ends at same time as routing loop
-        self.check_thread = threading.Thread(target=self._check_loop)
+        # slow rate scheduled check to monitor status of things
+        # cancelled at same time as routing loop ends
+        self.check_task = None
+        # thread stopping the monitor once the dataloggers are done
+        self.stop_thread = None
+        # seconds the last call to stop took
+        self.stop_time = None
 
-    def add_datalogger(self, datalogger):
+    def add_datalogger(self, datalogger, node=None):
         """
         Adds a datalogger to the monitor
 
         :param datalogger:
         :type datalogger: :class:`datalog.DataLogger`
+        :param node: Only log timesteps of this node, required if the
+            format has more than one node. None for all
+        :type node: :class:`Int`
         """
+        check_datalogger_node(self.format, node)
         self.dataloggers.append(datalogger)
+        self.datalogger_nodes.append(node)
 
     def add_filter(self, filter):
         """
@@ -86,19 +121,22 @@ class Monitor:
 
         filter is one the classes deriving from :class:`FilterType` base class
 
-        :param filter: A filter to be applied the datapoints
+        :param filter: A filter to be applied the timesteps
         :type filter: :class:`FilterType`
         """
         self.filters.append(filter)
 
-    def add_scope_window(self, scope_window):
+    def add_scope_window(self, scope_window, node=None):
         """
-        Adds a scope window for the monitor to send datapoints to
+        Adds a scope window for the monitor to send timesteps to
 
         :param scope_window:
         :type scope_window: :class: `scope.ScopeWindow`
+        :param node: Only send timesteps of this node, None for all
+        :type node: :class:`Int`
         """
         self.scope_windows.append(scope_window)
+        self.scope_window_nodes.append(node)
 
     def start(self):
         """
@@ -108,6 +146,10 @@ class Monitor:
         """
 
         logger.info("Monitor Started")
+        # nodes may have been added to the format since
+        for node in self.datalogger_nodes:
+            check_datalogger_node(self.format, node)
+
         # Start the pdo_converter
         self.pdo_converter.start()
 
@@ -119,12 +161,13 @@ class Monitor:
         for scope_window in self.scope_windows:
             scope_window.start()
 
+        self._register_metrics()
         self.active.set()
         # start the routing thread
         self.route_thread.start()
 
-        # start the check thread
-        self.check_thread.start()
+        # start the checks
+        self.check_task = scheduler.call_every(2, self._check)
 
     def stop(self):
         """
@@ -133,6 +176,10 @@ class Monitor:
         Calling this should successfully end all threads in PDOConverter,
         Device and all dataloggers
         """
+        start_time = time.monotonic()
+        if self.check_task is not None:
+            self.check_task.cancel()
+
         # stop pdo converter
         self.pdo_converter.stop()
 
@@ -144,64 +191,148 @@ class Monitor:
         self.active.clear()
         if self.route_thread.is_alive():
             self.route_thread.join()
+        self.stop_time = time.monotonic() - start_time
+        logger.info("Monitor Stopped in {:.3f}s".format(self.stop_time))
 
     def _route_loop(self):
         """
-        Continuous loop run in thread to pass datapoints around
+        Continuous loop run in thread to pass timesteps around
 
         Will stop automatically if all dataloggers are done
         """
 
         while(self.active.is_set()):
-            # get the next set of datapoints
-            datapoints = self.pdo_converter.get_datapoints()
-            if datapoints is None:
+            # get the next timestep
+            data = self.pdo_converter.get_datapoints()
+            if data is None:
                 # pdo converter has stopped
                 break
 
-            # pass the datapoints through filters
-            for filter in self.filters:
-                filter.process(datapoints)
-
-            # pass all the datapoints to the dataloggers
-            for datalogger in self.dataloggers:
-                datalogger.put(datapoints)
-
-            # pass the datapoints to the scope window
-            for scope_window in self.scope_windows:
-                scope_window.add_datapoints(datapoints)
-
-    def _check_loop(self):
-        while(self.active.is_set()):
-            dl_active = False
-            # check if all the dataloggers are still active
-            for datalogger in self.dataloggers:
-                if datalogger.active.is_set():
-                    dl_active = True
-            scope_active = False
-            if (len(self.scope_windows)):
-                scope_active = True
+            if isinstance(data, DataBlock):
+                self._check_index(data.schema.node, int(data.index[0]),
+                                  int(data.index[-1]))
+                # block mode, route each timestep of the block in turn
+                for timestep in data.timesteps():
+                    self._route(timestep)
+            else:
+                timestep = as_timestep(data)
+                self._check_index(timestep.schema.node, timestep.index,
+                                  timestep.index)
+                self._route(timestep)
+
+    def _check_index(self, node, first, last):
+        """
+        Counts timesteps missing between the previous index and first
 
+        Timesteps can be dropped by the queue overflow policies, this
+        records where. Each node has its own index
+        """
+        prev_index = self.prev_index.get(node)
+        if prev_index is not None and first != prev_index + 1:
+            missing = first - prev_index - 1
+            self.missing_count = self.missing_count + missing
+            logger.warning("Missing {} timesteps from index {}".format(
+                missing, prev_index + 1))
+        self.prev_index[node] = last
+
+    def _route(self, timestep):
+        """
+        Passes one timestep through filters and on to outputs
+        """
+        perf_counter = time.perf_counter
+        # pass the timestep through filters
+        for filter, histogram in zip(self.filters, self.filter_histograms):
+            start = perf_counter()
+            filter.process(timestep)
+            histogram.observe(perf_counter() - start)
+
+        node = timestep.schema.node
+
+        # pass the timestep to the dataloggers
+        for datalogger, dl_node, histogram in zip(
+                self.dataloggers, self.datalogger_nodes,
+                self.datalogger_histograms):
+            if dl_node is None or dl_node == node:
+                start = perf_counter()
+                datalogger.put(timestep)
+                histogram.observe(perf_counter() - start)
+
+        # pass the timestep to the scope window
+        for scope_window, sw_node, histogram in zip(
+                self.scope_windows, self.scope_window_nodes,
+                self.scope_window_histograms):
+            if sw_node is None or sw_node == node:
+                start = perf_counter()
+                scope_window.add_datapoints(timestep)
+                histogram.observe(perf_counter() - start)
+
+    def _register_metrics(self):
+        """
+        Creates the processing time histograms in the
+        :data:`metrics.registry`, each only observed by the routing thread
+        """
+        self.filter_histograms = [
+            registry.histogram("canpdo_filter_seconds",
+                               "Seconds a filter takes per timestep",
+                               {"filter": "{} {}".format(
+                                   i, type(filter).__name__)})
+            for i, filter in enumerate(self.filters)]
+        self.datalogger_histograms = [
+            registry.histogram("canpdo_consumer_seconds",
+                               "Seconds a consumer takes to accept a "
+                               "timestep",
+                               {"consumer": "datalogger",
+                                "name": datalogger.filename})
+            for datalogger in self.dataloggers]
+        self.scope_window_histograms = [
+            registry.histogram("canpdo_consumer_seconds",
+                               "Seconds a consumer takes to accept a "
+                               "timestep",
+                               {"consumer": "scope_window", "name": i})
+            for i in range(len(self.scope_windows))]
+        registry.counter("canpdo_monitor_timesteps_missing_total",
+                         "Timesteps missing from the routed indices",
+                         fn=lambda: self.missing_count)
+
+    def _check(self):
+        """
+        Stops the monitor once all dataloggers are done, run by the scheduler
 
-            if not dl_active and not scope_active:
-                logger.info("No more active dataloggers")
-                # no more dataloggers are running, stop monitor
-                self.stop()
-                return
+        Stopping joins the threads of the converter, device and dataloggers,
+        so it is done in stop_thread to not hold up other scheduled tasks
+        """
+        if not self.active.is_set():
+            return
+        dl_active = False
+        # check if all the dataloggers are still active
+        for datalogger in self.dataloggers:
+            if datalogger.active.is_set():
+                dl_active = True
+        scope_active = False
+        if (len(self.scope_windows)):
+            scope_active = True
 
-            time.sleep(2)
+        if not dl_active and not scope_active:
+            logger.info("No more active dataloggers")
+            # no more dataloggers are running, stop monitor
+            self.check_task.cancel()
+            self.stop_thread = threading.Thread(target=self.stop)
+            self.stop_thread.start()
 
 
 class FilterType(ABC):
     """
     Base class for Filter
 
-    Child classes must implement the process method that acts on a list of
-    datapoints, can change values, add more etc
+    Child classes must implement the process method that acts on a
+    :class:`datalog.Timestep`, can change values, add more etc.
+
+    A timestep also behaves as a list of datapoints, so filters written for
+    lists of :class:`datalog.Datapoint` still work
     """
 
     @abstractmethod
-    def process(self, datapoints):
+    def process(self, timestep):
         pass
 
 
@@ -231,32 +362,44 @@ class Calibrate(FilterType):
         self.new_name = new_name
         self.keep = keep
 
-    def process(self, datapoints):
+    def process(self, timestep):
         # find the signal name
-        for datapoint in datapoints:
-            if datapoint.name == self.name:
-                # calc new value
-                value = (datapoint.value + self.offset) * self.gain
-                # change in place if no new name
-                if self.new_name is None:
-                    datapoint.value = value
-                else:
-                    # if not keeping old, change in place
-                    if not self.keep:
-                        datapoint.value = value
-                        datapoint.name = self.new_name
-                    else:
-                        # create a new datapoint and add to list
-                        new_datapoint = Datapoint(
-                            name=self.new_name,
-                            value=value,
-                            time=datapoint.time,
-                            timestamp=datapoint.timestamp,
-                            index=datapoint.index,
-                        )
-                        datapoints.append(new_datapoint)
-                # Found datapoint, break from loop
-                break
+        i = timestep.schema.index.get(self.name)
+        if i is None:
+            return
+        # calc new value
+        value = (timestep.values[i] + self.offset) * self.gain
+        # change in place if no new name
+        if self.new_name is None:
+            timestep.values[i] = value
+        else:
+            # if not keeping old, change in place
+            if not self.keep:
+                timestep.values[i] = value
+                timestep.rename(self.name, self.new_name)
+            else:
+                # add a new signal to the timestep
+                timestep.add(self.new_name, value)
+
+
+def check_datalogger_node(format, node):
+    """
+    Raises :class:`InvalidArgumentsError` if a datalogger would be given
+    the timesteps of several nodes
+
+    The header of a log is written from the first timestep, so timesteps
+    of other nodes with other signals would be logged under it
+
+    :param format: Format of the monitor
+    :type format: :class:`can.Format`
+    :param node: Node given for the datalogger
+    :type node: :class:`Int`
+    """
+    if (node is None and isinstance(format, MultiNodeFormat)
+            and len(format.node) > 1):
+        raise InvalidArgumentsError(
+            "Format has nodes {}, a datalogger must be given the node to "
+            "log".format(sorted(format.node)))
 
 
 class InvalidArgumentsError(Exception):
@@ -0,0 +1,550 @@
+"""
+Decodes PDO frames in separate processes, passing data in shared memory
+
+The CAN device is read in its own process, which writes the raw frames of
+each node into a shared memory ring for the decode worker of that node.
+Workers assemble timesteps into blocks and write them into a second ring
+per worker, read by :class:`ProcessPDOConverter` in the main process. So
+reading and decoding frames do not share the GIL with the monitor,
+dataloggers and scope windows
+"""
+
+from canPDOMonitor.can import FRAME_RECORD, TimestepAssembler, _pack_record
+from canPDOMonitor.datalog import DataBlock
+from multiprocessing import shared_memory
+import multiprocessing
+import queue
+import threading
+import traceback
+import logging
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only required in the main process, for data blocks
+    np = None
+
+
+class SharedRing:
+    """
+    Single producer, single consumer ring of messages in shared memory
+
+    Each message is a length followed by its bytes, padded to 8 bytes. The
+    producer only moves head and the consumer only moves tail, both stored
+    in the shared memory block with a closed flag, so a ring created in one
+    process can be attached to by name in another. Neither side blocks on
+    the other, an empty or full ring is polled every poll_time seconds.
+    Messages must not be empty, as empty bytes are returned on timeout
+
+    :param size: Bytes of messages the ring holds. None to attach to an
+        existing ring by name
+    :type size: :class:`Int`
+    :param name: Name of the shared memory block of an existing ring
+    :type name: :class:`String`
+    """
+
+    # seconds to sleep between checks of an empty or full ring
+    poll_time = 0.001
+
+    def __init__(self, size=None, name=None):
+        if name is None:
+            size = _align(size)
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=_DATA_OFFSET + size)
+            self.counts = self.shm.buf[:_DATA_OFFSET].cast("Q")
+            self.counts[_CAPACITY] = size
+            # only the process that created the ring removes it
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.counts = self.shm.buf[:_DATA_OFFSET].cast("Q")
+            self.owner = False
+        self.name = self.shm.name
+        self.capacity = self.counts[_CAPACITY]
+        self.data = self.shm.buf[_DATA_OFFSET:_DATA_OFFSET + self.capacity]
+
+    @property
+    def closed(self):
+        return bool(self.counts[_CLOSED])
+
+    def put(self, message, timeout=None):
+        """
+        Writes a message into the ring, waiting for room if full
+
+        Returns False if there was no room before timeout, or the ring was
+        closed by the consumer
+        """
+        n = len(message)
+        need = _align(_LENGTH.size + n)
+        if need > self.capacity:
+            raise ValueError("Message of {} bytes larger than ring".format(n))
+
+        head = self.counts[_HEAD]
+        pos = head % self.capacity
+        # messages are not split, skip to start if no room at the end
+        skip = 0
+        if pos + need > self.capacity:
+            skip = self.capacity - pos
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while head + skip + need - self.counts[_TAIL] > self.capacity:
+            if self.closed:
+                return False
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(self.poll_time)
+
+        if skip:
+            _LENGTH.pack_into(self.data, pos, _WRAP)
+            head = head + skip
+            pos = 0
+        _LENGTH.pack_into(self.data, pos, n)
+        self.data[pos + _LENGTH.size:pos + _LENGTH.size + n] = message
+        # publish the message to the consumer
+        self.counts[_HEAD] = head + need
+        return True
+
+    def get(self, timeout=None):
+        """
+        Returns the bytes of the next message
+
+        Returns empty bytes on timeout and None if closed and empty
+        """
+        tail = self.counts[_TAIL]
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while self.counts[_HEAD] == tail:
+            if self.closed:
+                # check again, message may have been added before closing
+                if self.counts[_HEAD] == tail:
+                    return None
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return b""
+            time.sleep(self.poll_time)
+
+        pos = tail % self.capacity
+        n = _LENGTH.unpack_from(self.data, pos)[0]
+        if n == _WRAP:
+            # message continues at start of ring
+            tail = tail + self.capacity - pos
+            pos = 0
+            n = _LENGTH.unpack_from(self.data, pos)[0]
+        message = bytes(self.data[pos + _LENGTH.size:pos + _LENGTH.size + n])
+        # hand the space back to the producer
+        self.counts[_TAIL] = tail + _align(_LENGTH.size + n)
+        return message
+
+    def close(self):
+        """
+        Marks the end of messages, or that the consumer has gone
+        """
+        self.counts[_CLOSED] = 1
+
+    def release(self):
+        """
+        Detaches from the shared memory, removing it if this is the owner
+        """
+        self.data.release()
+        self.counts.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ProcessPDOConverter:
+    """
+    Converts frames to data as :class:`can.PDOConverter`, in other processes
+
+    The device is created in a reader process by calling device_factory, so
+    hardware handles are only opened there. With spawn (Windows) the factory
+    and format are pickled, so use a class or :func:`functools.partial`
+    rather than a lambda. Frames are sharded by node to up to workers decode
+    processes, each with a :class:`can.TimestepAssembler` per node.
+
+    Data is always returned as :class:`datalog.DataBlock`, one per burst of
+    frames per node and at most block_size timesteps. Has the start, stop
+    and get_datapoints interface of :class:`can.PDOConverter`, so can be
+    given to :class:`monitor.Monitor`. Errors in the device process at start
+    are raised by start, later errors are logged and kept in errors, and
+    end the data as for a stopped device
+
+    :param device_factory: Called with no arguments in the reader process to
+        create the :class:`can.Device`
+    :type device_factory: :class:`callable`
+    :param format: PDO format of the frames
+    :type format: :class:`can.Format`
+    :param workers: Maximum number of decode processes, at most one per node
+    :type workers: :class:`Int`
+    :param block_size: Maximum number of timesteps per block
+    :type block_size: :class:`Int`
+    :param resync: If True, recover from out of order frames, see
+        :class:`can.PDOConverter`
+    :type resync: :class:`Bool`
+    :param ring_size: Bytes in each shared memory ring
+    :type ring_size: :class:`Int`
+    :param start_timeout: Seconds to wait for the device process to start
+    :type start_timeout: :class:`Float`
+    """
+
+    # maximum number of frames to fetch from device at once
+    read_size = 1000
+
+    def __init__(self, device_factory, format, workers=1, block_size=100,
+                 resync=False, ring_size=1 << 22, start_timeout=10):
+        if np is None:
+            raise ImportError("numpy is required for process decoding")
+
+        self.device_factory = device_factory
+        self.format = format
+        self.workers = workers
+        self.block_size = block_size
+        self.resync = resync
+        self.ring_size = ring_size
+        self.start_timeout = start_timeout
+
+        # device is only created in the reader process
+        self.device = None
+
+        # rings of frames to each worker and blocks from each worker
+        self.frame_rings = []
+        self.data_rings = []
+        # ring to read next, so workers are read in turn
+        self.next_ring = 0
+        self.reader = None
+        self.decoders = []
+
+        # set to tell the reader process to stop the device
+        self.stop_event = None
+        # (kind, message) from the other processes
+        self.status = None
+        # error messages from the other processes
+        self.errors = []
+
+        # total timesteps received
+        self.data_count = 0
+
+        # marks the converter as active
+        self.active = threading.Event()
+        # held while reading rings, so they are not released mid read
+        self.read_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the device reader process, then a decode process per shard
+
+        Raises :class:`ProcessError` if the device fails to start
+        """
+        logger.info("Starting process PDO Converter")
+        self.format.compile()
+        ctx = multiprocessing.get_context()
+
+        # formats of each node, dealt out to the workers in turn
+        nodes = {}
+        for node, format in self.format.dispatch.values():
+            nodes[node] = format
+        nworkers = min(self.workers, len(nodes))
+        shards = [[] for i in range(nworkers)]
+        worker = {}
+        for i, node in enumerate(sorted(nodes)):
+            shards[i % nworkers].append(nodes[node])
+            worker[node] = i % nworkers
+        # schema of each node, to rebuild blocks from the workers
+        self.schema = {node: format.schema for node, format in nodes.items()}
+        self.rate = {node: format.rate for node, format in nodes.items()}
+        # lookup of frame id to the worker of its node
+        shard = {id: worker[node]
+                 for id, (node, format) in self.format.dispatch.items()}
+
+        self.frame_rings = [SharedRing(self.ring_size)
+                            for i in range(nworkers)]
+        self.data_rings = [SharedRing(self.ring_size)
+                           for i in range(nworkers)]
+        self.stop_event = ctx.Event()
+        self.status = ctx.Queue()
+
+        self.reader = ctx.Process(
+            target=_read_device, name="PDO device reader", daemon=True,
+            args=(self.device_factory,
+                  [ring.name for ring in self.frame_rings], shard,
+                  self.read_size, self.stop_event, self.status))
+        self.reader.start()
+
+        # wait for the device to start, to get its timestamps
+        try:
+            kind, message = self.status.get(timeout=self.start_timeout)
+        except queue.Empty:
+            kind, message = "error", "Device process did not start"
+        if kind == "error":
+            self.errors.append(message)
+            self.active.set()
+            self.stop()
+            raise ProcessError(message)
+        start_timestamp, timestamp_resolution = message
+
+        for i, formats in enumerate(shards):
+            decoder = ctx.Process(
+                target=_decode_frames, daemon=True,
+                name="PDO decoder {}".format(i),
+                args=(self.frame_rings[i].name, self.data_rings[i].name,
+                      formats, self.block_size, self.resync,
+                      timestamp_resolution, start_timestamp, self.status))
+            decoder.start()
+            self.decoders.append(decoder)
+
+        self.active.set()
+        logger.info("Started process PDO Converter with {} decoders".format(
+            nworkers))
+
+    def stop(self):
+        """
+        Stops the device, waits for the processes to end and frees the rings
+        """
+        if not self.active.is_set():
+            return
+        logger.debug("Stopping process PDO Converter")
+        self.active.clear()
+        self.stop_event.set()
+        # the data is no longer read, so decoders end straight away rather
+        # than finish the frames left or wait for room in a full ring
+        for ring in self.data_rings:
+            ring.close()
+
+        # device process closes the frame rings, which also ends the decoders
+        for process in [self.reader] + self.decoders:
+            process.join(timeout=2)
+            if process.is_alive():
+                logger.error("{} not closing, terminating".format(
+                    process.name))
+                process.terminate()
+                process.join()
+
+        with self.read_lock:
+            for ring in self.frame_rings + self.data_rings:
+                ring.release()
+            self.frame_rings = []
+            self.data_rings = []
+        self._check_status()
+        logger.info("Stopped process PDO Converter")
+
+    def get_datapoints(self):
+        """
+        Returns the next :class:`datalog.DataBlock`, None if stopped
+        """
+        while True:
+            with self.read_lock:
+                if not self.active.is_set():
+                    return None
+                rings = self.data_rings
+                running = False
+                for i in range(len(rings)):
+                    k = (self.next_ring + i) % len(rings)
+                    message = rings[k].get(timeout=0)
+                    if message:
+                        self.next_ring = k + 1
+                        return self._decode_block(message)
+                    if message is not None:
+                        running = True
+            if not running:
+                # all decoders have ended
+                logger.info("Process PDO converter: Decoders have stopped")
+                self.stop()
+                return None
+            time.sleep(SharedRing.poll_time)
+
+    def _decode_block(self, message):
+        """
+        Rebuilds a :class:`datalog.DataBlock` from a worker message
+        """
+        node, start_index, nsteps = _BLOCK_HEADER.unpack_from(message)
+        schema = self.schema[node]
+        offset = _BLOCK_HEADER.size
+        timestamp = np.frombuffer(message, dtype="<f8", count=nsteps,
+                                  offset=offset)
+        values = np.frombuffer(message, dtype="<f8",
+                               count=nsteps * len(schema),
+                               offset=offset + 8 * nsteps)
+        index = np.arange(start_index, start_index + nsteps)
+        self.data_count = self.data_count + nsteps
+        return DataBlock(schema=schema,
+                         values=values.reshape(nsteps, len(schema)),
+                         index=index,
+                         time=index / self.rate[node],
+                         timestamp=timestamp)
+
+    def _check_status(self):
+        """
+        Logs any errors sent by the other processes
+        """
+        if self.status is None:
+            return
+        while True:
+            try:
+                kind, message = self.status.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                return
+            if kind == "error":
+                logger.error(message)
+                self.errors.append(message)
+
+
+class _BlockWriter:
+    """
+    Stands in for the data queue of a :class:`can.TimestepAssembler`,
+    writing each block into a shared ring
+    """
+
+    # seconds to wait for room in the ring before giving up
+    timeout = 1
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def put(self, block):
+        values = np.ascontiguousarray(block.values, dtype="<f8")
+        timestamp = np.ascontiguousarray(block.timestamp, dtype="<f8")
+        message = b"".join((
+            _BLOCK_HEADER.pack(block.schema.node, int(block.index[0]),
+                               len(block)),
+            timestamp.tobytes(),
+            values.tobytes()))
+        return self.ring.put(message, self.timeout)
+
+    def close(self):
+        self.ring.close()
+
+
+def _read_device(device_factory, ring_names, shard, read_size, stop_event,
+                 status):
+    """
+    Runs in the reader process, passing frames from device to worker rings
+
+    Each burst of frames from the device is split by worker, and written as
+    :data:`can.FRAME_RECORD` records into that worker's ring
+    """
+    rings = [SharedRing(name=name) for name in ring_names]
+    device = None
+    try:
+        device = device_factory()
+        # frames of other ids are dropped by the device where it can
+        device.set_id_filter(shard)
+        device.start()
+        status.put(("started", (device.start_timestamp,
+                                device.timestamp_resolution)))
+
+        size = FRAME_RECORD.size
+        while not stop_event.is_set():
+            frames = device.get_frames(read_size, timeout=0.1)
+            if frames is None:
+                # device has stopped
+                break
+
+            bursts = [bytearray() for ring in rings]
+            for frame in frames:
+                k = shard.get(frame.id)
+                if k is None:
+                    continue
+                burst = bursts[k]
+                offset = len(burst)
+                burst.extend(bytes(size))
+                _pack_record(burst, offset, frame.id, frame.dlc,
+                             frame.timestamp, frame.data)
+
+            for ring, burst in zip(rings, bursts):
+                if burst and not ring.put(burst, _BlockWriter.timeout):
+                    if ring.closed and stop_event.is_set():
+                        # decoder ended as the converter is stopping
+                        break
+                    raise ProcessError("Frame ring full or decoder ended")
+    except Exception:
+        status.put(("error", "Device process: " + traceback.format_exc()))
+    finally:
+        if device is not None:
+            device.stop()
+        for ring in rings:
+            ring.close()
+            ring.release()
+
+
+def _decode_frames(frame_ring_name, data_ring_name, formats, block_size,
+                   resync, timestamp_resolution, start_timestamp, status):
+    """
+    Runs in a worker process, assembling frames into blocks of timesteps
+
+    Part filled blocks are passed on at the end of each burst, so blocks
+    follow the device bursts up to block_size timesteps
+    """
+    frame_ring = SharedRing(name=frame_ring_name)
+    data_ring = SharedRing(name=data_ring_name)
+    writer = _BlockWriter(data_ring)
+    assemblers = []
+    dispatch = {}
+    for format in formats:
+        assembler = TimestepAssembler(
+            format, writer, block_size=block_size, resync=resync,
+            timestamp_resolution=timestamp_resolution,
+            start_timestamp=start_timestamp)
+        assemblers.append(assembler)
+        for id in format.order:
+            dispatch[id] = assembler
+
+    try:
+        # data ring is closed by the converter on stop
+        while not data_ring.closed:
+            records = frame_ring.get(timeout=_BlockWriter.timeout)
+            if records is None:
+                # device process has ended
+                break
+            added = True
+            for timestamp, id, dlc, data in FRAME_RECORD.iter_unpack(
+                    records):
+                if not dispatch[id].process_frame(id, data[:dlc], timestamp):
+                    added = False
+                    break
+            if added:
+                added = all([assembler.flush() for assembler in assemblers])
+            if not added and not data_ring.closed:
+                raise ProcessError("Data ring full")
+    except Exception:
+        status.put(("error", "Decode process: " + traceback.format_exc()))
+    finally:
+        # tell the device process this worker has gone
+        frame_ring.close()
+        data_ring.close()
+        frame_ring.release()
+        data_ring.release()
+
+
+def _align(n):
+    """
+    Returns n rounded up to a multiple of 8
+    """
+    return (n + 7) & ~7
+
+
+# layout of the ring header as native 8 byte counters, each read and
+# written whole, so the other process never sees half of an update. Head
+# and tail are on their own cache lines
+_HEAD = 0
+_TAIL = 8
+_CLOSED = 16
+_CAPACITY = 17
+_DATA_OFFSET = 192
+# length of each message in the ring, and marker to continue at the start
+_LENGTH = struct.Struct("<I")
+_WRAP = 0xFFFFFFFF
+# node, index of first timestep and number of timesteps of a block message
+_BLOCK_HEADER = struct.Struct("<iqi")
+
+
+class ProcessError(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+
+
+logger = logging.getLogger(__name__)
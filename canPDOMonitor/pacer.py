@@ -0,0 +1,141 @@
+"""
+Deadline based pacing of generated or replayed frames
+
+Devices that make up their own frames, such as :class:`virtual.Virtual` and
+:class:`replay.Replay`, use a :class:`Pacer` to add them when they are due.
+Each burst is due at a fixed time from the start, so sleeping late never
+builds up into drift, and a burst that is late is sent straight away to
+catch up. With no rate the pacer never waits, to find how fast the rest
+of the pipeline can go
+"""
+
+import logging
+import time
+
+
+class Pacer:
+    """
+    Works out when items are due at rate items per second, and waits for them
+
+    Deadlines are in seconds from :py:func:`start`, on clock. Waits are
+    slept in steps of at most max_sleep, so a waiting thread sees a stop
+    quickly. The final spin seconds before a deadline are busy waited
+    rather than slept, for sub-millisecond precision at the cost of CPU
+
+    The count of items sent is kept with :py:func:`add`, for the achieved
+    rate::
+
+        pacer = Pacer(rate=1000)
+        pacer.start()
+        while active.is_set():
+            if not pacer.wait_for(pacer.count + 10, active):
+                break
+            send(10)
+            pacer.add(10)
+
+    :param rate: Items per second, None to never wait
+    :type rate: :class:`Float`
+    :param clock: Monotonic clock giving seconds, such as
+        :py:func:`time.monotonic` or :py:func:`time.perf_counter`
+    :type clock: :class:`callable`
+    :param max_sleep: Longest single sleep, in seconds
+    :type max_sleep: :class:`Float`
+    :param spin: Seconds before a deadline to busy wait
+    :type spin: :class:`Float`
+    """
+
+    def __init__(self, rate=None, clock=time.perf_counter, max_sleep=0.1,
+                 spin=0):
+        self.rate = rate
+        self.clock = clock
+        self.max_sleep = max_sleep
+        self.spin = spin
+
+        # clock time of start, deadlines are relative to it
+        self.start_time = None
+        # items sent since start
+        self.count = 0
+        # largest seconds a wait returned after its deadline
+        self.max_late = 0
+
+    def start(self):
+        """
+        Sets the start time that deadlines are from, and resets the count
+        """
+        self.start_time = self.clock()
+        self.count = 0
+        self.max_late = 0
+
+    def elapsed(self):
+        """
+        Returns seconds since start
+        """
+        return self.clock() - self.start_time
+
+    def due(self, count):
+        """
+        Returns seconds from start that count items are due, 0 with no rate
+        """
+        if self.rate is None:
+            return 0
+        return count / self.rate
+
+    def delay(self, deadline):
+        """
+        Returns seconds until deadline, 0 if it has passed
+
+        For callers that sleep themselves, such as asyncio tasks
+        """
+        return max(deadline - self.elapsed(), 0)
+
+    def wait(self, deadline, active=None):
+        """
+        Waits until deadline seconds from start
+
+        :param active: Event that ends the wait early when cleared
+        :type active: :class:`threading.Event`
+        :return: False if active was cleared, otherwise True
+        :rtype: :class:`bool`
+        """
+        while True:
+            if active is not None and not active.is_set():
+                return False
+            remaining = deadline - self.elapsed()
+            if remaining <= 0:
+                if -remaining > self.max_late:
+                    self.max_late = -remaining
+                return True
+            if remaining > self.spin:
+                time.sleep(min(remaining - self.spin, self.max_sleep))
+            # otherwise spin until the deadline
+
+    def wait_for(self, count, active=None):
+        """
+        Waits until count items since start are due
+
+        Returns straight away with no rate
+        """
+        if self.rate is None:
+            return active is None or active.is_set()
+        return self.wait(count / self.rate, active)
+
+    def add(self, n):
+        """
+        Adds n to the count of items sent
+        """
+        self.count = self.count + n
+
+    @property
+    def achieved_rate(self):
+        """
+        Items sent per second since start
+        """
+        if self.start_time is None:
+            return 0
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0
+        return self.count / elapsed
+
+
+logger = logging.getLogger(__name__)
@@ -0,0 +1,156 @@
+"""
+Parquet data log, for loading tests into pandas or polars
+
+Requires pyarrow, which is optional and only imported here
+"""
+
+from canPDOMonitor.datalog import DataLogger
+from array import array
+from time import monotonic
+import logging
+import json
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class ParquetLogger(DataLogger):
+    """
+    Writes timesteps to a Parquet file
+
+    inherits from :class:`datalog.DataLogger`, with the same start and end
+    conditions and start_at_zero time offset. There is a Time column and a
+    column for each signal. Timesteps are collected column by column, and
+    written as a compressed row group every row_group_size timesteps or
+    row_group_interval seconds, whichever comes first, and on stop.
+
+    The node, rate and start time are stored in the schema metadata under
+    canpdo, as JSON::
+
+        logger = ParquetLogger("run.parquet", row_group_interval=10)
+        ...
+        frame = pandas.read_parquet("run.parquet", columns=["Time", "385_0"])
+
+    :param dtype: Type of the signal columns, "f4" for float32 or "f8" for
+        float64. PDO values are 7Q8 or single floats, so float32 is exact
+    :type dtype: :class:`String`
+    :param rate: Timesteps per second, stored in the metadata. None for the
+        rate of the format the timesteps are from
+    :type rate: :class:`Float`
+    :param row_group_size: Most timesteps in a row group
+    :type row_group_size: :class:`Int`
+    :param row_group_interval: Most seconds between row groups written,
+        None for no limit
+    :type row_group_interval: :class:`Float`
+    :param compression: Parquet compression codec, such as zstd, snappy or
+        None
+    :type compression: :class:`String`
+    """
+
+    file_mode = "wb"
+
+    def __init__(self, filename, start_condition=None, end_condition=None,
+                 start_at_zero=True, dtype="f4", rate=None,
+                 row_group_size=100000, row_group_interval=None,
+                 compression="zstd"):
+        if pa is None:
+            raise ImportError("pyarrow is required to write Parquet logs")
+        if dtype not in _COLUMN_TYPES:
+            raise ValueError("dtype must be f4 or f8, not {}".format(dtype))
+        super().__init__(filename, start_condition, end_condition,
+                         start_at_zero)
+        self.dtype = dtype
+        self.rate = rate
+        self.row_group_size = row_group_size
+        self.row_group_interval = row_group_interval
+        self.compression = compression
+
+        # created with the header, once the signal names are known
+        self.arrow_schema = None
+        self.writer = None
+        # timesteps waiting to be written, a float64 array per column
+        self.columns = []
+        self.rows = 0
+        # monotonic time the last row group was written
+        self.group_time = None
+        self.row_groups = 0
+
+    def _write_header(self, timestep):
+        """
+        Creates the Parquet schema and writer, the header is written with
+        the first row group
+        """
+        metadata = {
+            "node": timestep.schema.node,
+            "rate": self.rate if self.rate is not None
+            else timestep.schema.rate,
+            # wall clock time of the first row
+            "start_time": time.time(),
+            "time_offset": self.time_offset,
+        }
+        column_type = pa.type_for_alias(_COLUMN_TYPES[self.dtype])
+        self.arrow_schema = pa.schema(
+            [pa.field("Time", pa.float64())]
+            + [pa.field(name, column_type) for name in timestep.names],
+            metadata={"canpdo": json.dumps(metadata)})
+        self.writer = pq.ParquetWriter(self.file, self.arrow_schema,
+                                       compression=self.compression)
+        self.columns = [array("d") for i in range(len(self.arrow_schema))]
+        self.rows = 0
+        self.group_time = monotonic()
+
+    def _write_timestep(self, timestep):
+        """
+        Adds the timestep to the columns, writing a row group once enough
+        are held
+        """
+        self.columns[0].append(timestep.time - self.time_offset)
+        for column, value in zip(self.columns[1:], timestep.values):
+            column.append(value)
+        self.rows = self.rows + 1
+        if self.rows >= self.row_group_size or (
+                self.row_group_interval is not None
+                and monotonic() - self.group_time >= self.row_group_interval):
+            self._write_row_group()
+
+    def _write_row_group(self):
+        """
+        Writes the timesteps held as one row group
+        """
+        arrays = []
+        for column, field in zip(self.columns, self.arrow_schema):
+            # no copy until cast to the column type
+            values = pa.Array.from_buffers(pa.float64(), len(column),
+                                           [None, pa.py_buffer(column)])
+            arrays.append(values.cast(field.type))
+        self.writer.write_batch(
+            pa.RecordBatch.from_arrays(arrays, schema=self.arrow_schema),
+            row_group_size=self.rows)
+        self.row_groups = self.row_groups + 1
+        self.bytes_written = self.file.tell()
+        self.columns = [array("d") for column in self.columns]
+        self.rows = 0
+        self.group_time = monotonic()
+
+    def _close(self):
+        if self.writer is not None:
+            if self.rows:
+                self._write_row_group()
+            # writes the footer, leaves the file open
+            self.writer.close()
+            self.bytes_written = self.file.tell()
+            logger.info("{} row groups written to {}".format(
+                self.row_groups, self.filename))
+        self.file.close()
+
+
+# arrow type of the signal columns for each dtype
+_COLUMN_TYPES = {"f4": "float32", "f8": "float64"}
+
+
+logger = logging.getLogger(__name__)
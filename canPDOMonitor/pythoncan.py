@@ -0,0 +1,203 @@
+"""
+can.Device on python-can, for SocketCAN and the other python-can interfaces
+
+Any interface python-can supports can be read, including its in process
+virtual interface for tests, without the Kvaser canlib
+"""
+
+from canPDOMonitor.can import Device, Frame, FRAME_RECORD, _pack_record
+from canPDOMonitor.metrics import registry
+import can as pycan
+import threading
+import logging
+
+
+class PythonCAN(Device):
+    """
+    Device reading CAN frames through a python-can bus
+
+    inherits from :class:`can.Device`
+
+    A python-can Notifier thread waits for each message, then the device
+    reads every message already received without waiting and adds them as
+    one burst. The frame ids given to set_id_filter are set as the bus
+    filters, applied by the kernel or adapter where the interface can, and
+    by python-can otherwise
+
+    Error frames are not queued, they are counted in error_frames. Those
+    reporting a controller receive overflow are also counted in
+    rx_overflows, both are in the device metrics::
+
+        device = PythonCAN(interface="socketcan", channel="can0")
+
+    :param interface: python-can interface name, such as socketcan, pcan
+        or virtual
+    :type interface: :class:`String`
+    :param channel: Channel of the interface
+    :type channel: :class:`String`
+    :param bus: Open python-can bus to read instead, it is not shut down
+        on stop
+    :type bus: :class:`can.BusABC`
+    :param max_burst: Most messages read from the bus at once
+    :type max_burst: :class:`Int`
+    :param kwargs: Other arguments for the python-can Bus
+    """
+
+    # python-can timestamps are in seconds
+    timestamp_resolution = 1
+
+    # seconds the notifier waits for a message before checking for stop
+    READ_TIMEOUT = 0.1
+
+    def __init__(self, interface="socketcan", channel="can0",
+                 bitrate=1000000, ring_buffer=False, overflow_policy=None,
+                 bus=None, max_burst=4000, **kwargs):
+        super().__init__(bitrate, ring_buffer=ring_buffer,
+                         overflow_policy=overflow_policy)
+        self.max_burst = max_burst
+        # only shut down a bus opened here
+        self.own_bus = bus is None
+        if bus is None:
+            bus = pycan.Bus(interface=interface, channel=channel,
+                            bitrate=bitrate, **kwargs)
+        self.bus = bus
+        self.notifier = None
+
+        # clear to stop adding frames, such as after an overflow
+        self.reading = threading.Event()
+
+        # error frames received, and those reporting a receive overflow
+        self.error_frames = 0
+        self.rx_overflows = 0
+
+    def set_id_filter(self, ids):
+        """
+        Sets the bus filters to let through only the frame ids
+        """
+        super().set_id_filter(ids)
+        self.bus.set_filters([
+            {"can_id": id, "can_mask": _EFF_MASK if id > _SFF_MASK
+             else _SFF_MASK, "extended": id > _SFF_MASK}
+            for id in sorted(self.id_filter)])
+        logger.info("Bus filters set for {} ids".format(len(self.id_filter)))
+
+    def _start(self):
+        logger.debug("Starting python-can {}".format(
+            self.bus.channel_info))
+        # throw away anything received before start
+        while self.bus.recv(0) is not None:
+            pass
+        self.reading.set()
+        self.notifier = pycan.Notifier(self.bus, [_BurstListener(self)],
+                                       timeout=self.READ_TIMEOUT)
+
+    def _stop(self):
+        logger.debug("Stopping python-can")
+        self.reading.clear()
+        # waits for the notifier thread to end
+        self.notifier.stop()
+        if self.own_bus:
+            self.bus.shutdown()
+        logger.info("{} error frames, {} receive overflows".format(
+            self.error_frames, self.rx_overflows))
+
+    def _read_burst(self, message):
+        """
+        Reads the messages already received after message, and adds them
+        to the queue as one burst
+
+        Called in the notifier thread. Returns False if the queue
+        overflowed
+        """
+        if not self.reading.is_set():
+            return False
+        messages = [message]
+        recv = self.bus.recv
+        while len(messages) < self.max_burst:
+            message = recv(0)
+            if message is None:
+                break
+            messages.append(message)
+
+        if self.ring_buffer:
+            size = FRAME_RECORD.size
+            records = bytearray(len(messages) * size)
+            n = 0
+            for message in messages:
+                if message.is_error_frame:
+                    self._count_error(message)
+                    continue
+                _pack_record(records, n * size, message.arbitration_id,
+                             message.dlc, message.timestamp, message.data)
+                n = n + 1
+            added = self._add_records(memoryview(records)[:n * size])
+        else:
+            frames = []
+            for message in messages:
+                if message.is_error_frame:
+                    self._count_error(message)
+                    continue
+                frames.append(Frame(id=message.arbitration_id,
+                                    data=message.data,
+                                    timestamp=message.timestamp,
+                                    dlc=message.dlc))
+            added = self._add_frames(frames)
+        if not added:
+            self.reading.clear()
+        return added
+
+    def _count_error(self, message):
+        """
+        Counts an error frame, and any receive overflow it reports
+        """
+        self.error_frames = self.error_frames + 1
+        # SocketCAN error frames report overflows in the controller
+        # class, data byte 1
+        if (message.arbitration_id & _CAN_ERR_CRTL
+                and len(message.data) > 1
+                and message.data[1] & _CAN_ERR_CRTL_OVERFLOW):
+            self.rx_overflows = self.rx_overflows + 1
+
+    def _register_metrics(self):
+        """
+        Adds the error frame and overflow counts to the device metrics
+        """
+        super()._register_metrics()
+        labels = {"device": type(self).__name__}
+        registry.counter("canpdo_device_error_frames_total",
+                         "Error frames received by the device", labels,
+                         fn=lambda: self.error_frames)
+        registry.counter("canpdo_device_rx_overflows_total",
+                         "Receive overflows reported by the bus", labels,
+                         fn=lambda: self.rx_overflows)
+
+
+class _BurstListener(pycan.Listener):
+    """
+    Passes each message the notifier receives to the device
+    """
+
+    def __init__(self, device):
+        self.device = device
+
+    def on_message_received(self, message):
+        self.device._read_burst(message)
+
+    def on_error(self, exc):
+        logger.error("python-can receive failed: {}".format(exc))
+        self.device.reading.clear()
+        self.device._trigger_stop()
+
+    def stop(self):
+        pass
+
+
+# standard and extended frame id masks
+_SFF_MASK = 0x7FF
+_EFF_MASK = 0x1FFFFFFF
+# SocketCAN error frame controller class, and its rx overflow flags
+_CAN_ERR_CRTL = 0x04
+_CAN_ERR_CRTL_OVERFLOW = 0x01
+
+
+logger = logging.getLogger(__name__)
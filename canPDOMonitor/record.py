@@ -0,0 +1,245 @@
+"""
+Recording of raw CAN frames to a binary frame log, and reading them back
+
+:class:`FrameRecorder` taps a :class:`can.Device`, writing every frame it
+reads as a fixed width :data:`can.FRAME_RECORD`, before any decoding. The
+log can be re-decoded later with :class:`replay.Replay`, or read in place
+as a numpy array with :class:`FrameLog`
+"""
+
+from canPDOMonitor.can import (FRAME_RECORD, FRAME_LOG_HEADER,
+                               FRAME_LOG_MAGIC, FRAME_LOG_VERSION,
+                               _pack_record)
+from canPDOMonitor.replay import _read_header
+from canPDOMonitor.metrics import registry
+from collections import deque
+import threading
+import logging
+import time
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only required for reading logs with FrameLog
+    np = None
+
+
+class FrameRecorder:
+    """
+    Appends the frames read by a device to a binary frame log
+
+    Set as the recorder of a :class:`can.Device`, which starts and stops it
+    with itself and passes it each burst of frames. Bursts are only queued
+    by the device thread, they are packed into records and written by the
+    recorder thread in writes of up to buffer_size bytes. A part filled
+    buffer is written after flush_time seconds, so the log can be read
+    while recording::
+
+        device = Kvaser()
+        device.recorder = FrameRecorder("run.frames")
+
+    :param filename: Name of file to write to, replaced if it exists
+    :type filename: :class:`String`
+    :param buffer_size: Bytes of records written to file at once
+    :type buffer_size: :class:`Int`
+    :param flush_time: Most seconds a record is held before writing
+    :type flush_time: :class:`Float`
+    """
+
+    def __init__(self, filename, buffer_size=1 << 20, flush_time=1):
+        self.filename = filename
+        # whole number of records
+        self.buffer_size = max(buffer_size // FRAME_RECORD.size, 1) \
+            * FRAME_RECORD.size
+        self.flush_time = flush_time
+
+        # bursts of frames waiting to be written
+        self.bursts = deque()
+        # set when bursts are added or on stop
+        self.ready = threading.Event()
+        self.active = threading.Event()
+        self.write_thread = None
+        self.file = None
+
+        # total frames and bytes written
+        self.frame_count = 0
+        self.bytes_written = 0
+
+    def start(self, timestamp_resolution=1):
+        """
+        Opens the log and starts the write thread
+
+        :param timestamp_resolution: Seconds per unit of frame timestamp,
+            of the device recorded
+        :type timestamp_resolution: :class:`Float`
+        """
+        logger.info("Recording frames to {}".format(self.filename))
+        self.bursts.clear()
+        self.file = open(self.filename, "wb", buffering=0)
+        self.file.write(FRAME_LOG_HEADER.pack(
+            FRAME_LOG_MAGIC, FRAME_LOG_VERSION, timestamp_resolution))
+        self.bytes_written = FRAME_LOG_HEADER.size
+        registry.counter("canpdo_recorder_bytes_total",
+                         "Bytes written to the frame log",
+                         {"file": self.filename},
+                         fn=lambda: self.bytes_written)
+        self.active.set()
+        self.write_thread = threading.Thread(target=self._write_loop)
+        self.write_thread.start()
+
+    def stop(self):
+        """
+        Writes all the frames recorded so far, then closes the log
+        """
+        if self.active.is_set():
+            self.active.clear()
+            self.ready.set()
+            self.write_thread.join()
+            self.file.close()
+            logger.info("Recorded {} frames to {}".format(
+                self.frame_count, self.filename))
+
+    def put(self, frames):
+        """
+        Queues a burst of frames to be written, called by the device
+        """
+        self.bursts.append(frames)
+        self.ready.set()
+
+    def put_records(self, records):
+        """
+        Queues a burst of frames already packed as records
+        """
+        self.bursts.append(bytes(records))
+        self.ready.set()
+
+    def _write_loop(self):
+        """
+        Loop run in thread to pack bursts into records and write them
+        """
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        size = FRAME_RECORD.size
+        offset = 0
+        write_time = time.monotonic()
+        bursts = self.bursts
+        while True:
+            self.ready.wait(self.flush_time)
+            self.ready.clear()
+            active = self.active.is_set()
+            while bursts:
+                burst = bursts.popleft()
+                if isinstance(burst, bytes):
+                    # packed records, copied in as they fit
+                    start = 0
+                    while start < len(burst):
+                        if offset == self.buffer_size:
+                            self._write(view[:offset])
+                            offset = 0
+                            write_time = time.monotonic()
+                        n = min(len(burst) - start, self.buffer_size - offset)
+                        buffer[offset:offset + n] = burst[start:start + n]
+                        offset = offset + n
+                        start = start + n
+                    continue
+                for frame in burst:
+                    if offset == self.buffer_size:
+                        self._write(view[:offset])
+                        offset = 0
+                        write_time = time.monotonic()
+                    _pack_record(buffer, offset, frame.id, frame.dlc,
+                                 frame.timestamp, frame.data)
+                    offset = offset + size
+
+            # part filled buffer is written once it has been held a while
+            if offset and (not active
+                           or time.monotonic() - write_time
+                           >= self.flush_time):
+                self._write(view[:offset])
+                offset = 0
+                write_time = time.monotonic()
+            if not active:
+                # every burst added before stop has been written
+                break
+
+    def _write(self, records):
+        self.file.write(records)
+        self.frame_count = (self.frame_count
+                            + len(records) // FRAME_RECORD.size)
+        self.bytes_written = self.bytes_written + len(records)
+
+
+class FrameLog:
+    """
+    Binary frame log read in place, as a numpy structured array
+
+    The file is memory mapped, nothing is parsed or copied until the
+    records are used. The records have fields timestamp, id, dlc and data,
+    the data as 8 bytes. Timestamps are in the units of the recorded
+    device, seconds per unit are in timestamp_resolution
+
+    :param filename: Name of the frame log
+    :type filename: :class:`String`
+    """
+
+    def __init__(self, filename):
+        if np is None:
+            raise ImportError("numpy is required to read frame logs")
+        self.filename = filename
+        with open(filename, "rb") as file:
+            self.timestamp_resolution = _read_header(file)
+        # a part written record at the end is left out
+        n = ((os.path.getsize(filename) - FRAME_LOG_HEADER.size)
+             // FRAME_RECORD.size)
+        if n:
+            self.records = np.memmap(filename, dtype=FRAME_DTYPE, mode="r",
+                                     offset=FRAME_LOG_HEADER.size,
+                                     shape=(n,))
+        else:
+            self.records = np.empty(0, dtype=FRAME_DTYPE)
+
+    @property
+    def timestamp(self):
+        return self.records["timestamp"]
+
+    @property
+    def id(self):
+        return self.records["id"]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def time_range(self, start=None, end=None):
+        """
+        Returns the records with start <= timestamp < end, as a view
+
+        Found by binary search, so timestamps must be in order, as they
+        are when recorded from one device
+
+        :param start: First timestamp, None from the start of the log
+        :type start: :class:`Float`
+        :param end: Timestamp to end before, None to the end of the log
+        :type end: :class:`Float`
+        """
+        timestamp = self.records["timestamp"]
+        first = 0
+        last = len(timestamp)
+        if start is not None:
+            first = np.searchsorted(timestamp, start, side="left")
+        if end is not None:
+            last = np.searchsorted(timestamp, end, side="left")
+        return self.records[first:last]
+
+
+# numpy type of a FRAME_RECORD
+if np is not None:
+    FRAME_DTYPE = np.dtype({"names": ["timestamp", "id", "dlc", "data"],
+                            "formats": ["<f8", "<u4", "u1", ("u1", 8)],
+                            "offsets": [0, 8, 12, 16],
+                            "itemsize": FRAME_RECORD.size})
+
+logger = logging.getLogger(__name__)
@@ -0,0 +1,229 @@
+"""
+can.Device replaying recorded CAN traffic
+
+Frames are read from a raw binary frame log, as written with
+:data:`can.FRAME_LOG_HEADER` followed by :data:`can.FRAME_RECORD` records,
+or a candump text log, and passed through the normal
+:class:`can.PDOConverter` and :class:`monitor.Monitor` pipeline
+"""
+
+from canPDOMonitor import can
+from canPDOMonitor.can import (FRAME_RECORD, FRAME_LOG_HEADER,
+                               FRAME_LOG_MAGIC, OverflowPolicy)
+from canPDOMonitor.pacer import Pacer
+import itertools
+import threading
+import logging
+import re
+
+
+class Replay(can.Device):
+    """
+    Device replaying the frames of a recorded log file
+
+    The recorded timestamps are kept, so the device ends up in the same
+    state as when it was recorded. Frames are paced from the recorded
+    timestamps, at speed times real time. With speed None frames are added
+    as fast as the consumer takes them, the queue then defaults to the
+    Block overflow policy so none are lost. The device stops itself once
+    every frame has been replayed
+
+    :param filename: Binary frame log or candump log to replay, the type
+        is found from the start of the file
+    :type filename: :class:`String`
+    :param speed: Multiple of real time to replay at, None for as fast as
+        possible. The rate reached is logged at the end of the log
+    :type speed: :class:`Float`
+    :param burst_size: Most frames to add to the queue at once
+    :type burst_size: :class:`Int`
+    """
+
+    # longest time to sleep while waiting for a frame, so stop is quick
+    MAX_SLEEP = 0.1
+
+    def __init__(self, filename, speed=1, burst_size=100, bitrate=1000000,
+                 ring_buffer=False, overflow_policy=None):
+        if speed is None and overflow_policy is None:
+            overflow_policy = OverflowPolicy.Block
+        super().__init__(bitrate=bitrate, ring_buffer=ring_buffer,
+                         overflow_policy=overflow_policy)
+        self.filename = filename
+        self.speed = speed
+        self.burst_size = burst_size
+
+        with open(filename, "rb") as file:
+            self.binary = file.read(len(FRAME_LOG_MAGIC)) == FRAME_LOG_MAGIC
+        if self.binary:
+            with open(filename, "rb") as file:
+                self.timestamp_resolution = _read_header(file)
+        else:
+            # candump timestamps are in seconds
+            self.timestamp_resolution = 1
+
+        self.replay_thread = None
+        self.thread_active = threading.Event()
+        # waits for frames from their recorded timestamps
+        self.pacer = Pacer(max_sleep=self.MAX_SLEEP)
+        # frames replayed since start
+        self.replay_count = 0
+
+    def _start(self):
+        self.replay_count = 0
+        if self.binary:
+            self.file = open(self.filename, "rb")
+            _read_header(self.file)
+            chunks = _read_binary(self.file, self.burst_size)
+        else:
+            self.file = open(self.filename, "r")
+            chunks = _read_candump(self.file, self.burst_size)
+
+        # first frame timestamp is the start, older frames are never stale
+        first = next(chunks, [])
+        if first:
+            self.start_timestamp = first[0].timestamp
+        self.thread_active.set()
+        self.replay_thread = threading.Thread(
+            target=self._replay_loop, args=(first, chunks))
+        self.replay_thread.start()
+
+    def _stop(self):
+        self.thread_active.clear()
+        # waits at most the queue timeout if blocked on a full queue
+        self.replay_thread.join()
+        self.file.close()
+
+    def _replay_loop(self, first, chunks):
+        """
+        Loop called in thread to add the frames when they are due
+        """
+        logger.info("Replaying {}".format(self.filename))
+        pacer = self.pacer
+        pacer.start()
+        chunks = itertools.chain([first], chunks)
+        start_timestamp = self.start_timestamp
+        # seconds of replay per unit of recorded timestamp
+        scale = None
+        if self.speed is not None:
+            scale = self.timestamp_resolution / self.speed
+
+        for frames in chunks:
+            i = 0
+            n = len(frames)
+            while i < n:
+                if not self.thread_active.is_set():
+                    return
+                if scale is None:
+                    j = n
+                else:
+                    # add every frame already due, or wait for the next
+                    now = pacer.elapsed()
+                    j = i
+                    while (j < n and (frames[j].timestamp - start_timestamp)
+                           * scale <= now):
+                        j = j + 1
+                    if j == i:
+                        due = (frames[i].timestamp - start_timestamp) * scale
+                        if not pacer.wait(due, self.thread_active):
+                            return
+                        continue
+                if not self._add_frames(frames[i:j]):
+                    return
+                pacer.add(j - i)
+                self.replay_count = self.replay_count + j - i
+                i = j
+
+        logger.info("Replay of {} finished, {} frames at {:.0f} frames/s"
+                    .format(self.filename, self.replay_count,
+                            pacer.achieved_rate))
+        # end of the log, stop as if the bus was taken off
+        self._trigger_stop()
+
+
+def _read_header(file):
+    """
+    Reads the header of a binary frame log, returns timestamp resolution
+    """
+    header = file.read(FRAME_LOG_HEADER.size)
+    if len(header) < FRAME_LOG_HEADER.size:
+        raise LogFormatError("Frame log header is too short")
+    magic, version, timestamp_resolution = FRAME_LOG_HEADER.unpack(header)
+    if magic != FRAME_LOG_MAGIC:
+        raise LogFormatError("Not a frame log")
+    if version != can.FRAME_LOG_VERSION:
+        raise LogFormatError("Frame log version {} not supported".format(
+            version))
+    return timestamp_resolution
+
+
+def _read_binary(file, n):
+    """
+    Generator giving lists of up to n frames from a binary frame log
+    """
+    size = FRAME_RECORD.size
+    buffer = bytearray(n * size)
+    while True:
+        nbytes = file.readinto(buffer)
+        # any part record at the end of the file is ignored
+        nbytes = nbytes - nbytes % size
+        if not nbytes:
+            return
+        yield [can.Frame(id=id, data=data[:dlc], timestamp=timestamp,
+                         dlc=dlc)
+               for timestamp, id, dlc, data
+               in FRAME_RECORD.iter_unpack(memoryview(buffer)[:nbytes])]
+
+
+def _read_candump(file, n):
+    """
+    Generator giving lists of up to n frames from a candump log
+
+    Reads both the log file format of candump -l and the display format of
+    candump -ta. Lines that are not frames are skipped, remote and error
+    frames are not replayed
+    """
+    frames = []
+    for line in file:
+        match = _CANDUMP_LOG.match(line)
+        if match is not None:
+            timestamp, id, data = match.groups()
+            if data.startswith("R"):
+                continue
+            if data.startswith("#"):
+                # CAN FD frame, data follows a flags digit
+                data = data[2:]
+            data = bytes.fromhex(data)
+        else:
+            match = _CANDUMP_DISPLAY.match(line)
+            if match is None:
+                continue
+            timestamp, id, dlc, data = match.groups()
+            if data.lstrip().startswith("remote"):
+                continue
+            data = bytes.fromhex(data)[:int(dlc)]
+        id = int(id, 16)
+        if id & _CAN_ERR_FLAG:
+            continue
+        frames.append(can.Frame(id=id & _CAN_EFF_MASK, data=data,
+                                timestamp=float(timestamp), dlc=len(data)))
+        if len(frames) >= n:
+            yield frames
+            frames = []
+    if frames:
+        yield frames
+
+
+# (1436509052.249713) vcan0 123#11223344
+_CANDUMP_LOG = re.compile(r"\s*\(([\d.]+)\)\s+\S+\s+([0-9A-Fa-f]+)#(\S*)")
+# (1436509052.249713)  vcan0  123   [4]  11 22 33 44
+_CANDUMP_DISPLAY = re.compile(
+    r"\s*\(([\d.]+)\)\s+\S+\s+([0-9A-Fa-f]+)\s+\[(\d+)\]\s*([^']*)")
+# error frame flag and 29 bit id mask of candump ids
+_CAN_ERR_FLAG = 0x20000000
+_CAN_EFF_MASK = 0x1FFFFFFF
+
+
+class LogFormatError(Exception):
+    pass
+
+
+logger = logging.getLogger(__name__)
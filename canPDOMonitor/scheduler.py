@@ -0,0 +1,149 @@
+"""
+Process wide scheduler for periodic housekeeping tasks
+
+Devices, converters and monitors register their stats and liveness checks
+with the shared :data:`scheduler`, rather than each owning threads that
+sleep in a loop. All tasks run in one thread, in order of when they are
+due using a heap, and are cancelled straight away on stop. Tasks must be
+quick, anything that waits on other threads, such as stopping, is started
+in a thread of its own
+"""
+
+import heapq
+import itertools
+import os
+import threading
+import logging
+import time
+
+
+class Task:
+    """
+    A function scheduled to run once, or every interval seconds
+
+    Returned by the :class:`Scheduler` call methods, call cancel to stop it
+    running again
+    """
+
+    def __init__(self, scheduler, func, interval, due):
+        self.scheduler = scheduler
+        self.func = func
+        self.interval = interval
+        # monotonic time the task is next due
+        self.due = due
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stops the task from running again, does not wait if it is running
+        """
+        with self.scheduler.condition:
+            self.cancelled = True
+            # wake the scheduler, so it can end if nothing else is due
+            self.scheduler.condition.notify()
+
+
+class Scheduler:
+    """
+    Runs tasks in a single thread at the times they are due
+
+    The thread is started when a task is added and waits on a condition
+    until the earliest task is due, so it does not poll. It ends once there
+    are no tasks left, so a process is kept running while periodic tasks
+    are registered, as it was by the threads they replace. Cancelled tasks
+    are discarded when they reach the top of the heap.
+    Periodic tasks are rescheduled from when they were due, skipping runs
+    that were missed rather than running them back to back. Tasks must not
+    block for long, as they hold up every other task
+
+    The largest lateness of a task seen is kept in max_late. A forked child
+    process starts with no tasks and its own thread
+    """
+
+    def __init__(self):
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """
+        Empties the scheduler, also run in a forked child process
+        """
+        # (due, sequence, task), sequence keeps order of tasks due together
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        # seconds the latest task started after it was due
+        self.max_late = 0
+
+    def call_later(self, delay, func):
+        """
+        Runs func once in the scheduler thread after delay seconds
+        """
+        return self._add(Task(self, func, None, time.monotonic() + delay))
+
+    def call_every(self, interval, func, delay=None):
+        """
+        Runs func in the scheduler thread every interval seconds
+
+        The first run is after delay seconds, defaults to interval
+        """
+        if delay is None:
+            delay = interval
+        return self._add(Task(self, func, interval,
+                              time.monotonic() + delay))
+
+    def _add(self, task):
+        with self.condition:
+            heapq.heappush(self.heap, (task.due, next(self.sequence), task))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name="Scheduler")
+                self.thread.start()
+            self.condition.notify()
+        return task
+
+    def _run(self):
+        """
+        Loop run in the scheduler thread, waits for and runs each task
+        """
+        while True:
+            with self.condition:
+                while True:
+                    # drop cancelled tasks
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        # nothing left to run, started again by _add
+                        self.thread = None
+                        return
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                due, sequence, task = heapq.heappop(self.heap)
+
+            late = time.monotonic() - due
+            if late > self.max_late:
+                self.max_late = late
+            try:
+                task.func()
+            except Exception:
+                logger.exception("Scheduled task {} failed".format(task.func))
+
+            if task.interval is not None and not task.cancelled:
+                # next run, skipping any that are already missed
+                now = time.monotonic()
+                task.due = due + task.interval
+                if task.due < now:
+                    task.due = now
+                with self.condition:
+                    heapq.heappush(self.heap,
+                                   (task.due, next(self.sequence), task))
+
+
+# the scheduler shared by everything in the process
+scheduler = Scheduler()
+
+logger = logging.getLogger(__name__)
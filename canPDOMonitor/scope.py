@@ -5,9 +5,12 @@ Classes for displaying data live on the screen
 from PyQt5 import QtWidgets
 from PyQt5.QtCore import QTimer
 import pyqtgraph as pg
+from canPDOMonitor.datalog import as_timestep
+from canPDOMonitor.metrics import registry
 from enum import Enum
 from collections import deque
 import threading
+import time
 import queue
 import logging
 
@@ -54,12 +57,12 @@ class ScopeWindow(pg.GraphicsLayoutWidget):
         for scope in self.scopes:
             scope.start()
 
-    def add_datapoints(self, datapoints):
+    def add_datapoints(self, timestep):
         """
-        Adds the list of datapoints to all attached scopes in window
+        Adds the timestep to all attached scopes in window
         """
         for scope in self.scopes:
-            scope.add_datapoints(datapoints)
+            scope.add_datapoints(timestep)
 
     def _create_layout(self):
         """
@@ -152,7 +155,7 @@ class Scope(pg.PlotItem):
         self.samplelength = samplelength
         self.samplerate = samplerate
 
-        # queue for incoming datapoints
+        # queue for incoming timesteps
         self.data_queue = queue.Queue()
         # buffer for holding the plot data and time values
         self.buffer = ScopeBuffer(
@@ -192,6 +195,8 @@ class Scope(pg.PlotItem):
 
         # offset used to time data to align first datapoint on plot with 0
         self.time_offset = 0
+        # ingest time of the newest timestep taken, None if unknown
+        self.ingest_time = None
         # cannot offset time with no trigger
         if trigger is None:
             time_zero = False
@@ -218,52 +223,71 @@ class Scope(pg.PlotItem):
                 self.enableAutoRange(x=True)
 
     def start(self):
+        labels = {"scope": str(self.title)}
+        # counted by the data thread only
+        self.timestep_counter = registry.counter(
+            "canpdo_scope_timesteps_total", "Timesteps taken by the scope",
+            labels)
+        registry.gauge("canpdo_scope_queue_size",
+                       "Timesteps waiting to be added to the scope", labels,
+                       fn=self.data_queue.qsize)
+        self.refresh_histogram = registry.histogram(
+            "canpdo_scope_refresh_seconds",
+            "Seconds taken to redraw the scope", labels)
+        # age of the newest timestep taken, each time the scope is redrawn
+        self.latency = registry.summary(
+            "canpdo_sink_latency_seconds",
+            "Seconds from the device queueing a timestep to a sink using it",
+            {"sink": "scope", "name": str(self.title)})
         # start the scope threads
         self.data_thread.start()
         self.display_timer.start(100)
 
-    def add_datapoints(self, datapoints):
+    def add_datapoints(self, timestep):
         """
-        Add a list of datapoints to the data queue, potentially to be shown
+        Add a timestep to the data queue, potentially to be shown
+
+        A list of :class:`datalog.Datapoint` is also accepted
         """
-        self.data_queue.put(datapoints)
-        
+        self.data_queue.put(as_timestep(timestep))
 
     def _data_loop(self):
         """
-        Pulls datapoints from data_queue and adds the values to deques
+        Pulls timesteps from data_queue and adds the values to deques
         """
         # flag to determine if data should be put in buffer
         self.triggered = False
 
         while(True):
-            # get next datapoitns from queue
-            # logger.debug("Get next datapoint")
-            datapoints = self.data_queue.get()
-            
+            # get next timestep from queue
+            timestep = self.data_queue.get()
+
             # end if None
-            if datapoints is None:
+            if timestep is None:
                 break
+            self.timestep_counter.inc()
+            self.ingest_time = timestep.ingest_time
 
-            signals = [d for d in datapoints if d.name in self.signal_names]
+            # create dict of values, offsetting time value if required
+            values = {"Time": timestep.time}
+            index = timestep.schema.index
+            for name in self.signal_names:
+                if name in index:
+                    values[name] = timestep.values[index[name]]
 
-            if len(signals) == 0:
+            if len(values) == 1:
                 logger.warn("No Matching Signal names")
                 continue
 
-            # create dict of values, offsetting time value if required
-            values = {"Time": signals[0].time}
-            for sig in signals:
-                values[sig.name] = sig.value
             if self.trigger is None:
-                # free run mode, all datapoints to buffer
+                # free run mode, all timesteps to buffer
                 self.buffer.append(values)
             else:
                 # get the value of the trigger signal if not already
-                if self.trigger.name not in self.signal_names:
-                    for d in datapoints:
-                        if d.name == self.trigger.name:
-                            values[self.trigger.name] = d.value
+                if (self.trigger.name not in self.signal_names
+                        and self.trigger.name in index):
+                    values[self.trigger.name] = (
+                        timestep.values[index[self.trigger.name]])
                 if self.triggered:
                     # scope has been triggered, put data in buffer
                     # adjust time
@@ -288,6 +312,7 @@ class Scope(pg.PlotItem):
         """
         Refreshes the data displayed on scope according to scope settings
         """
+        start = time.perf_counter()
         # go through each signal and set data on plot
         # logger.debug("Updating scope")
         data = self.buffer.get_data()
@@ -300,6 +325,9 @@ class Scope(pg.PlotItem):
                 )
 
             # set ranges if required
+            if self.ingest_time is not None:
+                self.latency.observe(time.monotonic() - self.ingest_time)
+        self.refresh_histogram.observe(time.perf_counter() - start)
 
 
 class ScopeSettings():
@@ -5,7 +5,9 @@ import socket
 import json
 from threading import Thread, Event
 from canPDOMonitor.scope import (ScopeWindow, Scope, app)
-from canPDOMonitor.datalog import Datapoint
+from canPDOMonitor.datalog import (Datapoint, Schema, Timestep,
+                                   as_timestep)
+from canPDOMonitor.metrics import registry
 import time
 
 import logging
@@ -43,6 +45,8 @@ class Client():
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.scopes = []
+        # schema last sent to the server, names only sent when it changes
+        self.schema = None
 
     def add_scope(self, settings):
         """
@@ -55,15 +59,30 @@ class Client():
         Opens connection and sends the scope window configuration to the server
         """
         self.socket.connect((self.host, self.port))
+        self.latency = registry.summary(
+            "canpdo_sink_latency_seconds",
+            "Seconds from the device queueing a timestep to a sink using it",
+            {"sink": "client", "name": "{}:{}".format(self.host, self.port)})
         msg = json.dumps({"Scopes":self.scopes}).encode()
         self.socket.send(struct.pack('!BH',1,len(msg)+3) + msg)
     
-    def add_datapoints(self, datapoints):
+    def add_datapoints(self, timestep):
         """
-        Accepts a list of Datapoints at current timestep and send them to scope
+        Accepts a Timestep (or list of Datapoints) and sends it to scope
+
+        The signal names are sent once in a schema packet, then each
+        timestep is sent as a packet of values only
         """
-        msg = json.dumps([d.__dict__ for d in datapoints]).encode()
-        self.socket.send(struct.pack('!BH',2,len(msg)+3) + msg)
+        timestep = as_timestep(timestep)
+        if timestep.schema is not self.schema:
+            self.schema = timestep.schema
+            msg = json.dumps(timestep.names).encode()
+            self.socket.send(struct.pack('!BH',3,len(msg)+3) + msg)
+        msg = json.dumps([timestep.time, timestep.timestamp, timestep.index,
+                          [float(v) for v in timestep.values]]).encode()
+        self.socket.send(struct.pack('!BH',4,len(msg)+3) + msg)
+        if timestep.ingest_time is not None:
+            self.latency.observe(time.monotonic() - timestep.ingest_time)
   
 class Connection():
     """
@@ -75,6 +94,9 @@ class Connection():
         self.data = bytearray() # buffer containing data from client
 
         self.packet_count = 0
+        self.bytes_received = 0
+        # schema of the timesteps being recieved
+        self.schema = None
 
         self.window_settings = None
         self.create_window = Event()
@@ -90,8 +112,14 @@ class Connection():
         listen_thread = Thread(target=self.listen)
         listen_thread.start()
 
-        monitor_thread = Thread(target=self.monitor)
-        monitor_thread.start()
+        # packet counts are exported as metrics, instead of printed
+        labels = {"client": "{}:{}".format(*self.address[:2])}
+        registry.counter("canpdo_server_packets_total",
+                         "Packets received from the scope client", labels,
+                         fn=lambda: self.packet_count)
+        registry.counter("canpdo_server_bytes_total",
+                         "Bytes received from the scope client", labels,
+                         fn=lambda: self.bytes_received)
         # wait for the create window flag to be set
         if not self.create_window.wait(5):
             logger.warn("Timeout waiting to recieve scope window settings")
@@ -134,7 +162,17 @@ class Connection():
                     # datapoints packet
                     datapoints = json.loads(packet.data)
                     datapoints = [Datapoint(**d) for d in datapoints]
-                    self.window.add_datapoints(datapoints)
+                    self.window.add_datapoints(
+                        Timestep.from_datapoints(datapoints))
+                if packet.id == 3:
+                    # schema packet, names of the following timesteps
+                    self.schema = Schema(json.loads(packet.data))
+                if packet.id == 4:
+                    # timestep packet
+                    t, timestamp, index, values = json.loads(packet.data)
+                    self.window.add_datapoints(Timestep(
+                        self.schema, values, time=t,
+                        timestamp=timestamp, index=index))
             else:
                 return
     
@@ -147,6 +185,7 @@ class Connection():
             if not len(new_data):
                 return None
             else:
+                self.bytes_received += len(new_data)
                 self.data += new_data
                 data_length = len(self.data)
                 if data_length > 3:
@@ -161,14 +200,6 @@ class Connection():
                 else:
                     continue
 
-    def monitor(self):
-        """
-        Thread used to print debug info
-        """
-        while(True):
-            print("Packet Count {}".format(self.packet_count))
-            time.sleep(2)
-
 class Packet():
     def __init__(self, id, length, data):
         self.id = id
@@ -0,0 +1,256 @@
+"""
+can.Device reading a Linux SocketCAN raw socket directly
+
+No driver library is used, frames are read from an AF_CAN CAN_RAW socket
+with the frame ids filtered by the kernel and timestamped on receive
+"""
+
+from canPDOMonitor.can import Device, Frame, FRAME_RECORD, _pack_record
+from canPDOMonitor.metrics import registry
+import threading
+import logging
+import select
+import socket
+import struct
+import time
+
+
+class SocketCAN(Device):
+    """
+    Device reading a SocketCAN interface, such as can0 or vcan0
+
+    inherits from :class:`can.Device`
+
+    The bitrate is set on the interface with ip link, not here. The frame
+    ids given to set_id_filter are installed as CAN_RAW_FILTER entries, so
+    the kernel drops other frames before they are read. Frames are
+    timestamped by the kernel on receive with SO_TIMESTAMP, in seconds
+    since the epoch
+
+    The read thread waits in poll until frames arrive, then reads every
+    frame waiting without blocking into a preallocated buffer, adding them
+    as one burst. Frames dropped by the kernel because the socket buffer
+    was full are counted in rx_overflows, from SO_RXQ_OVFL
+
+    A connected datagram socket can be given as sock in place of a CAN
+    socket, such as one end of a socketpair for tests. Frames are written
+    to the other end as 16 byte struct can_frame. If the filters cannot be
+    installed on it, frames are filtered before queueing instead
+
+    :param channel: Name of the SocketCAN interface
+    :type channel: :class:`String`
+    :param sock: Socket to read instead of opening the interface, it is
+        not closed on stop
+    :type sock: :class:`socket.socket`
+    :param max_burst: Most frames read at once
+    :type max_burst: :class:`Int`
+    """
+
+    # kernel timestamps are in seconds
+    timestamp_resolution = 1
+
+    # milliseconds to wait for frames before checking for stop
+    READ_TIMEOUT = 100
+
+    def __init__(self, channel="can0", bitrate=1000000, ring_buffer=False,
+                 overflow_policy=None, sock=None, max_burst=4000):
+        super().__init__(bitrate, ring_buffer=ring_buffer,
+                         overflow_policy=overflow_policy)
+        self.channel = channel
+        self.max_burst = max_burst
+        # only close a socket opened here
+        self.own_socket = sock is None
+        if sock is None:
+            sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW,
+                                 socket.CAN_RAW)
+            sock.bind((channel,))
+        self.sock = sock
+
+        # kernel receive timestamps, and count of frames the kernel dropped
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError:
+            logger.warning("Kernel receive overflows cannot be counted")
+        self.ancbufsize = (socket.CMSG_SPACE(_TIMEVAL.size)
+                           + socket.CMSG_SPACE(_DROPS.size))
+
+        # frames are read straight into this, one can_frame each
+        self.buffer = bytearray(max_burst * CAN_FRAME.size)
+        self.view = memoryview(self.buffer)
+
+        # ids to keep of frames read, if the kernel is not filtering
+        self.software_filter = None
+        # frames dropped by the kernel, and error frames read
+        self.rx_overflows = 0
+        self.error_frames = 0
+
+        # thread for reading the socket
+        self.read_thread = threading.Thread(target=self._read_loop)
+        # clear to stop the thread
+        self.reading = threading.Event()
+
+    def set_id_filter(self, ids):
+        """
+        Installs a kernel filter for each frame id
+
+        Only data frames of exactly the ids are let through
+        """
+        super().set_id_filter(ids)
+        filters = []
+        for id in sorted(self.id_filter):
+            if id > CAN_SFF_MASK:
+                filters.extend((id | CAN_EFF_FLAG,
+                                CAN_EFF_MASK | CAN_EFF_FLAG | CAN_RTR_FLAG))
+            else:
+                filters.extend((id, CAN_SFF_MASK | CAN_EFF_FLAG
+                                | CAN_RTR_FLAG))
+        try:
+            self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER,
+                                 struct.pack("={}I".format(len(filters)),
+                                             *filters))
+            self.software_filter = None
+            logger.info("Kernel filters set for {} ids".format(
+                len(self.id_filter)))
+        except OSError:
+            # not a CAN socket
+            self.software_filter = self.id_filter
+            logger.info("Frame ids filtered in software")
+
+    def _start(self):
+        logger.debug("Starting SocketCAN {}".format(self.channel))
+        # throw away anything received before start
+        while True:
+            try:
+                self.sock.recv(CAN_FRAME.size, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+        # kernel timestamps use the same clock
+        self.start_timestamp = time.time()
+        self.reading.set()
+        self.read_thread.start()
+
+    def _stop(self):
+        logger.debug("Stopping SocketCAN")
+        self.reading.clear()
+        self.read_thread.join()
+        if self.own_socket:
+            self.sock.close()
+        logger.info("{} frames dropped by the kernel, {} error frames"
+                    .format(self.rx_overflows, self.error_frames))
+
+    def _read_loop(self):
+        """
+        Started in thread, waits for frames and reads them in bursts
+        """
+        poll = select.poll()
+        poll.register(self.sock.fileno(), select.POLLIN)
+        while self.reading.is_set():
+            if not poll.poll(self.READ_TIMEOUT):
+                continue
+            if not self._read_frames():
+                return
+
+    def _read_frames(self):
+        """
+        Reads every frame waiting on the socket, up to max_burst, and
+        adds them to the queue as one burst
+
+        Returns False if the queue overflowed
+        """
+        view = self.view
+        size = CAN_FRAME.size
+        recvmsg_into = self.sock.recvmsg_into
+        ancbufsize = self.ancbufsize
+        timestamps = []
+        n = 0
+        while n < self.max_burst:
+            try:
+                nbytes, ancdata, flags, address = recvmsg_into(
+                    [view[n * size:(n + 1) * size]], ancbufsize,
+                    socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            if nbytes != size:
+                # not a classic CAN frame
+                continue
+            timestamp = None
+            for level, type, data in ancdata:
+                if level != socket.SOL_SOCKET:
+                    continue
+                if type == SO_TIMESTAMP:
+                    seconds, microseconds = _TIMEVAL.unpack(data)
+                    timestamp = seconds + microseconds * 1e-6
+                elif type == SO_RXQ_OVFL:
+                    # total dropped since the socket was opened
+                    self.rx_overflows = _DROPS.unpack(data)[0]
+            if timestamp is None:
+                timestamp = time.time()
+            timestamps.append(timestamp)
+            n = n + 1
+        if not n:
+            return True
+
+        wanted = self.software_filter
+        if self.ring_buffer:
+            records = bytearray(n * FRAME_RECORD.size)
+            offset = 0
+        else:
+            frames = []
+        for (can_id, dlc, data), timestamp in zip(
+                CAN_FRAME.iter_unpack(view[:n * size]), timestamps):
+            if can_id & (CAN_ERR_FLAG | CAN_RTR_FLAG):
+                if can_id & CAN_ERR_FLAG:
+                    self.error_frames = self.error_frames + 1
+                continue
+            if can_id & CAN_EFF_FLAG:
+                id = can_id & CAN_EFF_MASK
+            else:
+                id = can_id & CAN_SFF_MASK
+            if wanted is not None and id not in wanted:
+                self.software_rejected = self.software_rejected + 1
+                continue
+            if self.ring_buffer:
+                _pack_record(records, offset, id, dlc, timestamp, data)
+                offset = offset + FRAME_RECORD.size
+            else:
+                frames.append(Frame(id=id, data=data[:dlc],
+                                    timestamp=timestamp, dlc=dlc))
+        if self.ring_buffer:
+            return self._add_records(memoryview(records)[:offset])
+        return self._add_frames(frames)
+
+    def _register_metrics(self):
+        """
+        Adds the kernel drop and error frame counts to the device metrics
+        """
+        super()._register_metrics()
+        labels = {"device": type(self).__name__}
+        registry.counter("canpdo_device_error_frames_total",
+                         "Error frames received by the device", labels,
+                         fn=lambda: self.error_frames)
+        registry.counter("canpdo_device_rx_overflows_total",
+                         "Receive overflows reported by the bus", labels,
+                         fn=lambda: self.rx_overflows)
+
+
+# struct can_frame: id with flags, length, 3 pad/reserved bytes, 8 data
+CAN_FRAME = struct.Struct("=IB3x8s")
+
+# can_id flags and masks, from linux/can.h
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_SFF_MASK = 0x7FF
+CAN_EFF_MASK = 0x1FFFFFFF
+
+# socket options, not all are in the socket module
+SO_TIMESTAMP = getattr(socket, "SO_TIMESTAMP", 29)
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
+
+# struct timeval of SO_TIMESTAMP, and the uint32 drop count of SO_RXQ_OVFL
+_TIMEVAL = struct.Struct("@ll")
+_DROPS = struct.Struct("@I")
+
+
+logger = logging.getLogger(__name__)
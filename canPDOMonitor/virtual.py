@@ -1,11 +1,20 @@
 """Virtual can.Device for testing programs."""
 
 import threading
-import time
-from canPDOMonitor import can
+from abc import ABC, abstractmethod
+from canPDOMonitor import can, record
+from canPDOMonitor.can import FRAME_RECORD, OverflowPolicy
+from canPDOMonitor.pacer import Pacer
 import math
 import random
 import logging
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    # without numpy frames are generated one timestep at a time
+    np = None
 
 
 class Virtual(can.Device):
@@ -14,45 +23,143 @@ class Virtual(can.Device):
 
     inherits from :class:`can.Device`.
 
-    Streams data at 1kHz, single float on 0x181
-    and 7Q8 on 0x281, 0x381 and 0x481
+    Sends the PDOs of a :class:`can.Format` at its rate, with the value of
+    each signal given by a :class:`Waveform`. Bursts of frames are computed
+    in one pass with numpy, and with a ring buffer are written to it as
+    records without creating frame objects, for rates of 100k frames/s.
+
+    By default streams data at 1kHz, single float on 0x181
+    and 7Q8 on 0x281, 0x381 and 0x481, as :class:`can.DefaultFormat`
+
+    Several nodes can be simulated, each sends the same PDOs with its own
+    node id, interleaved as they would be after a SYNC.
+    Frame timestamps are the time of their timestep, in seconds from start
+
+    Bursts of burst_size frames are added when due by a :class:`Pacer`,
+    at speed times the rate of the format. With speed None frames are
+    added as fast as the pipeline takes them, the queue then defaults to
+    the Block overflow policy so none are lost. The rate reached is in
+    achieved_frame_rate, and logged on stop
+
+    :param nodes: CANopen node ids to send PDOs from, if no format is given
+    :type nodes: :class:`list`
+    :param format: Format of the PDOs sent, or the path of an odr to read
+        it from. Defaults to :class:`can.DefaultFormat` for each node
+    :type format: :class:`can.Format`
+    :param waveforms: Waveform of signals by name, as in the schema of the
+        format. Other signals are sine waves
+    :type waveforms: :class:`dict`
+    :param speed: Multiple of the format rate to send at, None for as fast
+        as possible
+    :type speed: :class:`Float`
+    :param burst_size: Frames added at once, defaults to 10ms of frames
+    :type burst_size: :class:`Int`
     """
 
-    def __init__(self):
+    def __init__(self, ring_buffer=False, overflow_policy=None, nodes=(1,),
+                 format=None, waveforms=None, speed=1, burst_size=None):
+
+        if speed is None and overflow_policy is None:
+            overflow_policy = OverflowPolicy.Block
 
         # super init with bitrate that doesnt matter
-        super().__init__(bitrate=1000000)
+        super().__init__(bitrate=1000000, ring_buffer=ring_buffer,
+                         overflow_policy=overflow_policy)
+
+        if format is None:
+            if len(nodes) == 1:
+                format = can.DefaultFormat(nodes[0])
+            else:
+                format = can.MultiNodeFormat(prefix=None)
+                for node in nodes:
+                    format.add(can.DefaultFormat(node))
+            defaults = _DEFAULT_WAVEFORMS
+        else:
+            if isinstance(format, str):
+                format = can.Format(odr=format)
+            defaults = ()
+        format.compile()
+        self.format = format
+        if waveforms is None:
+            waveforms = {}
+
+        if isinstance(format, can.MultiNodeFormat):
+            formats = list(format.node.values())
+        else:
+            formats = [format]
+        # timesteps per second
+        self.rate = formats[0].rate
+
+        # (frame format, waveform of each value) of each frame, in the
+        # order to send them
+        self.plan = []
+        # position of each frame in the order of its node
+        position = {}
+        for node_format in formats:
+            names = iter(node_format.schema.names)
+            column = 0
+            for j, id in enumerate(node_format.order):
+                position[id] = j
+                frame_format = node_format.frame[id]
+                waves = []
+                for i in range(frame_format.n_values):
+                    name = next(names)
+                    if name in waveforms:
+                        waves.append(waveforms[name])
+                    elif column < len(defaults):
+                        waves.append(defaults[column])
+                    else:
+                        waves.append(Sine(phase=-column * math.pi / 3))
+                    column = column + 1
+                self.plan.append((frame_format, waves))
+        # nodes are interleaved, each keeping its own order
+        self.plan.sort(key=lambda plan: (position[plan[0].id], plan[0].id))
 
         self.gen_thread = threading.Thread(target=self._gen_loop)
 
         self.thread_active = threading.Event()
 
-        # how many frames should be sent per second
-        self.target_frame_rate = 4000
+        # order in which to send PDOs
+        self.order = [frame_format.id for frame_format, waves in self.plan]
 
-        # how long to sleep for between bursts
-        self.sleep_time = 0.01
+        # how many frames should be sent per second
+        self.speed = speed
+        self.target_frame_rate = self.rate * len(self.order)
+        if speed is not None:
+            self.target_frame_rate = self.target_frame_rate * speed
 
         # how many frames to send in one go, to roughly mimic real device
-        self.nframe_send = round(self.target_frame_rate * self.sleep_time)
+        if burst_size is None:
+            burst_size = max(round(self.rate * len(self.order) * 0.01), 1)
+        self.burst_size = burst_size
 
-        # order in which to send PDOs
-        self.order = [0x181, 0x281, 0x381, 0x481]
-        self.order_ind = 0
+        self.pacer = Pacer(self.target_frame_rate if speed is not None
+                           else None)
+
+        # total frames generated, sets the timestep and frame of the next
+        self._frame_count = 0
 
-        # total datapoints sent
-        self.data_count = 0
+    @property
+    def achieved_frame_rate(self):
+        """
+        Frames added per second since start
+        """
+        return self.pacer.achieved_rate
 
     def _start(self):
-        self.start_time = time.time()
+        # timestamps are relative to start time
+        self.start_timestamp = 0
 
         self._frame_count = 0
+        self.pacer.start()
         self.thread_active.set()
         self.gen_thread.start()
 
     def _stop(self):
         self.thread_active.clear()
         self.gen_thread.join()
+        logger.info("Generated {} frames at {:.0f} frames/s".format(
+            self.pacer.count, self.achieved_frame_rate))
 
     def _gen_loop(self):
         """
@@ -62,53 +169,228 @@ class Virtual(can.Device):
         """
 
         logger.info("Frame Generation Started")
-        while(self.thread_active.is_set()):
-            # check how long its been running and how many frames should
-            # have been sent
-            elapsed_time = time.time() - self.start_time
-            frame_target = self.target_frame_rate * elapsed_time
-
-            # if sent more than required, go to sleep
-            if frame_target < self.frame_count:
-                time.sleep(self.sleep_time)
-                continue
-            for i in range(self.nframe_send):
-                self._gen_frame()
-
-    def _gen_frame(self):
+        # ring buffer takes the records, no frame objects needed
+        use_records = self.ring_buffer and np is not None
+        pacer = self.pacer
+        n = self.burst_size
+        # wait until the last frame of each burst is due
+        while pacer.wait_for(pacer.count + n, self.thread_active):
+            # send the frames as a single burst
+            if use_records:
+                added = self._add_records(self.gen_records(n))
+            else:
+                added = self._add_frames(self.gen_frames(n))
+            if not added:
+                break
+            pacer.add(n)
+
+    def gen_frames(self, n):
         """
-        creates a frame for current id and adds to queue
+        Returns a list of the next n frames
         """
+        if np is not None:
+            return [can.Frame(id=id, data=data, timestamp=timestamp, dlc=dlc)
+                    for timestamp, id, dlc, data
+                    in FRAME_RECORD.iter_unpack(self.gen_records(n))]
+
+        # one timestep at a time, with struct
+        nframes = len(self.plan)
+        frames = []
+        for count in range(self._frame_count, self._frame_count + n):
+            step, i = divmod(count, nframes)
+            frame_format, waves = self.plan[i]
+            t = step / self.rate
+            if frame_format.use7Q8:
+                data = _F7Q8.pack(*[_to_7Q8(wave(t)) for wave in waves])
+            else:
+                data = _SINGLE.pack(*[wave(t) for wave in waves])
+            frames.append(can.Frame(id=frame_format.id, data=data,
+                                    timestamp=(step + i / nframes)
+                                    / self.rate))
+        self._frame_count = self._frame_count + n
+        return frames
+
+    def gen_records(self, n):
+        """
+        Returns the next n frames as packed :data:`can.FRAME_RECORD` bytes
+
+        The values of every timestep the frames cover are computed in one
+        numpy pass per signal, requires numpy
+        """
+        nframes = len(self.plan)
+        first = self._frame_count
+        first_step = first // nframes
+        nsteps = (first + n - 1) // nframes - first_step + 1
+        t = np.arange(first_step, first_step + nsteps) / self.rate
+
+        # 8 data bytes of every frame of each timestep
+        data = np.empty((nsteps, nframes, 8), dtype=np.uint8)
+        for i, (frame_format, waves) in enumerate(self.plan):
+            if frame_format.use7Q8:
+                values = np.empty((nsteps, 4), dtype="<i2")
+                for j, wave in enumerate(waves):
+                    values[:, j] = np.clip(np.round(wave(t) * 256),
+                                           -(2**15), (2**15) - 1)
+            else:
+                values = np.empty((nsteps, 2), dtype="<f4")
+                for j, wave in enumerate(waves):
+                    values[:, j] = wave(t)
+            data[:, i, :] = values.view(np.uint8).reshape(nsteps, 8)
+
+        # the frames wanted, counting from the first of first_step
+        count = np.arange(first, first + n)
+        step, i = np.divmod(count, nframes)
+        records = np.zeros(n, dtype=record.FRAME_DTYPE)
+        records["timestamp"] = (step + i / nframes) / self.rate
+        records["id"] = np.asarray(self.order)[i]
+        records["dlc"] = 8
+        records["data"] = data.reshape(-1, 8)[count - first_step * nframes]
+        self._frame_count = self._frame_count + n
+        return records.tobytes()
+
+
+class Waveform(ABC):
+    """
+    Base class for the value of a signal sent by :class:`Virtual`
+
+    Child classes implement __call__, returning the value at t seconds.
+    t is a numpy array of times, or a float if numpy is not installed
+    """
+
+    @abstractmethod
+    def __call__(self, t):
+        pass
+
+
+class Sine(Waveform):
+    """
+    Sine wave, offset + amplitude * sin(2*pi*freq*t + phase)
+    """
+
+    def __init__(self, freq=1, amplitude=1, phase=0, offset=0):
+        self.freq = freq
+        self.amplitude = amplitude
+        self.phase = phase
+        self.offset = offset
+
+    def __call__(self, t):
+        return self.offset + self.amplitude * _sin(
+            2 * math.pi * self.freq * t + self.phase)
+
+
+class Square(Waveform):
+    """
+    Square wave between offset - amplitude and offset + amplitude
+
+    High for the first duty fraction of each period
+    """
+
+    def __init__(self, freq=1, amplitude=1, duty=0.5, offset=0):
+        self.freq = freq
+        self.amplitude = amplitude
+        self.duty = duty
+        self.offset = offset
+
+    def __call__(self, t):
+        high = (t * self.freq) % 1 < self.duty
+        return self.offset + self.amplitude * (2 * high - 1)
+
+
+class Ramp(Waveform):
+    """
+    Sawtooth rising from offset - amplitude to offset + amplitude each period
+    """
+
+    def __init__(self, freq=1, amplitude=1, offset=0):
+        self.freq = freq
+        self.amplitude = amplitude
+        self.offset = offset
+
+    def __call__(self, t):
+        return self.offset + self.amplitude * (2 * ((t * self.freq) % 1) - 1)
+
+
+class Noise(Waveform):
+    """
+    Normally distributed noise with standard deviation amplitude
+
+    :param seed: Seed of the random numbers, for repeatable runs
+    :type seed: :class:`Int`
+    """
+
+    def __init__(self, amplitude=1, offset=0, seed=None):
+        self.amplitude = amplitude
+        self.offset = offset
+        if np is not None:
+            self.rng = np.random.default_rng(seed)
+        else:
+            self.rng = random.Random(seed)
+
+    def __call__(self, t):
+        if np is not None:
+            return self.rng.normal(self.offset, self.amplitude, np.shape(t))
+        return self.rng.gauss(self.offset, self.amplitude)
+
+
+class Constant(Waveform):
+    """
+    Signal that is always value
+    """
+
+    def __init__(self, value=0):
+        self.value = value
+
+    def __call__(self, t):
+        # keeps the shape of t
+        return t * 0 + self.value
+
+
+class Recorded(Waveform):
+    """
+    Plays back recorded values at rate samples per second, repeating
+
+    :param values: Recorded values of the signal
+    :type values: :class:`list`
+    :param rate: Samples per second of values
+    :type rate: :class:`Float`
+    """
+
+    def __init__(self, values, rate=1000):
+        if np is not None:
+            values = np.asarray(values, dtype=float)
+        self.values = values
+        self.rate = rate
+
+    def __call__(self, t):
+        if np is not None:
+            index = (np.asarray(t) * self.rate).astype(np.int64)
+            return self.values[index % len(self.values)]
+        return self.values[int(t * self.rate) % len(self.values)]
+
+
+def _to_7Q8(num):
+    """
+    Returns num as a saturated int16 for packing in 7Q8 format
+    """
+    return min(max(round(num * 256), -(2**15)), (2**15) - 1)
+
+
+# sin of floats or arrays
+_sin = np.sin if np is not None else math.sin
+
+# waveforms of the default format signals, by column
+_DEFAULT_WAVEFORMS = (
+    Sine(1.1), Sine(1.1, phase=-math.pi/4),
+    Sine(), Sine(phase=-math.pi/3), Sine(phase=-2*math.pi/3),
+    Sine(phase=-math.pi),
+    Sine(phase=-4*math.pi/3), Sine(phase=-5*math.pi/3),
+    Constant(0), Constant(0),
+    Constant(1/256), Constant(0), Constant(0), Constant(0),
+)
 
-        frame = can.Frame(id=self.order[self.order_ind],
-                          timestamp=time.time() - self.start_time)
-        td = self.data_count/1000
-        if frame.id == 0x181:
-            value1 = math.sin(2*math.pi*1.1*td)
-            value2 = math.sin((2*math.pi*1.1*td)-(math.pi/4))
-            frame.data[0:4] = can.num_2_single(value1)
-            frame.data[4:8] = can.num_2_single(value2)
-
-        elif frame.id == 0x281:
-            frame.data[0:2] = can.num_2_f7Q8(math.sin(2*math.pi*1*td))
-            frame.data[2:4] = can.num_2_f7Q8(math.sin((2*math.pi*1*td) - math.pi/3))
-            frame.data[4:6] = can.num_2_f7Q8(math.sin((2*math.pi*1*td) - 2*math.pi/3))
-            frame.data[6:8] = can.num_2_f7Q8(math.sin((2*math.pi*1*td) - math.pi))
-            pass
-        elif frame.id == 0x381:
-            frame.data[0:2] = can.num_2_f7Q8(math.sin((2*math.pi*1*td) - 4*math.pi/3))
-            frame.data[2:4] = can.num_2_f7Q8(math.sin((2*math.pi*1*td) - 5*math.pi/3))
-        elif frame.id == 0x481:
-            frame.data[0] = 1
-            pass
-
-        self._add_to_queue(frame)
-        self.order_ind = self.order_ind + 1
-        if self.order_ind >= len(self.order):
-            # have reached end of data
-            self.order_ind = 0
-            self.data_count = self.data_count + 1
-        self._frame_count = self._frame_count + 1
+# structs for packing the frame data
+_SINGLE = struct.Struct("<2f")
+_F7Q8 = struct.Struct("<4h")
 
 
 # set up a logger for this module
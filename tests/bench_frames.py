@@ -0,0 +1,141 @@
+"""
+Micro-benchmark of frame creation and hand-off, printing frames/s
+
+Compares the original frame (dict based, new 8 byte bytearray each time,
+data filled with num_2_f7Q8/num_2_single) with the slotted frame packed by
+the virtual device, and the rate frames can be passed through each frame
+store
+"""
+
+from canPDOMonitor import can
+from canPDOMonitor.virtual import Virtual
+import math
+import sys
+import time
+
+N = 200000
+
+
+class LegacyFrame:
+    """
+    Copy of the original can.Frame for comparison
+    """
+
+    def __init__(self, id=0, data=None,
+                 timestamp=0, dlc=8, error=False):
+        self.id = id
+        if data is None:
+            self.data = bytearray((0, 0, 0, 0, 0, 0, 0, 0))
+        else:
+            self.data = data
+        self.timestamp = timestamp
+        self.dlc = dlc
+        self.error = error
+
+
+def legacy_gen(n):
+    """
+    Generates frames as the original Virtual._gen_frame did
+    """
+    order = [0x181, 0x281, 0x381, 0x481]
+    start_time = time.time()
+    frames = []
+    for i in range(n):
+        frame = LegacyFrame(id=order[i % 4],
+                            timestamp=time.time() - start_time)
+        td = (i // 4)/1000
+        if frame.id == 0x181:
+            value1 = math.sin(2*math.pi*1.1*td)
+            value2 = math.sin((2*math.pi*1.1*td)-(math.pi/4))
+            frame.data[0:4] = can.num_2_single(value1)
+            frame.data[4:8] = can.num_2_single(value2)
+        elif frame.id == 0x281:
+            frame.data[0:2] = can.num_2_f7Q8(math.sin(2*math.pi*1*td))
+            frame.data[2:4] = can.num_2_f7Q8(
+                math.sin((2*math.pi*1*td) - math.pi/3))
+            frame.data[4:6] = can.num_2_f7Q8(
+                math.sin((2*math.pi*1*td) - 2*math.pi/3))
+            frame.data[6:8] = can.num_2_f7Q8(
+                math.sin((2*math.pi*1*td) - math.pi))
+        elif frame.id == 0x381:
+            frame.data[0:2] = can.num_2_f7Q8(
+                math.sin((2*math.pi*1*td) - 4*math.pi/3))
+            frame.data[2:4] = can.num_2_f7Q8(
+                math.sin((2*math.pi*1*td) - 5*math.pi/3))
+        elif frame.id == 0x481:
+            frame.data[0] = 1
+        frames.append(frame)
+    return frames
+
+
+def new_gen(n):
+    """
+    Generates frames with the virtual device
+    """
+    device = Virtual()
+    return device.gen_frames(n)
+
+
+def record_gen(n):
+    """
+    Generates packed frame records with the virtual device
+    """
+    device = Virtual()
+    return device.gen_records(n)
+
+
+def rate(func, *args):
+    """
+    Returns result of func and the rate in frames/s it was produced at
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, N / (time.perf_counter() - start)
+
+
+def hand_off(store, frames, burst=40):
+    """
+    Passes frames through a frame store in bursts, reading each in turn
+    """
+    for i in range(0, len(frames), burst):
+        store.put_many(frames[i:i+burst])
+        store.get_many(burst, 0)
+    return store
+
+
+def hand_off_records(store, frames, burst=40):
+    """
+    Passes frames through a ring in bursts, reading the records in place
+    """
+    for i in range(0, len(frames), burst):
+        store.put_many(frames[i:i+burst])
+        store.get_records(burst, 0)
+    return store
+
+
+def frame_size(frame):
+    """
+    Returns approximate bytes used by a frame, its attributes and data
+    """
+    size = sys.getsizeof(frame) + sys.getsizeof(frame.data)
+    if hasattr(frame, "__dict__"):
+        size = size + sys.getsizeof(frame.__dict__)
+    return size
+
+
+legacy_frames, legacy_rate = rate(legacy_gen, N)
+print("Create legacy frames: {:.0f} frames/s, {} bytes/frame".format(
+    legacy_rate, frame_size(legacy_frames[1])))
+frames, new_rate = rate(new_gen, N)
+print("Create slotted frames: {:.0f} frames/s, {} bytes/frame".format(
+    new_rate, frame_size(frames[1])))
+print("Speed up: {:.2f}x".format(new_rate/legacy_rate))
+records, record_rate = rate(record_gen, N)
+print("Create frame records: {:.0f} frames/s".format(record_rate))
+
+store, queue_rate = rate(hand_off, can.BoundedQueue(8000), frames)
+print("BoundedQueue hand-off: {:.0f} frames/s".format(queue_rate))
+store, ring_rate = rate(hand_off, can.FrameRing(8000), frames)
+print("FrameRing hand-off as frames: {:.0f} frames/s".format(ring_rate))
+store, ring_rate = rate(hand_off_records, can.FrameRing(8000), frames)
+print("FrameRing hand-off as records: {:.0f} frames/s".format(ring_rate))
@@ -0,0 +1,32 @@
+"""
+Finds the saturation point of the device to converter pipeline
+
+Runs the virtual device unthrottled, with speed None, so frames are
+generated as fast as the PDOConverter takes them, and prints the frames/s
+reached for each burst size, with and without the ring buffer
+"""
+
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+import time
+
+# timesteps converted in each run
+N = 50000
+
+for ring_buffer in (False, True):
+    for burst_size in (10, 100, 1000):
+        device = Virtual(ring_buffer=ring_buffer, speed=None,
+                         burst_size=burst_size)
+        pdo_converter = PDOConverter(device, DefaultFormat(1),
+                                     block_size=1000)
+        start = time.perf_counter()
+        pdo_converter.start()
+        n = 0
+        while n < N:
+            n = n + len(pdo_converter.get_datapoints())
+        elapsed = time.perf_counter() - start
+        pdo_converter.stop()
+        print("Ring buffer {}, burst {}: generated {:.0f} frames/s, "
+              "converted {:.0f} frames/s".format(
+                  ring_buffer, burst_size, device.achieved_frame_rate,
+                  pdo_converter.frame_count / elapsed))
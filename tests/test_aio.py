@@ -0,0 +1,45 @@
+from canPDOMonitor.aio import AsyncPDOConverter, AsyncMonitor, AsyncVirtual
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import DefaultFormat
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running async PDO Converter test")
+
+
+async def main():
+    # threaded virtual device, adapted to asyncio, in blocks
+    pdo_converter = AsyncPDOConverter(Virtual(), DefaultFormat(),
+                                      block_size=100)
+    await pdo_converter.start()
+    async for block in pdo_converter:
+        print(block.index[0], len(block), block.values[0, 0])
+        if pdo_converter.data_count >= 1000:
+            break
+    await pdo_converter.stop()
+
+    # frame by frame by default, no numpy needed
+    pdo_converter = AsyncPDOConverter(Virtual(), DefaultFormat())
+    await pdo_converter.start()
+    async for timestep in pdo_converter:
+        if pdo_converter.data_count >= 1000:
+            print(timestep)
+            break
+    await pdo_converter.stop()
+
+    # virtual device in the event loop, routed to an async sink
+    monitor = AsyncMonitor(AsyncPDOConverter(AsyncVirtual(), DefaultFormat()))
+
+    async def sink(timestep):
+        if timestep.index % 100 == 0:
+            print(timestep)
+
+    monitor.add_sink(sink)
+    monitor.start()
+    await asyncio.sleep(1)
+    await monitor.stop()
+
+
+asyncio.run(main())
@@ -0,0 +1,84 @@
+"""
+Logs the same timesteps to CSV and to a binary log, with the same start
+and end conditions, then reads both back and compares them
+
+Prints the size of each file and the time taken to load it, then checks
+timesteps with other signals end logging
+"""
+
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+from canPDOMonitor.datalog import DataLogger, TriggerCondition, Trigger
+from canPDOMonitor.datalog import CountCondition, Schema, Timestep
+from canPDOMonitor.binlog import BinaryLogger, BinaryLog
+from array import array
+import numpy as np
+import logging
+import time
+import os
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running binary log test")
+
+device = Virtual()
+pdo_converter = PDOConverter(device, DefaultFormat())
+
+# both start on the same rising edge and log 5000 timesteps
+csv_log = DataLogger("binlog_test.csv",
+                     TriggerCondition(Trigger.Rising, "385_0"),
+                     CountCondition(5000))
+bin_log = BinaryLogger("binlog_test.bin",
+                       TriggerCondition(Trigger.Rising, "385_0"),
+                       CountCondition(5000))
+
+pdo_converter.start()
+csv_log.start()
+bin_log.start()
+while csv_log.active.is_set() or bin_log.active.is_set():
+    timesteps = pdo_converter.get_datapoints()
+    csv_log.put(timesteps)
+    bin_log.put(timesteps)
+pdo_converter.stop()
+csv_log.stop()
+bin_log.stop()
+
+start = time.perf_counter()
+csv = np.loadtxt("binlog_test.csv", delimiter=",", skiprows=1, ndmin=2)
+csv_time = time.perf_counter() - start
+
+start = time.perf_counter()
+log = BinaryLog("binlog_test.bin")
+values = np.array(log.values)
+bin_time = time.perf_counter() - start
+
+print("Header:", log.header)
+print("CSV: {} rows, {} bytes, loaded in {:.4f}s".format(
+    len(csv), os.path.getsize("binlog_test.csv"), csv_time))
+print("Binary: {} rows, {} bytes, loaded in {:.4f}s".format(
+    len(log), os.path.getsize("binlog_test.bin"), bin_time))
+assert len(csv) == len(log)
+# rate from the format
+assert log.rate == 1000
+assert np.allclose(csv[:, 0], log.time, atol=1e-4)
+assert np.array_equal(csv[:, 1:].astype("f4"), values)
+print("385_0, first 5:", log["385_0"][:5])
+
+os.remove("binlog_test.csv")
+os.remove("binlog_test.bin")
+
+# timesteps with other signals end logging, leaving a readable file
+schema = Schema(["a", "b"])
+other = Schema(["c", "d", "e"], node=2)
+bin_log = BinaryLogger("binlog_test.bin")
+bin_log.start()
+for i in range(10):
+    bin_log.put(Timestep(schema, array("d", [i, -i]), time=i * 0.001))
+bin_log.put(Timestep(other, array("d", [1, 2, 3]), time=0.01))
+bin_log.put(Timestep(schema, array("d", [10, -10]), time=0.011))
+bin_log.stop(flush=True)
+log = BinaryLog("binlog_test.bin")
+assert len(log) == 10 and list(log["b"]) == [-i for i in range(10)]
+print("Logging ended on new signals, {} rows kept".format(len(log)))
+del log
+os.remove("binlog_test.bin")
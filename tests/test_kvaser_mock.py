@@ -0,0 +1,181 @@
+"""
+Runs the Kvaser device against a mock canlib, without hardware
+
+The mock channel is fed the frames of a virtual device at 4000 frames/s,
+with frames of another node, SDOs and heartbeats, and wakes a blocked read
+as soon as a frame arrives as canlib does. Prints the reads made, the time
+frames waited to be read and the frames rejected by the acceptance filter
+and in software, then the CPU used while the bus is idle. The bus
+statistics must not be read in the read thread
+"""
+
+from canPDOMonitor.virtual import Virtual
+import collections
+import threading
+import logging
+import types
+import sys
+import time
+
+
+class CanNoMsg(Exception):
+    pass
+
+
+class MockChannel:
+    """
+    Receive buffer of a canlib channel, filled by a feed thread
+    """
+
+    def __init__(self):
+        self.buffer = collections.deque()
+        # monotonic time each buffered frame arrived
+        self.arrived = collections.deque()
+        self.condition = threading.Condition()
+        self.iocontrol = types.SimpleNamespace(
+            flush_rx_buffer=self.flush, rx_buffer_level=0)
+        self.reads = 0
+        # seconds from arrival to read of every frame
+        self.waits = []
+        # acceptance filter and frames on the bus
+        self.code = 0
+        self.mask = 0
+        self.bus_frames = 0
+        # threads the bus statistics were read from
+        self.statistics_threads = set()
+
+    def flush(self):
+        with self.condition:
+            self.buffer.clear()
+            self.arrived.clear()
+            self.iocontrol.rx_buffer_level = 0
+
+    def receive(self, frames):
+        with self.condition:
+            now = time.monotonic()
+            self.bus_frames = self.bus_frames + len(frames)
+            for frame in frames:
+                if frame.id & self.mask != self.code:
+                    continue
+                self.buffer.append(frame)
+                self.arrived.append(now)
+            self.iocontrol.rx_buffer_level = len(self.buffer)
+            self.condition.notify()
+
+    def read(self, timeout=0):
+        with self.condition:
+            self.reads = self.reads + 1
+            if not self.buffer and timeout:
+                self.condition.wait(timeout / 1000)
+            if not self.buffer:
+                raise CanNoMsg()
+            self.iocontrol.rx_buffer_level = len(self.buffer) - 1
+            self.waits.append(time.monotonic() - self.arrived.popleft())
+            return self.buffer.popleft()
+
+    def readTimer(self):
+        return 0
+
+    def setBusOutputControl(self, mode):
+        pass
+
+    def canSetAcceptanceFilter(self, code, mask):
+        self.code = code
+        self.mask = mask
+
+    def get_bus_statistics(self):
+        self.statistics_threads.add(threading.current_thread())
+        return types.SimpleNamespace(stdData=self.bus_frames, extData=0)
+
+    def busOn(self):
+        pass
+
+    def busOff(self):
+        pass
+
+
+channel = MockChannel()
+mock = types.SimpleNamespace(
+    CanNoMsg=CanNoMsg,
+    reinitializeLibrary=lambda: None,
+    openChannel=lambda *args, **kwargs: channel,
+    Open=types.SimpleNamespace(EXCLUSIVE=8),
+    Driver=types.SimpleNamespace(NORMAL=4),
+    MessageFlag=types.SimpleNamespace(ERROR_FRAME=0x20),
+    **{"canBITRATE_" + name: i for i, name in enumerate(
+        ["1M", "500K", "250K", "125K", "100K", "62K", "50K", "83K", "10K"])})
+sys.modules["canlib"] = types.SimpleNamespace(canlib=mock)
+sys.modules["canlib.canlib"] = mock
+
+from canPDOMonitor.kvaser import Kvaser  # noqa: E402
+from canPDOMonitor.can import PDOConverter, DefaultFormat  # noqa: E402
+from canPDOMonitor import can  # noqa: E402
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running Kvaser mock canlib test")
+
+
+def feed(active):
+    """
+    Adds frames of a virtual device to the channel, 1ms of frames at a time
+
+    Each ms node 2 sends a PDO and node 1 an SDO, the heartbeats of both
+    are sent every 100ms
+    """
+    generator = Virtual()
+    others = Virtual(nodes=[2])
+    while active.is_set():
+        frames = generator.gen_frames(4)
+        frames.append(others.gen_frames(1)[0])
+        sdo = frames[0]
+        frames.append(can.Frame(id=0x581, timestamp=sdo.timestamp))
+        if not others._frame_count % 400:
+            frames.append(can.Frame(id=0x701, timestamp=sdo.timestamp))
+            frames.append(can.Frame(id=0x702, timestamp=sdo.timestamp))
+        # canlib frames, timestamps in ms
+        channel.receive([types.SimpleNamespace(
+            id=frame.id, data=frame.data, dlc=frame.dlc, flags=0,
+            timestamp=round(frame.timestamp * 1000))
+            for frame in frames])
+        time.sleep(0.001)
+
+
+for ring_buffer in (False, True):
+    channel.waits = []
+    channel.reads = 0
+    channel.statistics_threads = set()
+    device = Kvaser(ring_buffer=ring_buffer)
+    pdo_converter = PDOConverter(device, DefaultFormat())
+    active = threading.Event()
+    active.set()
+    feeder = threading.Thread(target=feed, args=(active,))
+    pdo_converter.start()
+    feeder.start()
+    for i in range(1000):
+        if pdo_converter.get_datapoints() is None:
+            break
+    active.clear()
+    feeder.join()
+
+    # bus idle, read thread should be blocked
+    time.sleep(0.2)
+    cpu = time.process_time()
+    time.sleep(1)
+    cpu = time.process_time() - cpu
+    pdo_converter.stop()
+
+    waits = sorted(channel.waits)
+    print("Ring buffer {}: {} frames in {} reads, {} missing".format(
+        ring_buffer, device.frame_count, channel.reads,
+        pdo_converter.missing_count))
+    print("Wait to read: median {:.5f}s, max {:.5f}s".format(
+        waits[len(waits) // 2], waits[-1]))
+    print("Rejected: {} in hardware, {} in software, {} unused".format(
+        device.hardware_rejected, device.software_rejected,
+        pdo_converter.unused_count))
+    print("Idle CPU: {:.3f}s per second".format(cpu))
+    # the statistics take about 10ms, so are not read in the read thread
+    assert device.read_thread not in channel.statistics_threads
+    print("Statistics read from: {}".format(", ".join(sorted(
+        thread.name for thread in channel.statistics_threads))))
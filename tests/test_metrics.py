@@ -0,0 +1,33 @@
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+from canPDOMonitor.monitor import Monitor, Calibrate
+from canPDOMonitor.datalog import DataLogger, CountCondition
+from canPDOMonitor.metrics import registry
+import urllib.request
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running metrics test")
+
+pdo_converter = PDOConverter(Virtual(), DefaultFormat(), check_loop_time=1)
+monitor = Monitor(pdo_converter=pdo_converter)
+monitor.add_filter(Calibrate("Temperature", gain=2))
+monitor.add_datalogger(DataLogger("montest1.txt",
+                                  end_condition=CountCondition(2000)))
+
+server = registry.serve_http(port=0)
+monitor.start()
+monitor.route_thread.join()
+monitor.stop()
+
+registry.write_file("metrics.prom")
+with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(
+        server.server_address[1])) as response:
+    print(response.read().decode())
+registry.stop_http()
+
+snapshot = registry.snapshot()
+print("Timesteps:", snapshot["canpdo_timesteps_total"])
+print("Bytes written:", snapshot["canpdo_datalogger_bytes_total"])
+print("Datalogger latency:", snapshot["canpdo_sink_latency_seconds"])
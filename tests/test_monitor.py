@@ -1,6 +1,8 @@
 from canPDOMonitor.monitor import Monitor
 from canPDOMonitor.datalog import DataLogger, TimeCondition
+from canPDOMonitor.scheduler import scheduler
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -16,3 +18,14 @@ monitor.add_datalogger(DataLogger("montest2.txt",
 
 # start the monitor, which ends automagically
 monitor.start()
+
+# other scheduled tasks keep running while the monitor stops itself
+ticks = []
+task = scheduler.call_every(0.01, lambda: ticks.append(time.monotonic()))
+while monitor.stop_thread is None:
+    time.sleep(0.1)
+monitor.stop_thread.join()
+task.cancel()
+gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+print("Monitor stopped in {:.3f}s, longest scheduler gap {:.3f}s".format(
+    monitor.stop_time, max(gaps)))
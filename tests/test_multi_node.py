@@ -0,0 +1,49 @@
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat, MultiNodeFormat
+from canPDOMonitor.monitor import Monitor, InvalidArgumentsError
+from canPDOMonitor.datalog import DataLogger
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+logger.info("Running PDO Converter multi node test")
+
+# setup virtual device sending PDOs from 3 nodes
+device = Virtual(nodes=[1, 2, 5])
+
+# set up PDO formats of each node, signal names prefixed by node
+format = MultiNodeFormat()
+for node in [1, 2, 5]:
+    format.add(DefaultFormat(node=node))
+
+# start PDO converter, timesteps of every node come from one queue
+pdo_converter = PDOConverter(device, format)
+pdo_converter.start()
+
+counts = {}
+while(pdo_converter.data_count < 1000*3):
+    timestep = pdo_converter.data_queue.get()
+    if timestep is None:
+        break
+    node = timestep.schema.node
+    # each node has its own index
+    assert timestep.index == counts.get(node, 0)
+    counts[node] = timestep.index + 1
+    if timestep.index % 500 == 0:
+        print(node, timestep)
+
+pdo_converter.stop()
+print(counts)
+
+# a datalogger must be given a node, a log holds the signals of one node
+monitor = Monitor(device=Virtual(nodes=[1, 2, 5]), format=format)
+datalogger = DataLogger("multi_node_test.txt")
+try:
+    monitor.add_datalogger(datalogger)
+except InvalidArgumentsError as e:
+    print(e)
+else:
+    raise AssertionError("Datalogger of all nodes accepted")
+datalogger.file.close()
+os.remove("multi_node_test.txt")
@@ -0,0 +1,31 @@
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import DefaultFormat, MultiNodeFormat
+from canPDOMonitor.multiproc import ProcessPDOConverter
+from functools import partial
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    logger.info("Running process PDO Converter test")
+
+    # set up PDO formats of 4 nodes
+    format = MultiNodeFormat()
+    for node in [1, 2, 3, 4]:
+        format.add(DefaultFormat(node=node))
+
+    # virtual device is created in the reader process, decoded by 2 workers
+    pdo_converter = ProcessPDOConverter(
+        partial(Virtual, nodes=[1, 2, 3, 4]), format, workers=2)
+    pdo_converter.start()
+
+    while(pdo_converter.data_count < 1000*4*5):
+        block = pdo_converter.get_datapoints()
+        if block is None:
+            break
+        if block.index[0] % 1000 < len(block):
+            print(block.schema.node, block.index[0], block.values[0, :2])
+
+    pdo_converter.stop()
+    print(pdo_converter.errors)
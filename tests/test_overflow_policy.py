@@ -0,0 +1,138 @@
+"""
+Fills small queues under each overflow policy and checks what is kept,
+dropped and spilled, then runs a PDOConverter with a slow consumer and
+checks the dropped timestep indices account for every missing timestep
+"""
+
+from canPDOMonitor.can import (BoundedQueue, FrameRing, OverflowPolicy,
+                               PDOConverter, DefaultFormat)
+from canPDOMonitor.datalog import Schema, Timestep, DataBlock
+from canPDOMonitor.virtual import Virtual
+from array import array
+import numpy as np
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running overflow policy test")
+
+
+def drain(queue):
+    """
+    Returns everything left in the queue
+    """
+    queue.close()
+    items = []
+    while True:
+        burst = queue.get_many(100)
+        if burst is None:
+            return items
+        items.extend(burst)
+
+
+# Stop: a burst that does not fit is rejected whole
+queue = BoundedQueue(5, OverflowPolicy.Stop)
+assert queue.put_many(list(range(4)))
+assert not queue.put_many([4, 5])
+assert drain(queue) == [0, 1, 2, 3] and queue.dropped == 0
+print("Stop: rejected burst, kept", [0, 1, 2, 3])
+
+# DropNewest: keeps what fits of the burst
+dropped = []
+queue = BoundedQueue(5, OverflowPolicy.DropNewest, on_drop=dropped.extend)
+queue.put_many(list(range(4)))
+assert queue.put_many([4, 5, 6])
+assert drain(queue) == [0, 1, 2, 3, 4]
+assert queue.dropped == 2 and dropped == [5, 6]
+print("DropNewest: dropped", dropped)
+
+# DropOldest: pops the oldest to make room, and the oldest of a burst
+# larger than the queue
+dropped = []
+queue = BoundedQueue(5, OverflowPolicy.DropOldest, on_drop=dropped.extend)
+queue.put_many(list(range(4)))
+queue.put_many([4, 5, 6])
+assert dropped == [0, 1]
+queue.put_many(list(range(7, 15)))
+assert drain(queue) == [10, 11, 12, 13, 14]
+assert queue.dropped == 10 and dropped == list(range(10))
+print("DropOldest: dropped", dropped)
+
+# Block: waits for the consumer, then drops once the timeout passes
+queue = BoundedQueue(5, OverflowPolicy.Block, timeout=0.2)
+queue.put_many(list(range(5)))
+timer = threading.Timer(0.05, queue.get_many, (3,))
+timer.start()
+start = time.monotonic()
+assert queue.put_many([5, 6])
+waited = time.monotonic() - start
+timer.join()
+assert 0.04 < waited < 0.2 and queue.dropped == 0
+start = time.monotonic()
+queue.put_many([7, 8])
+assert time.monotonic() - start >= 0.2
+assert drain(queue) == [3, 4, 5, 6] and queue.dropped == 2
+print("Block: waited {:.3f}s for room, then dropped after timeout".format(
+    waited))
+
+# Spill: once full everything goes through the file, in order, and items
+# come back as they were
+schema = Schema(["a", "b"])
+queue = BoundedQueue(5, OverflowPolicy.Spill)
+queue.put_many([Timestep(schema, array("d", [i, -i]), time=i * 0.001,
+                         index=i) for i in range(5)])
+for i in range(5, 23, 3):
+    queue.put_many([Timestep(schema, array("d", [j, -j]), time=j * 0.001,
+                             index=j) for j in range(i, i + 3)])
+assert queue.spilled == 18 and queue.dropped == 0 and queue.qsize() == 23
+items = queue.get_many(7)
+items.extend(drain(queue))
+assert [t.index for t in items] == list(range(23))
+assert all(list(t.values) == [t.index, -t.index] for t in items)
+assert items[-1].names == ["a", "b"] and queue.empty()
+print("Spill: {} spilled, read back in order".format(queue.spilled))
+
+# FrameRing can not drop the oldest or spill
+for policy in (OverflowPolicy.DropOldest, OverflowPolicy.Spill):
+    try:
+        FrameRing(16, policy)
+    except ValueError as e:
+        print("FrameRing:", e)
+    else:
+        raise AssertionError("FrameRing accepted {}".format(policy))
+
+# dropped timesteps and blocks are recorded as runs of indices
+pdo_converter = PDOConverter(Virtual(), DefaultFormat())
+pdo_converter._record_dropped([Timestep(schema, array("d", [0, 0]),
+                                        index=i) for i in (4, 5, 6, 9)])
+pdo_converter._record_dropped([DataBlock(schema, np.zeros((3, 2)),
+                                         np.arange(10, 13), np.zeros(3),
+                                         np.zeros(3))])
+assert list(pdo_converter.dropped_indices) == [(4, 3), (9, 4)]
+assert pdo_converter.dropped_count == 7
+
+# slow consumer, every timestep is either received or in dropped_indices
+for policy in (OverflowPolicy.DropNewest, OverflowPolicy.DropOldest):
+    pdo_converter = PDOConverter(Virtual(speed=4), DefaultFormat(),
+                                 overflow_policy=policy, queue_size=20)
+    pdo_converter.start()
+    received = []
+    while len(received) < 300:
+        received.append(pdo_converter.get_datapoints().index)
+        time.sleep(0.002)
+    pdo_converter.stop()
+    while True:
+        timestep = pdo_converter.data_queue.get(0)
+        if timestep is None:
+            break
+        received.append(timestep.index)
+    dropped = [i for first, count in pdo_converter.dropped_indices
+               for i in range(first, first + count)]
+    assert dropped and not set(dropped) & set(received)
+    assert sorted(received + dropped) == list(
+        range(pdo_converter.data_count))
+    print("{}: {} timesteps received, {} dropped in {} runs".format(
+        policy, len(received), pdo_converter.dropped_count,
+        len(pdo_converter.dropped_indices)))
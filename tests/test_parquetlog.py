@@ -0,0 +1,77 @@
+"""
+Logs the same timesteps to CSV and to Parquet, with the same start and end
+conditions, then reads both back and compares them
+
+Row groups are written every 2000 timesteps. Prints the size of each file,
+the row groups and the time taken to load one column. Requires pyarrow
+"""
+
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+from canPDOMonitor.datalog import DataLogger, TriggerCondition, Trigger
+from canPDOMonitor.datalog import CountCondition
+from canPDOMonitor.parquetlog import ParquetLogger
+import pyarrow.parquet as pq
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running Parquet log test")
+
+device = Virtual()
+pdo_converter = PDOConverter(device, DefaultFormat())
+
+# both start on the same rising edge and log 5000 timesteps
+csv_log = DataLogger("parquet_test.csv",
+                     TriggerCondition(Trigger.Rising, "385_0"),
+                     CountCondition(5000))
+parquet_log = ParquetLogger("parquet_test.parquet",
+                            TriggerCondition(Trigger.Rising, "385_0"),
+                            CountCondition(5000), row_group_size=2000)
+
+pdo_converter.start()
+csv_log.start()
+parquet_log.start()
+while csv_log.active.is_set() or parquet_log.active.is_set():
+    timesteps = pdo_converter.get_datapoints()
+    csv_log.put(timesteps)
+    parquet_log.put(timesteps)
+pdo_converter.stop()
+csv_log.stop()
+parquet_log.stop()
+
+with open("parquet_test.csv") as file:
+    names = file.readline().strip().split(",")
+    rows = [[float(v) for v in line.split(",")] for line in file]
+
+start = time.perf_counter()
+column = pq.read_table("parquet_test.parquet", columns=["385_0"])
+load_time = time.perf_counter() - start
+table = pq.read_table("parquet_test.parquet")
+metadata = pq.ParquetFile("parquet_test.parquet").metadata
+
+metadata_json = json.loads(table.schema.metadata[b"canpdo"])
+print("Metadata:", metadata_json)
+# rate from the format
+assert metadata_json["rate"] == 1000
+print("CSV: {} rows, {} bytes".format(len(rows),
+                                      os.path.getsize("parquet_test.csv")))
+print("Parquet: {} rows in {} row groups, {} bytes, bytes_written {}".format(
+    table.num_rows, metadata.num_row_groups,
+    os.path.getsize("parquet_test.parquet"), parquet_log.bytes_written))
+print("Loaded one column in {:.4f}s".format(load_time))
+assert table.column_names == names
+assert table.num_rows == len(rows)
+for i, name in enumerate(names):
+    values = table.column(name).to_pylist()
+    if name == "Time":
+        assert all(abs(a - row[i]) < 1e-4 for a, row in zip(values, rows))
+    else:
+        assert values == [row[i] for row in rows]
+print("385_0, first 5:", column.column(0).to_pylist()[:5])
+
+os.remove("parquet_test.csv")
+os.remove("parquet_test.parquet")
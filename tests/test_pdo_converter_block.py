@@ -0,0 +1,31 @@
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, FrameFormat, Format
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+logger.info("Running PDO Converter block decode test")
+
+# setup virtual device
+device = Virtual()
+
+# set up PDO formats
+format = Format()
+format.add(FrameFormat(0x181, use7Q8=False,
+                       name=["Wave Gen Out", "Encoder Pos"]))
+format.add(FrameFormat(0x281))
+format.add(FrameFormat(0x381))
+format.add(FrameFormat(0x481))
+
+# start PDO converter, decoding 100 timesteps at a time
+pdo_converter = PDOConverter(device, format, block_size=100)
+pdo_converter.start()
+
+while(pdo_converter.data_count < 1000*10):
+    block = pdo_converter.data_queue.get()
+    if block is None:
+        break
+    # one row per timestep, one column per signal
+    print(block.values.shape, block.time[0], block.values[0, 0])
+
+pdo_converter.stop()
@@ -0,0 +1,56 @@
+"""
+Reads PDOs sent on the python-can virtual interface with the PythonCAN
+device, through a PDOConverter
+
+A second bus on the channel sends the frames of a virtual device at 4000
+frames/s, with frames of another node that the bus filters reject
+"""
+
+from canPDOMonitor.pythoncan import PythonCAN
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+import can as pycan
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running python-can device test")
+
+
+def send(active):
+    """
+    Sends 1ms of frames of node 1 and node 2 at a time
+    """
+    bus = pycan.Bus(interface="virtual", channel="test")
+    node1 = Virtual()
+    node2 = Virtual(nodes=[2])
+    while active.is_set():
+        for frame in node1.gen_frames(4) + node2.gen_frames(4):
+            bus.send(pycan.Message(arbitration_id=frame.id, data=frame.data,
+                                   is_extended_id=False))
+        time.sleep(0.001)
+    bus.shutdown()
+
+
+for ring_buffer in (False, True):
+    device = PythonCAN(interface="virtual", channel="test",
+                       ring_buffer=ring_buffer)
+    pdo_converter = PDOConverter(device, DefaultFormat())
+    active = threading.Event()
+    active.set()
+    sender = threading.Thread(target=send, args=(active,))
+    pdo_converter.start()
+    sender.start()
+    for i in range(1000):
+        if pdo_converter.get_datapoints() is None:
+            break
+    active.clear()
+    sender.join()
+    pdo_converter.stop()
+    print("Ring buffer {}: {} frames queued, {} timesteps, {} missing, "
+          "{} unused".format(ring_buffer, device.frame_count,
+                             pdo_converter.data_count,
+                             pdo_converter.missing_count,
+                             pdo_converter.unused_count))
@@ -0,0 +1,40 @@
+"""
+Records the frames of a virtual device while converting them, then reads
+the log back in place and replays it
+"""
+
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.record import FrameRecorder, FrameLog
+from canPDOMonitor.replay import Replay
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running frame recorder test")
+
+device = Virtual()
+device.recorder = FrameRecorder("record_test.frames")
+pdo_converter = PDOConverter(device, DefaultFormat())
+pdo_converter.start()
+while(pdo_converter.data_count < 2000):
+    pdo_converter.get_datapoints()
+pdo_converter.stop()
+
+log = FrameLog("record_test.frames")
+print("Recorded {} frames, device read {}".format(len(log),
+                                                 device.frame_count))
+print("First frame:", log[0])
+# frames of the second half second, found by binary search
+records = log.time_range(0.5, 1.0)
+ids = sorted(set(records["id"].tolist()))
+print("0.5s to 1s: {} frames, ids {}".format(len(records), ids))
+
+# decode the recording again
+pdo_converter = PDOConverter(Replay("record_test.frames", speed=None),
+                             DefaultFormat())
+pdo_converter.start()
+while pdo_converter.get_datapoints() is not None:
+    pass
+pdo_converter.stop()
+print("Replayed {} timesteps".format(pdo_converter.data_count))
@@ -0,0 +1,35 @@
+"""
+Writes a candump log of virtual frames, then replays it as fast as possible
+and at real time through a PDOConverter
+"""
+
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.replay import Replay
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running replay test")
+
+# record 1 second of virtual frames as candump -l would
+virtual = Virtual()
+virtual.start()
+with open("replay_test.log", "w") as file:
+    for i in range(4000):
+        frame = virtual.get_frame()
+        file.write("({:.6f}) can0 {:03X}#{}\n".format(
+            frame.timestamp, frame.id, bytes(frame.data).hex().upper()))
+virtual.stop()
+
+for speed in (None, 1):
+    pdo_converter = PDOConverter(Replay("replay_test.log", speed=speed),
+                                 DefaultFormat())
+    start_time = time.monotonic()
+    pdo_converter.start()
+    while pdo_converter.get_datapoints() is not None:
+        pass
+    pdo_converter.stop()
+    print("Speed {}: {} timesteps in {:.3f}s".format(
+        speed, pdo_converter.data_count, time.monotonic() - start_time))
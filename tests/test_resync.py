@@ -0,0 +1,115 @@
+"""
+Feeds out of order and missing frames through a TimestepAssembler in resync
+mode, frame by frame and in blocks, and checks the timesteps kept have the
+right indices and data, and that the missing timesteps are counted
+
+Without resync, an out of order frame must raise FrameOrderError and close
+the data queue
+"""
+
+from canPDOMonitor.can import (TimestepAssembler, BoundedQueue,
+                               DefaultFormat, FrameOrderError)
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running resync test")
+
+format = DefaultFormat()
+format.compile()
+order = format.order
+# first 7Q8 value, the first frame holds single floats
+column = format.schema.index["641_0"]
+
+
+def frames(n, drop=(), swap=()):
+    """
+    Returns (id, data, timestamp) of the frames of n timesteps at 1kHz
+
+    The first 7Q8 value of every frame is the timestep number, so kept
+    timesteps can be checked for the right data. drop is the (timestep,
+    frame position) of frames left out, swap the timesteps with their
+    second and third frames swapped
+    """
+    result = []
+    for i in range(n):
+        step = [(id, struct.pack("<4h", i * 256, 0, 0, 0), i * 0.001)
+                for id in order]
+        if i in swap:
+            step[1], step[2] = step[2], step[1]
+        result.extend(frame for j, frame in enumerate(step)
+                      if (i, j) not in drop)
+    return result
+
+
+def assemble(frame_list, block_size=None, resync=True):
+    """
+    Returns the assembler and the (index, 641_0 value, time) of each
+    timestep it put on the queue
+    """
+    queue = BoundedQueue(1000)
+    assembler = TimestepAssembler(format, queue, block_size=block_size,
+                                  resync=resync)
+    for id, data, timestamp in frame_list:
+        assembler.process_frame(id, data, timestamp)
+    assembler.flush()
+    queue.close()
+    timesteps = []
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        if block_size is None:
+            timesteps.append((item.index, item.values[column], item.time))
+        else:
+            timesteps.extend(zip(item.index.tolist(),
+                                 item.values[:, column].tolist(),
+                                 item.time.tolist()))
+    return assembler, timesteps
+
+
+cases = [
+    # name, frames, indices kept, resync events
+    ("In order", frames(10), list(range(10)), []),
+    ("Dropped frame in 2 timesteps", frames(10, drop=[(4, 1), (5, 2)]),
+     [0, 1, 2, 3, 6, 7, 8, 9], [(5, 1), (6, 1)]),
+    ("Dropped first frame", frames(10, drop=[(4, 0)]),
+     [0, 1, 2, 3, 5, 6, 7, 8, 9], [(5, 1)]),
+    ("Dropped last frame", frames(10, drop=[(4, 3)]),
+     [0, 1, 2, 3, 5, 6, 7, 8, 9], [(5, 1)]),
+    ("Out of order frames", frames(10, swap=[2]),
+     [0, 1, 3, 4, 5, 6, 7, 8, 9], [(3, 1)]),
+    # index carried forward over several timesteps from the timestamps
+    ("Timestep lost then frame dropped",
+     frames(10, drop=[(3, j) for j in range(4)] + [(4, 1)]),
+     [0, 1, 2, 5, 6, 7, 8, 9], [(5, 2)]),
+]
+
+for block_size in (None, 3):
+    for name, frame_list, indices, events in cases:
+        assembler, timesteps = assemble(frame_list, block_size)
+        assert [t[0] for t in timesteps] == indices, timesteps
+        # data of each timestep is from the timestep its index says
+        assert all(value == index for index, value, t in timesteps)
+        assert all(abs(t - index / format.rate) < 1e-9
+                   for index, value, t in timesteps)
+        assert assembler.data_count == 10
+        assert list(assembler.resync_events) == events
+        assert assembler.resync_count == len(events)
+        assert assembler.missing_count == 10 - len(indices)
+        print("{}, block size {}: kept {}, resyncs {}".format(
+            name, block_size, indices, events))
+
+# without resync the first out of order frame is an error
+for block_size in (None, 3):
+    queue = BoundedQueue(1000)
+    assembler = TimestepAssembler(format, queue, block_size=block_size)
+    try:
+        for id, data, timestamp in frames(10, drop=[(4, 1)]):
+            assembler.process_frame(id, data, timestamp)
+    except FrameOrderError as e:
+        print("Block size {}: FrameOrderError {}".format(block_size, e))
+    else:
+        raise AssertionError("No FrameOrderError without resync")
+    assert queue.closed and assembler.resync_count == 0
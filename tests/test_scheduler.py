@@ -0,0 +1,25 @@
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+from canPDOMonitor.scheduler import scheduler
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running stop latency test")
+
+# cycle converters as an automated test sequence would
+stop_times = []
+for i in range(10):
+    pdo_converter = PDOConverter(Virtual(), DefaultFormat(),
+                                 check_loop_time=1)
+    pdo_converter.start()
+    while(pdo_converter.data_count < 200):
+        pdo_converter.get_datapoints()
+    print("Threads:", threading.active_count())
+    pdo_converter.stop()
+    stop_times.append(pdo_converter.stop_time)
+
+print("Stop time max: {:.3f}s, mean: {:.3f}s".format(
+    max(stop_times), sum(stop_times) / len(stop_times)))
+print("Scheduler max late: {:.4f}s".format(scheduler.max_late))
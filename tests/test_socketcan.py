@@ -0,0 +1,70 @@
+"""
+Reads PDOs with the SocketCAN device, through a PDOConverter
+
+Uses vcan0 if it exists, set up with:
+    ip link add dev vcan0 type vcan && ip link set up vcan0
+otherwise one end of a socketpair stands in for the CAN socket. The
+frames of a virtual device are sent at 4000 frames/s, with frames of
+another node that are filtered out
+"""
+
+from canPDOMonitor.socketcan import SocketCAN, CAN_FRAME
+from canPDOMonitor.virtual import Virtual
+from canPDOMonitor.can import PDOConverter, DefaultFormat
+import threading
+import logging
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running SocketCAN test")
+
+
+def open_sockets():
+    """
+    Returns socket to send on and device reading it
+    """
+    try:
+        sender = socket.socket(socket.AF_CAN, socket.SOCK_RAW,
+                               socket.CAN_RAW)
+        sender.bind(("vcan0",))
+        return sender, SocketCAN("vcan0", ring_buffer=ring_buffer)
+    except OSError:
+        logger.info("vcan0 not available, using a socketpair")
+        sender, receiver = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_DGRAM)
+        return sender, SocketCAN(sock=receiver, ring_buffer=ring_buffer)
+
+
+def send(sender, active):
+    """
+    Sends 1ms of frames of node 1 and node 2 at a time
+    """
+    node1 = Virtual()
+    node2 = Virtual(nodes=[2])
+    while active.is_set():
+        for frame in node1.gen_frames(4) + node2.gen_frames(4):
+            sender.send(CAN_FRAME.pack(frame.id, frame.dlc, frame.data))
+        time.sleep(0.001)
+
+
+for ring_buffer in (False, True):
+    sender, device = open_sockets()
+    pdo_converter = PDOConverter(device, DefaultFormat())
+    active = threading.Event()
+    active.set()
+    send_thread = threading.Thread(target=send, args=(sender, active))
+    pdo_converter.start()
+    send_thread.start()
+    for i in range(1000):
+        if pdo_converter.get_datapoints() is None:
+            break
+    active.clear()
+    send_thread.join()
+    pdo_converter.stop()
+    sender.close()
+    print("Ring buffer {}: {} frames queued, {} timesteps, {} missing, "
+          "{} rejected in software".format(
+              ring_buffer, device.frame_count, pdo_converter.data_count,
+              pdo_converter.missing_count, device.software_rejected))
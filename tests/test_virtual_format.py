@@ -0,0 +1,40 @@
+"""
+Runs a Virtual device sending a custom format at 100k frames/s, with
+waveforms set for some of the signals, through a PDOConverter
+"""
+
+from canPDOMonitor.virtual import Virtual, Square, Ramp, Noise, Constant
+from canPDOMonitor.can import PDOConverter, Format, FrameFormat
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+logger.info("Running Virtual format test")
+
+format = Format(rate=25000)
+format.add(FrameFormat(0x181, use7Q8=False, name=["square", "ramp"]))
+format.add(FrameFormat(0x281, name=["noise", "const", "c", "d"]))
+format.add(FrameFormat(0x381, name=["e", "f", "g", "h"]))
+format.add(FrameFormat(0x481, use7Q8=False, name=["i", "j"]))
+
+waveforms = {"square": Square(10, 2), "ramp": Ramp(5),
+             "noise": Noise(0.1, seed=1), "const": Constant(4.5)}
+
+for ring_buffer in (False, True):
+    device = Virtual(ring_buffer=ring_buffer, format=format,
+                     waveforms=waveforms)
+    pdo_converter = PDOConverter(device, format, block_size=1000)
+    start = time.monotonic()
+    pdo_converter.start()
+    n = 0
+    while n < 100000:
+        block = pdo_converter.get_datapoints()
+        n = n + len(block)
+    elapsed = time.monotonic() - start
+    pdo_converter.stop()
+    print("Ring buffer {}: {:.0f} frames/s, {} missing".format(
+        ring_buffer, pdo_converter.frame_count / elapsed,
+        pdo_converter.missing_count))
+
+print(block.values[:4, :4])